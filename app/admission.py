@@ -0,0 +1,136 @@
+from dataclasses import dataclass
+from typing import Any, Literal, Optional
+
+from fastapi import HTTPException
+
+from app.catalog import model_catalog
+from app.limiter import limiter
+from app.metrics import stage
+from app.mongo import async_db_manager, AiModel, TokenBucket, User
+from app.tokens import estimate_input_tokens
+from app.usage_writer import usage_log_writer
+
+DEFAULT_MAX_TOKENS = 2048
+# the router each access type is served by, as labeled in metrics
+ROUTERS = {"ui-access": "core", "api-access": "projects"}
+
+
+@dataclass
+class AdmissionContext:
+    """Everything the chat pipeline needs to know about an admitted request."""
+    user_name: str
+    access_type: Literal["api-access", "ui-access"]
+    user: Optional[User]
+    ai_model: AiModel
+    token_bucket: TokenBucket
+    input_tokens: int
+    # estimated tokens used within the bucket's window, including this request's input
+    window_usage: int
+    log_id: Any
+    # the requested model's id when the request was failed over to its fallback model
+    fallback_from: Optional[str] = None
+
+    @property
+    def model_id(self) -> str:
+        return self.ai_model["provider_id"]
+
+    @property
+    def provider(self) -> str:
+        return self.ai_model.get("provider")
+
+    @property
+    def router(self) -> str:
+        return ROUTERS[self.access_type]
+
+    @property
+    def max_tokens(self) -> int:
+        return self.ai_model.get("max_tokens") or DEFAULT_MAX_TOKENS
+
+
+async def admit_chat_request(user_name: str, model_id: str, access_type: Literal["api-access", "ui-access"], chat_history: list, encoding) -> AdmissionContext:
+    """
+    Resolve and admit a chat request before any upstream call: the model comes from the in-memory
+    catalog, the matching token bucket and the user from a single aggregation, and the estimated input
+    tokens (text and images, priced for the model's provider) are charged to the bucket with one atomic
+    counter update. The usage log is then queued for insertion.
+
+    Raises:
+        HTTPException: 404 if the model or a matching token bucket doesn't exist, 429 if the bucket is exhausted.
+    """
+    ai_model = model_catalog.get(model_id)
+    if not ai_model:
+        raise HTTPException(status_code=404, detail="Model not found")
+
+    labels = {"router": ROUTERS[access_type], "provider": ai_model.get("provider"), "model": model_id}
+    with stage("bucket_lookup", **labels):
+        token_bucket, user = await async_db_manager.get_token_bucket_and_user(user_name, model_id, access_type)
+    if not token_bucket:
+        raise HTTPException(status_code=404, detail="Token bucket not found for user and model")
+
+    with stage("tokenization", **labels):
+        input_tokens = estimate_input_tokens(chat_history, encoding, ai_model.get("provider"))
+    with stage("limit_usage", **labels):
+        window_usage = await limiter.acquire(token_bucket, input_tokens)
+    if window_usage is None:
+        raise HTTPException(status_code=429, detail="Token limit exceeded")
+
+    log = {
+        "ai_model_id": model_id,
+        "applicable_token_bucket_id": token_bucket["_id"],
+        "user_name": user_name,
+        "tokens_input": input_tokens,
+        "tokens_output": 0,
+        "request_completed": False,
+    }
+    log_id = await usage_log_writer.insert(log)
+
+    return AdmissionContext(
+        user_name=user_name,
+        access_type=access_type,
+        user=user,
+        ai_model=ai_model,
+        token_bucket=token_bucket,
+        input_tokens=input_tokens,
+        window_usage=window_usage,
+        log_id=log_id,
+    )
+
+
+async def admit_reused_response(user_name: str, model_id: str, access_type: Literal["api-access", "ui-access"], log_fields: dict):
+    """
+    Admit a request that will be answered with a response produced for another request, from
+    the completion cache or a coalesced in-flight call. The user still needs a token bucket for
+    the model, but nothing goes upstream so the bucket isn't charged. The request is logged as
+    completed with no tokens.
+
+    Args:
+        log_fields (dict): Fields flagging where the response came from, added to the usage log.
+
+    Raises:
+        HTTPException: 404 if the model or a matching token bucket doesn't exist.
+    """
+    if not model_catalog.get(model_id):
+        raise HTTPException(status_code=404, detail="Model not found")
+
+    token_bucket, _ = await async_db_manager.get_token_bucket_and_user(user_name, model_id, access_type)
+    if not token_bucket:
+        raise HTTPException(status_code=404, detail="Token bucket not found for user and model")
+
+    log = {
+        "ai_model_id": model_id,
+        "applicable_token_bucket_id": token_bucket["_id"],
+        "user_name": user_name,
+        "tokens_input": 0,
+        "tokens_output": 0,
+        "request_completed": True,
+        **log_fields,
+    }
+    await usage_log_writer.insert(log)
+
+
+async def admit_cache_hit(user_name: str, model_id: str, access_type: Literal["api-access", "ui-access"], cached_from_log_id: Any):
+    await admit_reused_response(user_name, model_id, access_type, {"cache_hit": True, "cached_from_log_id": cached_from_log_id})
+
+
+async def admit_coalesced_request(user_name: str, model_id: str, access_type: Literal["api-access", "ui-access"], coalesced_with_log_id: Any):
+    await admit_reused_response(user_name, model_id, access_type, {"coalesced": True, "coalesced_with_log_id": coalesced_with_log_id})
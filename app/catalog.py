@@ -0,0 +1,77 @@
+import asyncio
+from typing import Iterable, Optional
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from app.config import get_settings
+from app.context import ContextProxy
+from app.mongo import AiModel
+
+
+class ModelCatalog:
+    """
+    Process-local snapshot of the ai_models collection, keyed by provider_id.
+
+    The collection is tiny and rarely changes, so routes resolve models from memory. The
+    snapshot is reloaded whenever a Mongo change stream reports a change, or on a fixed
+    interval when change streams aren't available (e.g. a standalone mongod).
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.models: dict[str, AiModel] = {}
+        self.watch_task: Optional[asyncio.Task] = None
+
+    def replace(self, models: Iterable[AiModel]):
+        # swap the whole mapping so readers never see a half-built snapshot
+        self.models = {model["provider_id"]: model for model in models}
+
+    async def load(self):
+        self.replace(await self.collection.find({}).to_list(None))
+
+    def get(self, provider_id: str) -> Optional[AiModel]:
+        return self.models.get(provider_id)
+
+    def list_models(self) -> list[AiModel]:
+        return list(self.models.values())
+
+    def list_models_for_ids(self, provider_ids: Iterable[str]) -> list[AiModel]:
+        return [self.models[provider_id] for provider_id in provider_ids if provider_id in self.models]
+
+    async def _poll(self):
+        interval = get_settings().catalog_poll_interval_seconds
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.load()
+            except PyMongoError as error:
+                print(f"Failed to reload model catalog: {error}")
+
+    async def _watch(self):
+        while True:
+            try:
+                async with self.collection.watch() as change_stream:
+                    # reload after opening the stream so no change between the two is missed
+                    await self.load()
+                    async for _ in change_stream:
+                        await self.load()
+            except OperationFailure as error:
+                print(f"Change streams unavailable for the model catalog ({error}), polling instead")
+                await self._poll()
+                return
+            except PyMongoError as error:
+                print(f"Model catalog change stream interrupted: {error}")
+                await asyncio.sleep(1)
+
+    async def start(self):
+        await self.load()
+        if self.watch_task is None:
+            self.watch_task = asyncio.create_task(self._watch())
+
+    async def close(self):
+        if self.watch_task is not None:
+            self.watch_task.cancel()
+            self.watch_task = None
+
+
+model_catalog = ContextProxy("model_catalog")
@@ -0,0 +1,168 @@
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+
+from app.completion_cache import completion_key
+from app.context import ContextProxy
+from app.responses import ClosingStreamingResponse
+
+
+class ChunkBroadcast:
+    """
+    Reads a response stream once and fans its chunks out to every subscriber.
+
+    The upstream stream is driven by its own task rather than by any one client, so a
+    subscriber going away doesn't cut the stream off for the others. Subscribers that join
+    late are sent the chunks they missed first. Once the last subscriber leaves, whether or
+    not it read anything, the stream is cancelled.
+    """
+
+    def __init__(self, iterator: AsyncIterator, on_done: Callable[[], None]):
+        self.chunks: list[bytes] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.changed = asyncio.Event()
+        self.on_done = on_done
+        self.task = asyncio.create_task(self._pump(iterator))
+
+    def _notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def _pump(self, iterator: AsyncIterator):
+        try:
+            async for chunk in iterator:
+                self.chunks.append(chunk.encode() if isinstance(chunk, str) else chunk)
+                self._notify()
+        except Exception as error:
+            print(f"Shared completion stream failed: {error}")
+            self.error = error
+        finally:
+            self.done = True
+            self.on_done()
+            self._notify()
+
+    def subscribe(self) -> AsyncIterator[bytes]:
+        """A new subscriber, counted from now on rather than from when it starts reading."""
+        return _Subscription(self)
+
+    def _leave(self):
+        self.subscribers -= 1
+        if self.subscribers == 0 and not self.done:
+            self.task.cancel()
+
+
+class _Subscription:
+    # a class rather than an async generator so a subscriber closed before it's iterated, e.g.
+    # when the client disconnects first, still leaves the broadcast
+    def __init__(self, broadcast: ChunkBroadcast):
+        self.broadcast = broadcast
+        self.sent = 0
+        self.closed = False
+        broadcast.subscribers += 1
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> bytes:
+        broadcast = self.broadcast
+        try:
+            while True:
+                if self.sent < len(broadcast.chunks):
+                    chunk = broadcast.chunks[self.sent]
+                    self.sent += 1
+                    return chunk
+                if broadcast.done:
+                    if broadcast.error is not None:
+                        raise broadcast.error
+                    raise StopAsyncIteration
+                await broadcast.changed.wait()
+        except BaseException:
+            await self.aclose()
+            raise
+
+    async def aclose(self):
+        if not self.closed:
+            self.closed = True
+            self.broadcast._leave()
+
+
+class SharedCompletion:
+    """The outcome of a coalesced upstream call, turned into a separate response for each caller."""
+
+    def __init__(self, response: Response, log_id: Any, on_done: Callable[[], None]):
+        self.log_id = log_id
+        self.status_code = response.status_code
+        self.media_type = response.media_type
+        self.headers = dict(response.headers)
+        if isinstance(response, StreamingResponse):
+            self.body = None
+            self.stream = ChunkBroadcast(response.body_iterator, on_done)
+        else:
+            self.body = response.body
+            self.stream = None
+            on_done()
+
+    def response(self) -> Response:
+        if self.stream is not None:
+            return ClosingStreamingResponse(self.stream.subscribe(), status_code=self.status_code, headers=self.headers, media_type=self.media_type)
+        return Response(content=self.body, status_code=self.status_code, headers=self.headers, media_type=self.media_type)
+
+
+class CompletionFlights:
+    """
+    Single-flight layer for chat completions: while a request is in flight, identical requests
+    (same canonical key) wait for its response instead of making their own upstream call.
+    Streams stay joinable until the last chunk has been received.
+    """
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self.flights: dict[str, asyncio.Future] = {}
+
+    def key_for(self, request: Request, user_name: str, access_type: str, body: dict) -> Optional[str]:
+        """The flight key for a request, or None if it shouldn't be coalesced (disabled, or `Cache-Control: no-store`)."""
+        if not self.enabled or "no-store" in request.headers.get("cache-control", ""):
+            return None
+        return completion_key(user_name, access_type, body)
+
+    def _land(self, key: str, flight: asyncio.Future):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    async def _lead(self, key: str, complete: Callable[[], Awaitable[tuple[Response, Any]]]) -> SharedCompletion:
+        flight = self.flights[key]
+        try:
+            response, log_id = await complete()
+        except BaseException:
+            self._land(key, flight)
+            raise
+        return SharedCompletion(response, log_id, on_done=lambda: self._land(key, flight))
+
+    async def join(self, key: str, complete: Callable[[], Awaitable[tuple[Response, Any]]]) -> tuple[Response, Any, bool]:
+        """
+        Get a response for the request with this key, calling `complete` only if no identical
+        request is in flight. Errors raised by `complete` are raised for every caller.
+
+        Args:
+            key (str): The flight key from `key_for`.
+            complete (Callable): Admits the request and calls upstream, returns the response and its usage log id.
+
+        Returns:
+            tuple[Response, Any, bool]: The caller's response, the usage log id of the request that went
+            upstream, and whether this caller is that request.
+        """
+        flight = self.flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = asyncio.ensure_future(self._lead(key, complete))
+            self.flights[key] = flight
+        # shield so a caller that goes away doesn't cancel the call for everyone else waiting on it
+        shared = await asyncio.shield(flight)
+        return shared.response(), shared.log_id, leader
+
+
+completion_flights = ContextProxy("completion_flights")
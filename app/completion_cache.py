@@ -0,0 +1,147 @@
+import datetime
+import hashlib
+from typing import Any, Optional, TypedDict
+
+import orjson
+from fastapi import Request
+from fastapi.responses import Response, StreamingResponse
+from pymongo.errors import PyMongoError
+
+from app.cache import TTLCache
+from app.context import ContextProxy
+from app.providers import SSE_HEADERS
+
+# request fields that change how the response is delivered but not what it says
+_DELIVERY_FIELDS = ("stream", "stream_options")
+
+
+def completion_key(user_name: str, access_type: str, body: dict) -> str:
+    """A canonical hash of a chat request: the same user, access type and body always give the same key."""
+    stream = bool(body.get("stream", False))
+    include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+    canonical = orjson.dumps(
+        {
+            "user_name": user_name,
+            "access_type": access_type,
+            "body": {k: v for k, v in body.items() if k not in _DELIVERY_FIELDS},
+            # responses are reused verbatim, so the delivery options are part of the key
+            "stream": stream,
+            "include_usage": include_usage,
+        },
+        option=orjson.OPT_SORT_KEYS,
+    )
+    return hashlib.sha256(canonical).hexdigest()
+
+
+class CachedCompletion(TypedDict):
+    stream: bool
+    # the response body, a single chunk for non-streaming completions and every SSE event for streams
+    chunks: list[bytes]
+    log_id: Any
+
+
+class CompletionCache:
+    """
+    Exact-match cache of chat completion responses.
+
+    Entries are keyed on a canonical hash of the user, access type and request body, and kept
+    in a bounded in-memory LRU tier. With `mongo_collection` set there is a second, shared tier
+    in Mongo so workers can serve each other's entries. Streams are cached as the SSE events
+    that were sent and replayed as they are.
+    """
+
+    def __init__(self, enabled: bool, ttl: float, max_entries: int, max_entry_bytes: int, mongo_collection=None):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_entry_bytes = max_entry_bytes
+        self.entries = TTLCache(maxsize=max_entries, ttl=ttl)
+        self.mongo_collection = mongo_collection
+
+    def key_for(self, request: Request, user_name: str, access_type: str, body: dict) -> Optional[str]:
+        """
+        The cache key for a request, or None when the request shouldn't use the cache:
+        the cache is disabled or the client sent `Cache-Control: no-store`.
+        """
+        if not self.enabled or "no-store" in request.headers.get("cache-control", ""):
+            return None
+        return completion_key(user_name, access_type, body)
+
+    async def get(self, request: Request, key: str) -> Optional[CachedCompletion]:
+        # no-cache asks for a fresh response, which is still stored for later requests
+        if "no-cache" in request.headers.get("cache-control", ""):
+            return None
+        entry = self.entries.get(key)
+        if entry is not None or self.mongo_collection is None:
+            return entry
+        try:
+            document = await self.mongo_collection.find_one({"_id": key, "expiresAt": {"$gt": datetime.datetime.utcnow()}})
+        except PyMongoError as error:
+            print(f"Failed to read the completion cache: {error}")
+            return None
+        if document is None:
+            return None
+        entry = {"stream": document["stream"], "chunks": document["chunks"], "log_id": document["log_id"]}
+        ttl = (document["expiresAt"] - datetime.datetime.utcnow()).total_seconds()
+        self.entries.set(key, entry, ttl=min(ttl, self.ttl))
+        return entry
+
+    async def set(self, key: str, entry: CachedCompletion):
+        self.entries.set(key, entry)
+        if self.mongo_collection is None:
+            return
+        document = {**entry, "_id": key, "expiresAt": datetime.datetime.utcnow() + datetime.timedelta(seconds=self.ttl)}
+        try:
+            await self.mongo_collection.replace_one({"_id": key}, document, upsert=True)
+        except PyMongoError as error:
+            print(f"Failed to write the completion cache: {error}")
+
+    def response(self, entry: CachedCompletion) -> Response:
+        """Replay a cached completion."""
+        if entry["stream"]:
+            async def replay():
+                for chunk in entry["chunks"]:
+                    yield chunk
+            return StreamingResponse(replay(), media_type="text/event-stream", headers={**SSE_HEADERS, "X-Cache": "HIT"})
+        return Response(content=entry["chunks"][0], media_type="application/json", headers={"X-Cache": "HIT"})
+
+    async def capture(self, key: str, response: Response, log_id: Any) -> Response:
+        """
+        Store a successful upstream response under `key` as it's sent. Streams are only stored
+        once they have been sent in full, a stream that fails or is cut off isn't cached.
+        """
+        if response.status_code != 200:
+            return response
+        response.headers["X-Cache"] = "MISS"
+        if not isinstance(response, StreamingResponse):
+            if len(response.body) <= self.max_entry_bytes:
+                await self.set(key, {"stream": False, "chunks": [response.body], "log_id": log_id})
+            return response
+
+        body_iterator = response.body_iterator
+
+        async def capture_stream():
+            chunks = []
+            size = 0
+            try:
+                async for chunk in body_iterator:
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode()
+                    if chunks is not None:
+                        size += len(chunk)
+                        if size <= self.max_entry_bytes:
+                            chunks.append(chunk)
+                        else:
+                            chunks = None  # too large to cache, stop collecting
+                    yield chunk
+            finally:
+                # pass a client disconnect on to the upstream stream
+                await body_iterator.aclose()
+            # a stream cut off upstream ends without [DONE]
+            if chunks and chunks[-1].endswith(b"data: [DONE]\n\n"):
+                await self.set(key, {"stream": True, "chunks": chunks, "log_id": log_id})
+
+        response.body_iterator = capture_stream()
+        return response
+
+
+completion_cache = ContextProxy("completion_cache")
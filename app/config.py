@@ -1,4 +1,5 @@
 from functools import lru_cache
+from typing import Optional
 
 from pydantic_settings import BaseSettings
 
@@ -12,6 +13,69 @@ class Settings(BaseSettings):
     mongo_uri: str
     unkey_api_id: str
     unkey_api_key: str
+    rate_limiter_backend: str = "mongo"  # "mongo" or "memory"
+    catalog_poll_interval_seconds: float = 30.0  # only used when change streams are unavailable
+
+    # write-behind buffer for request usage logs
+    usage_log_batch_size: int = 500
+    usage_log_flush_interval_seconds: float = 0.5
+    usage_log_max_pending: int = 10000
+
+    # exact-match completion cache, off unless enabled
+    completion_cache_enabled: bool = False
+    completion_cache_ttl_seconds: float = 300.0
+    completion_cache_max_entries: int = 1000
+    completion_cache_max_entry_bytes: int = 1_000_000
+    completion_cache_mongo_enabled: bool = False  # share cached completions between workers
+    # identical chat requests in flight at the same time share one upstream call, opt-in since
+    # every stream then goes through a broadcast task that keeps all its chunks
+    completion_coalescing_enabled: bool = False
+
+    # Auth0 token verification
+    jwks_refresh_interval_seconds: float = 600.0
+    jwt_cache_max_ttl_seconds: float = 3600.0
+    jwt_cache_max_entries: int = 10000
+
+    # project API key verification cache
+    unkey_cache_ttl_seconds: float = 30.0
+    unkey_negative_cache_ttl_seconds: float = 5.0
+    unkey_cache_max_entries: int = 10000
+
+    # shared upstream (provider) HTTP clients
+    anthropic_base_url: str = "https://api.anthropic.com"
+    openai_base_url: str = "https://api.openai.com/v1"
+    upstream_http2: bool = False
+    upstream_max_connections: int = 100
+    upstream_max_keepalive_connections: int = 20
+    upstream_keepalive_expiry: float = 30.0
+    upstream_connect_timeout: float = 5.0
+    upstream_read_timeout: float = 600.0
+    upstream_write_timeout: float = 30.0
+    upstream_pool_timeout: float = 10.0
+
+    # upstream call scheduling: concurrency caps, priority weights and load shedding
+    upstream_max_concurrency: int = 64  # per provider
+    upstream_provider_max_concurrency: dict[str, int] = {}  # per-provider overrides, e.g. {"Anthropic": 32}
+    upstream_model_max_concurrency: int = 32
+    upstream_queue_max_depth: int = 256
+    upstream_queue_max_wait_seconds: float = 10.0
+    upstream_priority_weights: dict[str, int] = {"ui-access": 3, "api-access": 1}
+
+    # upstream resilience: timeouts, retries before the first byte, hedging and circuit breaking
+    upstream_ttfb_timeout_seconds: float = 60.0  # until a stream's response headers arrive
+    upstream_response_timeout_seconds: float = 300.0  # for a whole non-streaming response
+    upstream_stream_idle_timeout_seconds: float = 60.0  # between two chunks of a stream
+    upstream_max_attempts: int = 3
+    upstream_retry_base_delay_seconds: float = 0.5
+    upstream_retry_max_delay_seconds: float = 8.0
+    upstream_hedge_after_seconds: Optional[float] = None  # hedge non-streaming calls slower than this, off by default
+    circuit_failure_threshold: int = 5
+    circuit_reset_seconds: float = 30.0
+
+    # instrumentation: Prometheus metrics at /metrics, and per-request trace spans written as JSON lines
+    metrics_enabled: bool = True
+    trace_export_path: Optional[str] = None  # tracing is off unless set
+    trace_flush_interval_seconds: float = 1.0
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,224 @@
+import asyncio
+import time
+from functools import cached_property
+from typing import Any, Optional
+
+from app.config import get_settings, Settings
+
+
+class AppContext:
+    """
+    The process-wide resources of the gateway: the Mongo clients, the auth verifiers, the
+    upstream clients and the services built on them.
+
+    Each resource is created the first time it's used, never at import, so importing the app
+    needs neither configuration nor running services. `start` connects what needs connecting
+    when the app starts and times each step, `close` releases it all on shutdown. Tests can
+    build a context with their own settings and install it with `set_context`.
+    """
+
+    def __init__(self, settings: Optional[Settings] = None):
+        self._settings = settings
+        # seconds taken by each startup step, and by the whole startup
+        self.startup_timings: dict[str, float] = {}
+        self.startup_seconds: Optional[float] = None
+
+    @cached_property
+    def settings(self) -> Settings:
+        return self._settings or get_settings()
+
+    # Mongo
+    @cached_property
+    def mongo_client(self):
+        from pymongo import MongoClient
+        return MongoClient(self.settings.mongo_uri)
+
+    @cached_property
+    def db(self):
+        return self.mongo_client.get_database('bongodb').get_collection('bongodb')
+
+    @cached_property
+    def async_mongo_client(self):
+        from motor.motor_asyncio import AsyncIOMotorClient
+        return AsyncIOMotorClient(self.settings.mongo_uri)
+
+    @cached_property
+    def async_db(self):
+        # async handle on the same database, used on the request hot path so Mongo round trips don't block the event loop
+        return self.async_mongo_client.get_database('bongodb').get_collection('bongodb')
+
+    @cached_property
+    def db_manager(self):
+        from app.mongo import DatabaseManager
+        return DatabaseManager(client=self.mongo_client, db=self.db)
+
+    @cached_property
+    def async_db_manager(self):
+        from app.mongo import AsyncDatabaseManager
+        return AsyncDatabaseManager(client=self.async_mongo_client, db=self.async_db)
+
+    # auth
+    @cached_property
+    def token_verifier(self):
+        from app.utils import VerifyToken
+        return VerifyToken(self.settings)
+
+    @cached_property
+    def unkey_verifier(self):
+        from app.utils import UnkeyKeyVerifier
+        return UnkeyKeyVerifier(api_id=self.settings.unkey_api_id, api_key=self.settings.unkey_api_key, settings=self.settings)
+
+    # upstream calls
+    @cached_property
+    def upstream_clients(self):
+        from app.upstream import UpstreamClients
+        return UpstreamClients(self.settings)
+
+    @cached_property
+    def upstream_scheduler(self):
+        from app.scheduler import UpstreamScheduler
+        return UpstreamScheduler(
+            max_concurrency=self.settings.upstream_max_concurrency,
+            provider_max_concurrency=self.settings.upstream_provider_max_concurrency,
+            max_model_concurrency=self.settings.upstream_model_max_concurrency,
+            max_queue_depth=self.settings.upstream_queue_max_depth,
+            max_wait=self.settings.upstream_queue_max_wait_seconds,
+            weights=self.settings.upstream_priority_weights,
+        )
+
+    @cached_property
+    def circuit_breakers(self):
+        from app.resilience import CircuitBreakers
+        return CircuitBreakers(
+            failure_threshold=self.settings.circuit_failure_threshold,
+            reset_seconds=self.settings.circuit_reset_seconds,
+        )
+
+    # chat pipeline
+    @cached_property
+    def model_catalog(self):
+        from app.catalog import ModelCatalog
+        return ModelCatalog(self.async_db.ai_models)
+
+    @cached_property
+    def limiter(self):
+        from app.limiter import create_limiter
+        return create_limiter(self.settings.rate_limiter_backend, self.async_db)
+
+    @cached_property
+    def usage_log_writer(self):
+        from app.usage_writer import UsageLogWriter
+        return UsageLogWriter(
+            self.async_db_manager,
+            batch_size=self.settings.usage_log_batch_size,
+            flush_interval=self.settings.usage_log_flush_interval_seconds,
+            max_pending=self.settings.usage_log_max_pending,
+        )
+
+    @cached_property
+    def completion_cache(self):
+        from app.completion_cache import CompletionCache
+        return CompletionCache(
+            enabled=self.settings.completion_cache_enabled,
+            ttl=self.settings.completion_cache_ttl_seconds,
+            max_entries=self.settings.completion_cache_max_entries,
+            max_entry_bytes=self.settings.completion_cache_max_entry_bytes,
+            mongo_collection=self.async_db.completion_cache if self.settings.completion_cache_mongo_enabled else None,
+        )
+
+    @cached_property
+    def completion_flights(self):
+        from app.coalescing import CompletionFlights
+        return CompletionFlights(enabled=self.settings.completion_coalescing_enabled)
+
+    @cached_property
+    def trace_exporter(self):
+        from app.tracing import TraceExporter
+        return TraceExporter(path=self.settings.trace_export_path, flush_interval=self.settings.trace_flush_interval_seconds)
+
+    async def _step(self, name: str, start):
+        # `start` creates the resource too, so building it counts towards the step
+        started = time.perf_counter()
+        await start()
+        self.startup_timings[name] = time.perf_counter() - started
+
+    async def start(self):
+        """Connect to Mongo and the providers and start the background tasks, timing each step."""
+        from app.mongo import initialize_db
+
+        started = time.perf_counter()
+        print("Initializing database...")
+
+        async def database():
+            # pymongo blocks, keep it off the event loop
+            await asyncio.to_thread(self.db_manager.check_connection)
+            await asyncio.to_thread(initialize_db, self.db)
+
+        await self._step("database", database)
+        print("Loading model catalog...")
+        await self._step("model_catalog", lambda: self.model_catalog.start())
+        await self._step("usage_log_writer", lambda: self.usage_log_writer.start())
+        await self._step("trace_exporter", lambda: self.trace_exporter.start())
+        print("Opening upstream clients...")
+        await self._step("upstream_clients", lambda: self.upstream_clients.open())
+        await self._step("unkey_verifier", lambda: self.unkey_verifier.start())
+        print("Prefetching JWKS...")
+        await self._step("token_verifier", lambda: self.token_verifier.start())
+        self.startup_seconds = time.perf_counter() - started
+        steps = ", ".join(f"{name} {seconds:.3f}s" for name, seconds in self.startup_timings.items())
+        print(f"Started in {self.startup_seconds:.3f}s ({steps})")
+
+    async def close(self):
+        """Close the resources that were created, flushing what's still buffered."""
+        for name in ("upstream_clients", "unkey_verifier", "token_verifier", "model_catalog", "usage_log_writer", "trace_exporter"):
+            if name in self.__dict__:
+                if name == "usage_log_writer":
+                    print("Flushing usage logs...")
+                await getattr(self, name).close()
+        # last, the usage logs are flushed through them. Their close() is synchronous and
+        # pymongo's waits for its monitor threads, keep it off the event loop
+        for name in ("async_mongo_client", "mongo_client"):
+            if name in self.__dict__:
+                await asyncio.to_thread(getattr(self, name).close)
+
+
+_context: Optional[AppContext] = None
+
+
+def get_context() -> AppContext:
+    """The application context of this process, created on first use."""
+    global _context
+    if _context is None:
+        _context = AppContext()
+    return _context
+
+
+def set_context(context: Optional[AppContext]):
+    """Install `context` as the application context, or reset it with None so the next use creates a fresh one."""
+    global _context
+    _context = context
+
+
+class ContextProxy:
+    """
+    Stands in for one resource of the application context, so a module can keep exposing its
+    singleton by name (`from app.catalog import model_catalog`) without building it at import.
+    Attribute access is forwarded to the resource of whichever context is current.
+    """
+
+    __slots__ = ("_name",)
+
+    def __init__(self, name: str):
+        object.__setattr__(self, "_name", name)
+
+    def _resolve(self) -> Any:
+        return getattr(get_context(), self._name)
+
+    def __getattr__(self, attribute: str) -> Any:
+        return getattr(self._resolve(), attribute)
+
+    def __setattr__(self, attribute: str, value: Any):
+        setattr(self._resolve(), attribute, value)
+
+    def __repr__(self) -> str:
+        return f"<{self._name} of the application context>"
@@ -0,0 +1,198 @@
+import time
+import datetime
+from typing import Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from app.context import ContextProxy
+from app.mongo import TokenBucket
+
+# Token buckets are enforced with a sliding-window counter. Tokens are added to
+# fixed windows of `window_duration_mins`, and the usage over the trailing window
+# is estimated as `current + previous * (1 - elapsed fraction of current)`.
+# Admission only ever looks at the two most recent windows of a bucket, so its
+# cost is constant no matter how many requests the bucket has served.
+
+
+def _window_position(window_secs: int, now: float) -> tuple[int, float]:
+    # returns the index of the current window and the weight of the previous one
+    index = int(now // window_secs)
+    elapsed = (now - index * window_secs) / window_secs
+    return index, 1.0 - elapsed
+
+
+class InMemoryLimiterBackend:
+    """Keeps window counters in process memory. Only correct with a single worker."""
+
+    def __init__(self):
+        # bucket key -> [window index, current window tokens, previous window tokens]
+        self.counters: dict[str, list] = {}
+
+    def _counter(self, key: str, index: int) -> list:
+        counter = self.counters.get(key)
+        if counter is None:
+            counter = self.counters[key] = [index, 0, 0]
+        elif counter[0] != index:
+            # roll the windows forward, anything older than the previous window is dropped
+            counter[2] = counter[1] if counter[0] == index - 1 else 0
+            counter[1] = 0
+            counter[0] = index
+        return counter
+
+    async def estimate(self, key: str, window_secs: int, now: float) -> float:
+        index, prev_weight = _window_position(window_secs, now)
+        counter = self._counter(key, index)
+        return counter[1] + counter[2] * prev_weight
+
+    async def try_consume(self, key: str, window_secs: int, limit: int, tokens: int, now: float) -> Optional[float]:
+        # no awaits between the check and the increment, so this is atomic on the event loop
+        index, prev_weight = _window_position(window_secs, now)
+        counter = self._counter(key, index)
+        usage = counter[1] + counter[2] * prev_weight
+        if usage + tokens > limit:
+            return None
+        counter[1] += tokens
+        return usage + tokens
+
+    async def add(self, key: str, window_secs: int, tokens: int, now: float):
+        index, _ = _window_position(window_secs, now)
+        self._counter(key, index)[1] += tokens
+
+
+class MongoLimiterBackend:
+    """Keeps window counters in a Mongo collection, shared by every worker.
+
+    Each window is one document holding a running total that is only ever changed
+    with `$inc`, so concurrent admissions cannot overshoot the limit.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        # closed windows never change again, so their totals can be cached
+        self.closed_windows: dict[str, int] = {}
+
+    @staticmethod
+    def _counter_id(key: str, window_secs: int, index: int) -> str:
+        return f"{key}:{window_secs}:{index}"
+
+    async def _previous_total(self, key: str, window_secs: int, index: int) -> int:
+        counter_id = self._counter_id(key, window_secs, index - 1)
+        if counter_id in self.closed_windows:
+            return self.closed_windows[counter_id]
+        counter = await self.collection.find_one({"_id": counter_id}, {"tokens": 1})
+        total = counter["tokens"] if counter else 0
+        if len(self.closed_windows) > 10000:
+            self.closed_windows.clear()
+        self.closed_windows[counter_id] = total
+        return total
+
+    def _current_fields(self, key: str, window_secs: int, index: int) -> dict:
+        window_start = datetime.datetime.utcfromtimestamp(index * window_secs)
+        return {
+            "bucket_key": key,
+            "window_start": window_start,
+            # the TTL index on expiresAt removes counters once they can no longer be read
+            "expiresAt": window_start + datetime.timedelta(seconds=2 * window_secs),
+        }
+
+    async def estimate(self, key: str, window_secs: int, now: float) -> float:
+        index, prev_weight = _window_position(window_secs, now)
+        counter = await self.collection.find_one({"_id": self._counter_id(key, window_secs, index)}, {"tokens": 1})
+        current = counter["tokens"] if counter else 0
+        return current + await self._previous_total(key, window_secs, index) * prev_weight
+
+    async def try_consume(self, key: str, window_secs: int, limit: int, tokens: int, now: float) -> Optional[float]:
+        index, prev_weight = _window_position(window_secs, now)
+        previous = await self._previous_total(key, window_secs, index) * prev_weight
+        ceiling = limit - previous - tokens
+        if ceiling < 0:
+            return None
+        counter_filter = {"_id": self._counter_id(key, window_secs, index), "tokens": {"$lte": ceiling}}
+        update = {"$inc": {"tokens": tokens}}
+        try:
+            # only matches while the current window still has room; if the counter exists
+            # but is full, the upsert collides with it
+            counter = await self.collection.find_one_and_update(
+                counter_filter,
+                {**update, "$setOnInsert": self._current_fields(key, window_secs, index)},
+                upsert=True,
+                projection={"tokens": 1},
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # the counter exists now: either it's full, or a concurrent first request of the
+            # window created it (Mongo doesn't retry upserts whose filter isn't pure equality).
+            # Try once more without upserting, no match means the window is full
+            counter = await self.collection.find_one_and_update(
+                counter_filter,
+                update,
+                projection={"tokens": 1},
+                return_document=ReturnDocument.AFTER,
+            )
+            if counter is None:
+                return None
+        return counter["tokens"] + previous
+
+    async def add(self, key: str, window_secs: int, tokens: int, now: float):
+        index, _ = _window_position(window_secs, now)
+        await self.collection.update_one(
+            {"_id": self._counter_id(key, window_secs, index)},
+            {"$inc": {"tokens": tokens}, "$setOnInsert": self._current_fields(key, window_secs, index)},
+            upsert=True,
+        )
+
+
+class TokenBucketLimiter:
+    """Admission control for TokenBuckets on top of a pluggable counter backend."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @staticmethod
+    def _bucket_params(token_bucket: TokenBucket) -> tuple[str, int]:
+        return str(token_bucket["_id"]), max(int(token_bucket["window_duration_mins"]), 1) * 60
+
+    async def acquire(self, token_bucket: TokenBucket, tokens: int, now: Optional[float] = None) -> Optional[int]:
+        """
+        Charge `tokens` against the bucket if it has room for them.
+
+        Returns:
+            Optional[int]: The estimated window usage including these tokens, or None if the bucket is exhausted.
+        """
+        key, window_secs = self._bucket_params(token_bucket)
+        now = time.time() if now is None else now
+        usage = await self.backend.try_consume(key, window_secs, token_bucket["max_tokens_within_window"], tokens, now)
+        return None if usage is None else int(usage)
+
+    async def try_acquire(self, token_bucket: TokenBucket, tokens: int, now: Optional[float] = None) -> bool:
+        """
+        Charge `tokens` against the bucket if it has room for them.
+
+        Returns:
+            bool: True if the tokens were admitted, False if the bucket is exhausted.
+        """
+        return await self.acquire(token_bucket, tokens, now) is not None
+
+    async def record(self, token_bucket: TokenBucket, tokens: int, now: Optional[float] = None):
+        """Charge tokens that have already been spent, e.g. output tokens once a completion ends."""
+        if not tokens:
+            return
+        key, window_secs = self._bucket_params(token_bucket)
+        await self.backend.add(key, window_secs, tokens, time.time() if now is None else now)
+
+    async def usage(self, token_bucket: TokenBucket, now: Optional[float] = None) -> int:
+        """Estimated number of tokens used within the bucket's trailing window."""
+        key, window_secs = self._bucket_params(token_bucket)
+        return int(await self.backend.estimate(key, window_secs, time.time() if now is None else now))
+
+
+def create_limiter(backend: str, async_db) -> TokenBucketLimiter:
+    if backend == "memory":
+        return TokenBucketLimiter(InMemoryLimiterBackend())
+    if backend == "mongo":
+        return TokenBucketLimiter(MongoLimiterBackend(async_db.token_bucket_counters))
+    raise ValueError(f"Unknown rate limiter backend: {backend}")
+
+
+limiter = ContextProxy("limiter")
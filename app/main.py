@@ -1,9 +1,12 @@
 from fastapi import FastAPI, APIRouter
+from fastapi.responses import Response
 
-from app.utils import VerifyToken
-from app.mongo import initialize_db
+from app.context import get_context, ContextProxy
+from app.metrics import registry, CONTENT_TYPE
+from app.tracing import trace_exporter
 
-from app.middleware import Auth0ScopedMiddleware, UnkeyMiddleware
+from app.middleware import Auth0ScopedMiddleware, UnkeyMiddleware, TracingMiddleware
+from app.responses import FastJSONResponse
 
 from app.routes.users import user_api_router
 from app.routes.models import models_api_router
@@ -13,19 +16,14 @@ from app.routes.projects.chat import project_chat_api_router
 from app.routes.projects.models import models_api_router as project_models_api_router
 from app.config import get_settings
 
-projects_app = FastAPI(root_path="/projects/v1", docs_url="/docs", redoc_url="/redoc")
-projects_app.add_middleware(
-    UnkeyMiddleware,
-    unkey_api_id=get_settings().unkey_api_id,
-    unkey_api_key=get_settings().unkey_api_key
-)
+unkey_verifier = ContextProxy("unkey_verifier")
+
+projects_app = FastAPI(root_path="/projects/v1", docs_url="/docs", redoc_url="/redoc", default_response_class=FastJSONResponse)
+projects_app.add_middleware(UnkeyMiddleware, verifier=unkey_verifier)
 projects_app.include_router(project_chat_api_router)
 projects_app.include_router(project_models_api_router)
 
-auth = VerifyToken() #
-
-
-core_app = FastAPI(root_path="/v1", docs_url="/docs", redoc_url="/redoc")
+core_app = FastAPI(root_path="/v1", docs_url="/docs", redoc_url="/redoc", default_response_class=FastJSONResponse)
 core_app.add_middleware(
     Auth0ScopedMiddleware,
     required_scopes=["key_type:core"]
@@ -43,6 +41,16 @@ def hello_world():
 
 
 app = FastAPI()
+app.add_middleware(TracingMiddleware, exporter=trace_exporter)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    # checked per request so the settings aren't read at import
+    if not get_settings().metrics_enabled:
+        return Response(status_code=404)
+    return Response(content=registry.render(), media_type=CONTENT_TYPE)
+
 
 @app.on_event("startup")
 async def startup_event():
@@ -50,12 +58,12 @@ async def startup_event():
     app.mount(path="/v1", app=core_app)
     app.mount(path="/projects/v1", app=projects_app)
     # You can add any other startup logic here, such as initializing the database
-    print("Initializing database...")
-    initialize_db()
+    await get_context().start()
     print("Application startup complete.")
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
     # You can add any other shutdown logic here
+    await get_context().close()
     print("Application shutdown complete.")
\ No newline at end of file
@@ -0,0 +1,152 @@
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from app.tracing import record_span
+
+# Prometheus text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# seconds, from sub-millisecond cache hits up to long streams
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...]):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values: dict[tuple[str, ...], object] = {}
+
+    def _key(self, labels: dict[str, object]) -> tuple[str, ...]:
+        return tuple("" if labels.get(name) is None else str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: tuple[str, ...], extra: Optional[tuple[str, str]] = None) -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+        if extra is not None:
+            pairs.append(f'{extra[0]}="{extra[1]}"')
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def samples(self) -> Iterator[str]:
+        for key, value in self.values.items():
+            yield f"{self.name}{self._labels(key)} {_format_value(value)}"
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...], buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self.values.get(key)
+        if series is None:
+            # observations per bucket (the last one is +Inf), and their sum
+            series = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self) -> Iterator[str]:
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{self._labels(key, ('le', _format_value(bound)))} {cumulative}"
+            yield f"{self.name}_sum{self._labels(key)} {_format_value(total)}"
+            yield f"{self.name}_count{self._labels(key)} {cumulative}"
+
+
+class MetricsRegistry:
+    """The metrics of this process, rendered for Prometheus by `render`."""
+
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+registry = MetricsRegistry()
+
+stage_seconds: Histogram = registry.register(Histogram(
+    "gateway_stage_duration_seconds",
+    "Time spent in each stage of handling a chat request",
+    ("stage", "router", "provider", "model"),
+))
+streams_in_flight: Gauge = registry.register(Gauge(
+    "gateway_streams_in_flight",
+    "Chat completion streams currently being sent",
+    ("router", "provider", "model"),
+))
+upstream_errors: Counter = registry.register(Counter(
+    "gateway_upstream_errors_total",
+    "Failed upstream provider calls, every attempt counted, by HTTP status or failure kind",
+    ("router", "provider", "model", "error"),
+))
+
+
+@contextmanager
+def stage(name: str, router: str, provider: Optional[str] = None, model: Optional[str] = None):
+    """
+    Time a stage of the chat pipeline: the duration is observed in `stage_seconds` and added
+    as a span to the request's trace.
+
+    Args:
+        name (str): The stage, e.g. "bucket_lookup" or "upstream_ttfb".
+        router (str): "core" or "projects".
+        provider (Optional[str]): The model's provider, once it's known.
+        model (Optional[str]): The model id, once it's known.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        stage_seconds.observe(duration, stage=name, router=router, provider=provider, model=model)
+        record_span(name, started, duration, {"router": router, "provider": provider, "model": model})
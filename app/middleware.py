@@ -1,36 +1,49 @@
 from typing import Optional
 from fastapi import Request, HTTPException
-from fastapi.responses import JSONResponse
+from app.responses import FastJSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials, SecurityScopes
-from starlette.middleware.base import BaseHTTPMiddleware
-from app.utils import VerifyToken, check_scope, UnauthorizedException, UnauthenticatedException
+from starlette.types import ASGIApp, Receive, Scope, Send
+from app.utils import get_token_verifier, UnkeyKeyVerifier, check_scope, UnauthorizedException, UnauthenticatedException
+from app.metrics import stage
+from app.tracing import current_trace, Trace, TraceExporter
 from typing import Any, Optional
-import unkey
 
-class Auth0ScopedMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app, required_scopes: list[str]):
-        super().__init__(app)
+# The middlewares are plain ASGI apps rather than BaseHTTPMiddleware subclasses: they only look
+# at the request before handing it on, so the response (including every SSE chunk of a stream)
+# goes straight to the server without being copied through an extra memory stream and task.
+
+class Auth0ScopedMiddleware:
+    def __init__(self, app: ASGIApp, required_scopes: list[str]):
+        self.app = app
         self.required_scopes = required_scopes
-        self.auth = VerifyToken()
         self.bearer = HTTPBearer()
 
-    async def dispatch(self, request: Request, call_next):
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request = Request(scope)
         try:
             # Extract and verify the token
             credentials: HTTPAuthorizationCredentials = await self.bearer(request)
-            payload = await self.auth.verify(SecurityScopes(scopes=self.required_scopes), credentials)
+            with stage("jwt_verification", router="core"):
+                payload = await get_token_verifier().verify(SecurityScopes(scopes=self.required_scopes), credentials)
             check_scope(payload, self.required_scopes)
         except (UnauthorizedException, UnauthenticatedException, HTTPException) as e:
             # Return appropriate error response for authentication/authorization failures
-            return JSONResponse(status_code=e.status_code, content={"detail": e.detail})
+            response = FastJSONResponse(status_code=e.status_code, content={"detail": e.detail})
+            await response(scope, receive, send)
+            return
         except Exception as e:
             # Log unexpected errors and return a generic error response
             # Consider logging the error here
-            return JSONResponse(status_code=500, content={"detail": "Internal Server Error"})
+            response = FastJSONResponse(status_code=500, content={"detail": "Internal Server Error"})
+            await response(scope, receive, send)
+            return
 
         # Proceed with the request if authentication and authorization succeed
-        response = await call_next(request)
-        return response
+        await self.app(scope, receive, send)
 
 
 def key_extractor(*args: Any, **kwargs: Any) -> Optional[str]:
@@ -38,34 +51,68 @@ def key_extractor(*args: Any, **kwargs: Any) -> Optional[str]:
         return auth.split(" ")[-1]
     return None
 
-class UnkeyMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app, unkey_api_id: str, unkey_api_key: str):
-        super().__init__(app)
-        self.unkey_api_id = unkey_api_id
-        self.unkey_client = unkey.Client(unkey_api_key)
+class UnkeyMiddleware:
+    def __init__(self, app: ASGIApp, verifier: UnkeyKeyVerifier):
+        self.app = app
+        self.verifier = verifier
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
 
-    async def dispatch(self, request: Request, call_next):
+        request = Request(scope)
         authorization: str = request.headers.get("authorization")
         key = key_extractor(authorization=authorization)
         if not key:
-            return JSONResponse(status_code=401, content={"detail": "Unauthorized"})
+            response = FastJSONResponse(status_code=401, content={"detail": "Unauthorized"})
+            await response(scope, receive, send)
+            return
 
         try:
-            await self.unkey_client.start()
-            unkey_verification = await self.unkey_client.keys.verify_key(key=key, api_id=self.unkey_api_id)
-            await self.unkey_client.close()
-            if not unkey_verification.is_ok:
-                return JSONResponse(status_code=500, content={"detail": "Internal Server Error"})
-            unkey_verification = unkey_verification.unwrap()
-            if not unkey_verification.valid:
-                return JSONResponse(status_code=401, content={"detail": "Unauthorized"})
+            with stage("unkey_verification", router="projects"):
+                unkey_verification = await self.verifier.verify(key)
+            if not unkey_verification:
+                response = FastJSONResponse(status_code=401, content={"detail": "Unauthorized"})
+                await response(scope, receive, send)
+                return
         except Exception as e:
             print(e)
-            return JSONResponse(status_code=500, content={"detail": "Internal Server Error"})
+            response = FastJSONResponse(status_code=500, content={"detail": "Internal Server Error"})
+            await response(scope, receive, send)
+            return
 
-        # Attach unkey_verification to request state for access in routes
+        # Attach unkey_verification to request state for access in routes, request.state
+        # is backed by scope["state"] so it is visible to every Request built from this scope
         request.state.unkey_verification = unkey_verification
         request.state.owner_id = unkey_verification.owner_id
 
-        response = await call_next(request)
-        return response
+        await self.app(scope, receive, send)
+
+
+class TracingMiddleware:
+    """Traces every HTTP request when the exporter is enabled, the trace id is returned in X-Trace-Id."""
+
+    def __init__(self, app: ASGIApp, exporter: TraceExporter):
+        self.app = app
+        self.exporter = exporter
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or not self.exporter.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace(f"{scope['method']} {scope['path']}")
+        token = current_trace.set(trace)
+
+        async def send_with_trace_id(message):
+            if message["type"] == "http.response.start":
+                trace.attributes["status"] = message["status"]
+                message["headers"] = [*message.get("headers", []), (b"x-trace-id", trace.trace_id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        finally:
+            current_trace.reset(token)
+            self.exporter.export(trace)
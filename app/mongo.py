@@ -1,12 +1,19 @@
 import datetime
 from typing import Literal, TypedDict, Optional
 
-from pymongo import MongoClient
-from app.config import get_settings
+from pymongo import ReturnDocument, IndexModel
+from pymongo.errors import OperationFailure
+from app.context import ContextProxy
+from app.rollups import UsageRollups, AsyncUsageRollups
 from bson import ObjectId
 
-client = MongoClient(get_settings().mongo_uri)
-db = client.get_database('bongodb').get_collection('bongodb')
+# the clients and database handles live in the application context, created on first use
+client = ContextProxy("mongo_client")
+db = ContextProxy("db")
+
+# async handle on the same database, used on the request hot path so Mongo round trips don't block the event loop
+async_client = ContextProxy("async_mongo_client")
+async_db = ContextProxy("async_db")
 
 AiProvider = Literal["OpenAI", "AzureOpenAI" "Anthropic", "Google"]
 
@@ -15,6 +22,8 @@ class AiModel(TypedDict):
     _id: str
     provider_id: str
     provider: AiProvider
+    # model to fail over to while this one's circuit breaker is open
+    fallback_model_id: Optional[str]
     createdAt: Optional[datetime.datetime]
     updatedAt: Optional[datetime.datetime]
 
@@ -22,12 +31,28 @@ class RequestUsageLog(TypedDict):
     _id: str
     ai_model_id: str
     applicable_token_bucket_id: str
+    user_name: str
     tokens_input: int
     tokens_output: int
     request_completed: bool
+    # set when the response was served from the completion cache, with the log of the request it was cached from
+    cache_hit: Optional[bool]
+    cached_from_log_id: Optional[str]
+    # set when the request shared the upstream call of an identical request in flight
+    coalesced: Optional[bool]
+    coalesced_with_log_id: Optional[str]
+    # set when the request was failed over to the requested model's fallback
+    served_by_model_id: Optional[str]
+    # set when the request ended before its response was complete, e.g. "client_disconnected"
+    cancel_reason: Optional[str]
     createdAt: Optional[datetime.datetime]
     updatedAt: Optional[datetime.datetime]
 
+
+def is_final_update(update_fields: dict) -> bool:
+    """Whether an update closes a usage log, completed or cancelled. Closed logs are folded into the usage rollups."""
+    return bool(update_fields.get("request_completed") or update_fields.get("cancel_reason"))
+
 class TokenBucket(TypedDict):
     _id: str
     applicable_ai_model_ids: list[str]
@@ -46,7 +71,126 @@ class User(TypedDict):
     updatedAt: Optional[datetime.datetime]
 
 
-def initialize_db():
+class IndexSpec(TypedDict):
+    collection: str
+    name: str
+    keys: list[tuple[str, int]]
+    options: dict
+
+
+# Every index the application relies on. Compound key order follows the equality fields of the
+# hot-path filters first, then the range/sort field.
+REQUIRED_INDEXES: list[IndexSpec] = [
+    {"collection": "token_buckets", "name": "user_type_models",
+     "keys": [("applicable_user_name", 1), ("type", 1), ("applicable_ai_model_ids", 1)], "options": {}},
+    {"collection": "request_usage_logs", "name": "bucket_created",
+     "keys": [("applicable_token_bucket_id", 1), ("createdAt", 1)], "options": {}},
+    # audit listings page through usage logs by creation time, optionally for one user
+    {"collection": "request_usage_logs", "name": "created_id",
+     "keys": [("createdAt", 1), ("_id", 1)], "options": {}},
+    {"collection": "request_usage_logs", "name": "user_created_id",
+     "keys": [("user_name", 1), ("createdAt", 1), ("_id", 1)], "options": {}},
+    {"collection": "users", "name": "username",
+     "keys": [("username", 1)], "options": {}},
+    {"collection": "ai_models", "name": "provider_id",
+     "keys": [("provider_id", 1)], "options": {}},
+    # token bucket window counters are only read for two windows, expire them afterwards
+    {"collection": "token_bucket_counters", "name": "expires_at_ttl",
+     "keys": [("expiresAt", 1)], "options": {"expireAfterSeconds": 0}},
+    {"collection": "usage_rollups_minute", "name": "period_user_model",
+     "keys": [("period", 1), ("user_name", 1), ("ai_model_id", 1)], "options": {}},
+    # minute totals are only useful for recent ranges, hour totals are kept
+    {"collection": "usage_rollups_minute", "name": "expires_at_ttl",
+     "keys": [("expiresAt", 1)], "options": {"expireAfterSeconds": 0}},
+    {"collection": "usage_rollups_hour", "name": "period_user_model",
+     "keys": [("period", 1), ("user_name", 1), ("ai_model_id", 1)], "options": {}},
+    {"collection": "completion_cache", "name": "expires_at_ttl",
+     "keys": [("expiresAt", 1)], "options": {"expireAfterSeconds": 0}},
+]
+
+# Filters the request hot path runs, used to check that each one is answered from an index.
+HOT_PATH_QUERIES: list[tuple[str, dict]] = [
+    ("token_buckets", {"applicable_user_name": "", "applicable_ai_model_ids": "", "type": "ui-access"}),
+    ("token_buckets", {"applicable_user_name": "", "type": "ui-access"}),
+    ("request_usage_logs", {"applicable_token_bucket_id": ObjectId(), "createdAt": {"$gte": datetime.datetime.utcnow()}}),
+    ("users", {"username": ""}),
+    ("ai_models", {"provider_id": ""}),
+]
+
+
+def _key_pattern(keys) -> tuple:
+    # the server may report directions as floats, text and geo indexes use strings
+    return tuple((field, direction if isinstance(direction, str) else int(direction)) for field, direction in keys)
+
+
+def ensure_indexes(db):
+    """
+    Create any missing indexes from REQUIRED_INDEXES. Existing indexes are left as they are: an index
+    with the same key pattern counts as present whatever its name, since Mongo refuses to create
+    a second one under another name.
+    """
+    collections: dict[str, list[IndexSpec]] = {}
+    for spec in REQUIRED_INDEXES:
+        collections.setdefault(spec["collection"], []).append(spec)
+    for collection_name, specs in collections.items():
+        collection = getattr(db, collection_name)
+        existing = {_key_pattern(index["key"]) for index in collection.index_information().values()}
+        indexes = [
+            IndexModel(spec["keys"], name=spec["name"], **spec["options"])
+            for spec in specs if _key_pattern(spec["keys"]) not in existing
+        ]
+        if indexes:
+            collection.create_indexes(indexes)
+
+
+def verify_indexes(db) -> dict[str, list[dict]]:
+    """
+    Compare the indexes in the database with REQUIRED_INDEXES.
+
+    Returns:
+        dict: "missing" lists required indexes whose key pattern doesn't exist, "unused" lists indexes
+        that haven't served an operation since the server started (per $indexStats).
+    """
+    report = {"missing": [], "unused": []}
+    for collection_name in {spec["collection"] for spec in REQUIRED_INDEXES}:
+        collection = getattr(db, collection_name)
+        existing = {_key_pattern(index["key"]) for index in collection.index_information().values()}
+        for spec in REQUIRED_INDEXES:
+            if spec["collection"] == collection_name and _key_pattern(spec["keys"]) not in existing:
+                report["missing"].append({"collection": collection_name, "name": spec["name"]})
+        try:
+            for stats in collection.aggregate([{"$indexStats": {}}]):
+                if stats["name"] != "_id_" and stats["accesses"]["ops"] == 0:
+                    report["unused"].append({"collection": collection_name, "name": stats["name"], "since": stats["accesses"]["since"]})
+        except OperationFailure:
+            pass  # $indexStats isn't available on every deployment
+    return report
+
+
+def _plan_stages(plan: dict):
+    yield plan.get("stage")
+    for child in plan.get("inputStages", []) + [plan.get("inputStage", {})]:
+        if child:
+            yield from _plan_stages(child)
+
+
+def check_query_plans(db) -> list[dict]:
+    """
+    Explain each HOT_PATH_QUERIES filter and return the ones whose winning plan scans the whole collection.
+    An empty list means every hot-path query is served by an index.
+    """
+    collection_scans = []
+    for collection_name, query in HOT_PATH_QUERIES:
+        explain = getattr(db, collection_name).find(query).explain()
+        winning_plan = explain["queryPlanner"]["winningPlan"]
+        # newer servers wrap the plan in a "queryPlan" for the slot based execution engine
+        stages = set(_plan_stages(winning_plan.get("queryPlan", winning_plan)))
+        if "COLLSCAN" in stages:
+            collection_scans.append({"collection": collection_name, "query": query})
+    return collection_scans
+
+
+def initialize_db(db):
     # Check if collections are empty and populate them with initial data if needed
     if db.ai_models.count_documents({}) == 0:
         db.ai_models.insert_many([
@@ -54,17 +198,26 @@ def initialize_db():
             {"provider_id": "claude-3-5-sonnet-20240620", "provider": "Anthropic", "createdAt": datetime.datetime.utcnow(), "updatedAt": datetime.datetime.utcnow()}
         ])
         print("Initialized models collection with default data.")
+    ensure_indexes(db)
+    missing_indexes = verify_indexes(db)["missing"]
+    if missing_indexes:
+        print(f"Missing indexes after initialization: {missing_indexes}")
 
 class DatabaseManager:
     # interacts with the database, provides an interface conforming to the TypedDicts above
     def __init__(self, client, db):
+        self.client = client
         self.db = db
-        sinfo = client.server_info()
+        self.rollups = UsageRollups(db)
+
+    def check_connection(self) -> bool:
+        sinfo = self.client.server_info()
         if not sinfo:
             print("Failed to connect to the database")
-            return
+            return False
         print("Connected to the database")
-        
+        return True
+
 
     # user
     def insert_user(self, user: User) -> bool:
@@ -108,22 +261,20 @@ class DatabaseManager:
     def list_ai_models(self) -> list[AiModel]:
         return list(self.db.ai_models.find({}))
     
-    def list_ai_models_for_user(self, user_name: str, access_type: Literal["ui-access", "api-access"] = "ui-access") -> list[AiModel]:
-        # Find all token buckets associated with the user
-        token_buckets = list(self.db.token_buckets.find({"applicable_user_name": user_name, "type": access_type}))
-        # Extract all applicable AI model IDs from the token buckets
+    def list_ai_model_ids_for_user(self, user_name: str, access_type: Literal["ui-access", "api-access"] = "ui-access") -> list[str]:
+        # Find all token buckets associated with the user and extract their applicable AI model IDs
+        token_buckets = self.db.token_buckets.find(
+            {"applicable_user_name": user_name, "type": access_type}, {"applicable_ai_model_ids": 1}
+        )
         model_ids = set()
         for bucket in token_buckets:
             model_ids.update(bucket.get("applicable_ai_model_ids", []))
+        return list(model_ids)
 
-        # Find all AI models associated with the model IDs
-        models = []
-        for id in model_ids:
-            model = self.get_ai_model_by_provider_id(id)
-            if model:
-                models.append(model)
-        
-        return models
+    def list_ai_models_for_user(self, user_name: str, access_type: Literal["ui-access", "api-access"] = "ui-access") -> list[AiModel]:
+        # Find all AI models associated with the model IDs in one query
+        model_ids = self.list_ai_model_ids_for_user(user_name, access_type)
+        return list(self.db.ai_models.find({"provider_id": {"$in": model_ids}}))
     
     def get_ai_model_by_provider_id(self, ai_model_id: str) -> AiModel:
         return self.db.ai_models.find_one({"provider_id": ai_model_id})
@@ -139,8 +290,13 @@ class DatabaseManager:
     
     def update_request_usage_log(self, log_id: str, update_fields: dict) -> bool:
         update_fields["updatedAt"] = datetime.datetime.utcnow()
-        result = self.db.request_usage_logs.update_one({"_id": log_id}, {"$set": update_fields})
-        return result.modified_count > 0
+        log = self.db.request_usage_logs.find_one_and_update(
+            {"_id": log_id}, {"$set": update_fields}, return_document=ReturnDocument.AFTER
+        )
+        if log and is_final_update(update_fields):
+            # closed logs are final, fold them into the usage rollups
+            self.rollups.record(log)
+        return log is not None
     
     def list_request_usage_logs(self) -> list[RequestUsageLog]:
         return list(self.db.request_usage_logs.find({}))
@@ -186,5 +342,162 @@ class DatabaseManager:
 
     
 
-db_manager = DatabaseManager(client=client, db=db)
+db_manager = ContextProxy("db_manager")
+
+
+class AsyncDatabaseManager:
+    # async twin of DatabaseManager for use from async routes, same interface with awaitable methods
+    def __init__(self, client, db):
+        self.client = client
+        self.db = db
+        self.rollups = AsyncUsageRollups(db)
+
+    # user
+    async def insert_user(self, user: User) -> bool:
+        user["createdAt"] = datetime.datetime.utcnow()
+        user["updatedAt"] = datetime.datetime.utcnow()
+        db_user = await self.db.users.insert_one(user)
+        if not db_user:
+            print("Failed to insert user")
+            return False
+        bucket = {
+            "applicable_ai_model_ids": ["gpt-4o-mini"],
+            "applicable_user_name": user.get("username"),
+            "window_duration_mins": 60,
+            "max_tokens_within_window": 100000,
+            "type": "ui-access",
+            "createdAt": datetime.datetime.utcnow(),
+            "updatedAt": datetime.datetime.utcnow()
+        }
+        bucket_result = await self.db.token_buckets.insert_one(bucket)
+        if not bucket_result:
+            print("Failed to insert token bucket")
+            return False
+        return True
+
+    async def list_users(self) -> list[User]:
+        return await self.db.users.find({}).to_list(None)
+
+    async def get_user(self, user_name: str) -> User:
+        return await self.db.users.find_one({"username": user_name})
+
+    async def delete_user(self, user_name: str) -> bool:
+        return await self.db.users.delete_one({"username": user_name})
+
+
+    # ai_model
+    async def insert_ai_model(self, model: AiModel) -> bool:
+        model["createdAt"] = datetime.datetime.utcnow()
+        model["updatedAt"] = datetime.datetime.utcnow()
+        return await self.db.ai_models.insert_one(model)
+
+    async def list_ai_models(self) -> list[AiModel]:
+        return await self.db.ai_models.find({}).to_list(None)
+
+    async def list_ai_model_ids_for_user(self, user_name: str, access_type: Literal["ui-access", "api-access"] = "ui-access") -> list[str]:
+        token_buckets = self.db.token_buckets.find(
+            {"applicable_user_name": user_name, "type": access_type}, {"applicable_ai_model_ids": 1}
+        )
+        model_ids = set()
+        async for bucket in token_buckets:
+            model_ids.update(bucket.get("applicable_ai_model_ids", []))
+        return list(model_ids)
+
+    async def list_ai_models_for_user(self, user_name: str, access_type: Literal["ui-access", "api-access"] = "ui-access") -> list[AiModel]:
+        model_ids = await self.list_ai_model_ids_for_user(user_name, access_type)
+        return await self.db.ai_models.find({"provider_id": {"$in": model_ids}}).to_list(None)
+
+    async def get_ai_model_by_provider_id(self, ai_model_id: str) -> AiModel:
+        return await self.db.ai_models.find_one({"provider_id": ai_model_id})
+
+    async def delete_ai_model(self, ai_model_id: str) -> bool:
+        return await self.db.ai_models.delete_one({"provider_id": ai_model_id})
+
+    # request_usage_log
+    async def insert_request_usage_log(self, log: RequestUsageLog):
+        log["createdAt"] = datetime.datetime.utcnow()
+        log["updatedAt"] = datetime.datetime.utcnow()
+        return await self.db.request_usage_logs.insert_one(log)
+
+    async def update_request_usage_log(self, log_id: str, update_fields: dict) -> bool:
+        update_fields["updatedAt"] = datetime.datetime.utcnow()
+        log = await self.db.request_usage_logs.find_one_and_update(
+            {"_id": log_id}, {"$set": update_fields}, return_document=ReturnDocument.AFTER
+        )
+        if log and is_final_update(update_fields):
+            await self.rollups.record(log)
+        return log is not None
+
+    async def list_request_usage_logs(self) -> list[RequestUsageLog]:
+        return await self.db.request_usage_logs.find({}).to_list(None)
+
+    async def get_request_usage_log(self, log_id: str) -> RequestUsageLog:
+        return await self.db.request_usage_logs.find_one({"_id": log_id})
+
+
+    # token_bucket
+    async def insert_token_bucket(self, token_bucket: TokenBucket):
+        token_bucket["createdAt"] = datetime.datetime.utcnow()
+        token_bucket["updatedAt"] = datetime.datetime.utcnow()
+        return await self.db.token_buckets.insert_one(token_bucket)
+
+    async def update_token_bucket(self, token_bucket_id: str, token_bucket: TokenBucket):
+        token_bucket["updatedAt"] = datetime.datetime.utcnow()
+        if isinstance(token_bucket_id, str):
+            token_bucket_id = ObjectId(token_bucket_id)
+        return await self.db.token_buckets.update_one({"_id": token_bucket_id}, {"$set": token_bucket})
+
+    async def list_token_buckets(self) -> list[TokenBucket]:
+        return await self.db.token_buckets.find({}).to_list(None)
+
+    async def list_token_buckets_for_user(self, user_name: str) -> list[TokenBucket]:
+        return await self.db.token_buckets.find({"applicable_user_name": user_name}).to_list(None)
+
+    async def get_token_bucket_for_user_and_model(self, user_name: str, model_id: str, type: Literal["api-access", "ui-access"]) -> TokenBucket:
+        """
+        Retrieve the token bucket for a specific user and AI model.
+
+        Args:
+            user_name (str): The username of the user.
+            model_id (str): The ID of the AI model.
+
+        Returns:
+            TokenBucket: The token bucket associated with the user and model, or None if not found.
+        """
+        return await self.db.token_buckets.find_one({
+            "applicable_user_name": user_name,
+            "applicable_ai_model_ids": model_id,
+            "type": type
+        })
+
+    async def get_token_bucket_and_user(self, user_name: str, model_id: str, type: Literal["api-access", "ui-access"]) -> tuple[Optional[TokenBucket], Optional[User]]:
+        """
+        Retrieve the token bucket for a specific user and AI model together with the user, in one round trip.
+
+        Returns:
+            tuple: The token bucket, or None if not found, and the user it applies to, or None if there is no such user.
+        """
+        pipeline = [
+            {"$match": {
+                "applicable_user_name": user_name,
+                "applicable_ai_model_ids": model_id,
+                "type": type
+            }},
+            {"$limit": 1},
+            {"$lookup": {
+                "from": self.db.users.name,
+                "localField": "applicable_user_name",
+                "foreignField": "username",
+                "as": "users"
+            }},
+        ]
+        async for token_bucket in self.db.token_buckets.aggregate(pipeline):
+            users = token_bucket.pop("users")
+            return token_bucket, (users[0] if users else None)
+        return None, None
+
+    async def get_token_bucket(self, token_bucket_id: str) -> TokenBucket:
+        return await self.db.token_buckets.find_one({"_id": token_bucket_id})
+
 
+async_db_manager = ContextProxy("async_db_manager")
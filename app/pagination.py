@@ -0,0 +1,121 @@
+import base64
+import datetime
+from typing import Any, Iterator, Literal, Optional
+
+from bson import ObjectId, json_util
+from bson.errors import InvalidId
+from fastapi import HTTPException
+from pymongo import ASCENDING, DESCENDING
+
+from app.responses import dumps
+
+SortOrder = Literal["asc", "desc"]
+
+MAX_PAGE_SIZE = 1000
+# documents serialized per chunk of an NDJSON export
+EXPORT_BATCH_SIZE = 1000
+
+
+def encode_cursor(document: dict, sort_field: str) -> str:
+    # the sort value and _id of the last document, json_util keeps ObjectIds and datetimes intact
+    position = [document.get(sort_field), document["_id"]]
+    return base64.urlsafe_b64encode(json_util.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor: str, sort_field: str) -> tuple[Any, ObjectId]:
+    """
+    Raises:
+        HTTPException: 400 if the cursor wasn't made by `encode_cursor` for `sort_field`. Its values go
+        straight into the query, so anything else, e.g. an operator document, is rejected.
+    """
+    try:
+        value, last_id = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError, InvalidId):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    # _id sorts carry the _id as the sort value too, the only other sort field is a datetime
+    value_type = ObjectId if sort_field == "_id" else datetime.datetime
+    if not isinstance(last_id, ObjectId) or not isinstance(value, value_type):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return value, last_id
+
+
+def keyset_filter(filter: dict, sort_field: str, order: SortOrder, cursor: Optional[str]) -> dict:
+    """
+    Narrow `filter` to the documents after `cursor` in (sort_field, _id) order.
+
+    Args:
+        filter (dict): The query filter.
+        sort_field (str): The field the results are sorted by, ties are broken by _id.
+        order (SortOrder): The sort direction.
+        cursor (Optional[str]): A cursor returned with the previous page, or None for the first page.
+
+    Returns:
+        dict: The filter for the next page.
+    """
+    if not cursor:
+        return filter
+    value, last_id = decode_cursor(cursor, sort_field)
+    after = "$gt" if order == "asc" else "$lt"
+    if sort_field == "_id":
+        position = {"_id": {after: last_id}}
+    else:
+        position = {"$or": [
+            {sort_field: {after: value}},
+            {sort_field: value, "_id": {after: last_id}},
+        ]}
+    return {"$and": [filter, position]} if filter else position
+
+
+def _sort(sort_field: str, order: SortOrder) -> list[tuple[str, int]]:
+    direction = ASCENDING if order == "asc" else DESCENDING
+    if sort_field == "_id":
+        return [("_id", direction)]
+    return [(sort_field, direction), ("_id", direction)]
+
+
+def paginate(collection, filter: dict, limit: int, cursor: Optional[str] = None, sort_field: str = "_id", order: SortOrder = "asc") -> tuple[list[dict], Optional[str]]:
+    """
+    Fetch one page of documents with keyset pagination, which costs the same on every page
+    unlike skip/offset.
+
+    Args:
+        collection: The pymongo collection to read from.
+        filter (dict): The query filter.
+        limit (int): The page size.
+        cursor (Optional[str]): A cursor returned with the previous page, or None for the first page.
+        sort_field (str): The field to sort by, ties are broken by _id.
+        order (SortOrder): The sort direction.
+
+    Returns:
+        tuple[list[dict], Optional[str]]: The page, and the cursor for the next page or None if this is the last one.
+    """
+    query = keyset_filter(filter, sort_field, order, cursor)
+    # one extra document tells us whether there is a next page
+    documents = list(collection.find(query).sort(_sort(sort_field, order)).limit(limit + 1))
+    next_cursor = None
+    if len(documents) > limit:
+        documents = documents[:limit]
+        next_cursor = encode_cursor(documents[-1], sort_field)
+    return documents, next_cursor
+
+
+def export_ndjson(collection, filter: dict, cursor: Optional[str] = None, sort_field: str = "_id", order: SortOrder = "asc") -> Iterator[bytes]:
+    """
+    Stream every matching document as newline-delimited JSON, straight from the Mongo cursor.
+
+    Only one cursor batch is held in memory at a time, so memory use doesn't grow with the
+    size of the collection. Lines are grouped into chunks to keep per-chunk overhead low.
+    """
+    query = keyset_filter(filter, sort_field, order, cursor)
+    documents = collection.find(query).sort(_sort(sort_field, order)).batch_size(EXPORT_BATCH_SIZE)
+    try:
+        lines = []
+        for document in documents:
+            lines.append(dumps(document))
+            if len(lines) >= EXPORT_BATCH_SIZE:
+                yield b"\n".join(lines) + b"\n"
+                lines = []
+        if lines:
+            yield b"\n".join(lines) + b"\n"
+    finally:
+        documents.close()
@@ -0,0 +1,67 @@
+from typing import Literal, Optional
+
+import tiktoken
+from fastapi import HTTPException, Request
+from fastapi.responses import Response
+
+from app.admission import admit_chat_request, admit_cache_hit, admit_coalesced_request
+from app.coalescing import completion_flights
+from app.completion_cache import completion_cache
+from app.providers import chat_completion
+
+
+async def close_response(response: Response):
+    """Close a response that won't be sent, so a stream it holds is let go of."""
+    aclose = getattr(getattr(response, "body_iterator", None), "aclose", None)
+    if aclose is not None:
+        await aclose()
+
+
+async def serve_chat_request(request: Request, body: dict, user_name: Optional[str], access_type: Literal["api-access", "ui-access"]) -> Response:
+    """
+    Answer a chat completion request, shared by the core and projects routers: from the completion
+    cache, by joining an identical request in flight, or by admitting it and calling the model's provider.
+
+    Raises:
+        HTTPException: 400 if the model, messages or user are missing, and the admission and upstream errors.
+    """
+    model_id = body.get("model")
+    chat_history = body.get("messages")
+    stream = body.get("stream", False)  # Default to streaming if not specified
+
+    if not model_id or not chat_history or not user_name:
+        raise HTTPException(status_code=400, detail="Model ID, input text, and username are required")
+
+    cache_key = completion_cache.key_for(request, user_name, access_type, body)
+    if cache_key:
+        cached = await completion_cache.get(request, cache_key)
+        if cached:
+            await admit_cache_hit(user_name, model_id, access_type, cached["log_id"])
+            return completion_cache.response(cached)
+
+    async def complete():
+        # Admit the request, charging its estimated input tokens
+        encoding = tiktoken.get_encoding("cl100k_base")
+        context = await admit_chat_request(user_name, model_id, access_type, chat_history, encoding)
+
+        # Call the appropriate model API
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+        response = await chat_completion(context, chat_history, stream, encoding=encoding, include_usage=include_usage)
+        if cache_key:
+            response = await completion_cache.capture(cache_key, response, context.log_id)
+        return response, context.log_id
+
+    flight_key = completion_flights.key_for(request, user_name, access_type, body)
+    if not flight_key:
+        response, _ = await complete()
+        return response
+    # identical requests already in flight share its upstream call
+    response, log_id, leader = await completion_flights.join(flight_key, complete)
+    if not leader:
+        try:
+            await admit_coalesced_request(user_name, model_id, access_type, log_id)
+        except BaseException:
+            # the response is already subscribed to the shared stream, leave it or the stream is kept alive
+            await close_response(response)
+            raise
+    return response
@@ -0,0 +1,437 @@
+from dataclasses import replace
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from app.admission import AdmissionContext
+from app.catalog import model_catalog
+from app.config import get_settings
+from app.responses import ClosingStreamingResponse, FastJSONResponse
+from app.usage_writer import usage_log_writer
+from app.limiter import limiter
+from app.metrics import stage, streams_in_flight, upstream_errors
+from app.resilience import circuit_breakers, error_kind, hedged, is_retryable, to_http_exception, upstream_error_detail, with_idle_timeout, with_retries
+from app.scheduler import upstream_scheduler, OverloadedException, Slot
+from app.sse import SSEParser, OpenAIChunkEncoder, text_delta_literal, decode_literals
+from app.upstream import upstream_clients
+from openai import NOT_GIVEN
+from typing import Any, Awaitable, Callable, Optional
+import asyncio
+import json
+import time
+import uuid
+
+# Provider calls shared by the core and projects chat routers. Each function calls the
+# upstream API for an admitted request and returns the response to send to the client,
+# completing the request usage log once the output is known.
+
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "Transfer-Encoding": "chunked",
+    "Content-Type": "text/event-stream"
+}
+
+# cancel_reason of usage logs closed without completing: the client went away, no response could
+# be obtained from the provider, the provider's stream went idle part way, the request was shed
+# while waiting for an upstream slot, or the model's provider isn't supported
+CLIENT_DISCONNECTED = "client_disconnected"
+UPSTREAM_ERROR = "upstream_error"
+UPSTREAM_TIMEOUT = "upstream_timeout"
+SHED = "shed"
+UNSUPPORTED_PROVIDER = "unsupported_provider"
+
+
+# last event of a stream cut off because the provider went idle, sent instead of [DONE]
+IDLE_TIMEOUT_EVENT = b'data: {"error": {"message": "Upstream provider stopped responding", "type": "upstream_timeout"}}\n\n'
+
+
+def failure_reason(error: BaseException) -> str:
+    """The cancel_reason of a request whose upstream call failed with `error`."""
+    if isinstance(error, asyncio.CancelledError):
+        return CLIENT_DISCONNECTED
+    if isinstance(error, OverloadedException):
+        return SHED
+    return UPSTREAM_ERROR
+
+
+async def complete_usage_log(context: AdmissionContext, input_tokens: Optional[int], output_tokens: int, cancel_reason: Optional[str] = None):
+    """
+    Mark the request usage log as completed with its final token counts, and charge the token bucket
+    for the output tokens plus any difference between the estimated and reported input tokens.
+    With `cancel_reason` the log is closed as not completed instead, with the tokens used so far.
+    """
+    update_fields = {
+        "tokens_output": output_tokens,
+        "request_completed": cancel_reason is None
+    }
+    if cancel_reason is not None:
+        update_fields["cancel_reason"] = cancel_reason
+    if context.fallback_from:
+        update_fields["served_by_model_id"] = context.model_id
+    input_correction = 0
+    if input_tokens is not None:
+        update_fields["tokens_input"] = input_tokens
+        input_correction = input_tokens - context.input_tokens
+    await usage_log_writer.update(context.log_id, update_fields)
+    await limiter.record(context.token_bucket, output_tokens + input_correction)
+
+
+async def chat_completion(context: AdmissionContext, chat_history: list, stream: bool, encoding, include_usage: bool = False):
+    """
+    Call the admitted model's provider and return the response for the client. The upstream
+    slot taken by `call_upstream` is held until the response, or the whole stream, is done.
+    If no response could be obtained the input tokens are given back to the bucket, and the usage
+    log is closed as cancelled with the reason.
+    """
+    if context.provider not in PROVIDER_REQUESTS:
+        await complete_usage_log(context, 0, 0, cancel_reason=UNSUPPORTED_PROVIDER)
+        raise HTTPException(status_code=400, detail="Unsupported model provider")
+
+    try:
+        context, upstream_response, slot = await call_upstream(context, chat_history, stream)
+    except BaseException as error:
+        # shielded, the request's task may be the one being cancelled
+        await asyncio.shield(complete_usage_log(context, 0, 0, cancel_reason=failure_reason(error)))
+        raise
+    try:
+        if context.provider == "OpenAI":
+            response = await openai_chat_completion(context, upstream_response, stream, encoding=encoding, include_usage=include_usage)
+        else:
+            response = await anthropic_chat_completion(context, upstream_response, stream, encoding=encoding)
+    except BaseException:
+        slot.release()
+        raise
+    if isinstance(response, StreamingResponse):
+        response.body_iterator = slot.hold(measure_stream(response.body_iterator, context))
+    else:
+        slot.release()
+    return response
+
+
+async def measure_stream(iterator, context: AdmissionContext):
+    """Pass a response stream through, counted as in flight and timed as the streaming stage while it's sent."""
+    labels = {"router": context.router, "provider": context.provider, "model": context.model_id}
+    streams_in_flight.inc(**labels)
+    try:
+        with stage("streaming", **labels):
+            async for chunk in iterator:
+                yield chunk
+    finally:
+        streams_in_flight.dec(**labels)
+        # pass a client disconnect on to the stream
+        await iterator.aclose()
+
+
+def _fallback_context(context: AdmissionContext) -> Optional[AdmissionContext]:
+    fallback_model_id = context.ai_model.get("fallback_model_id")
+    fallback = model_catalog.get(fallback_model_id) if fallback_model_id else None
+    if not fallback or fallback.get("provider") not in PROVIDER_REQUESTS:
+        return None
+    return replace(context, ai_model=fallback, fallback_from=context.model_id)
+
+
+async def call_upstream(context: AdmissionContext, chat_history: list, stream: bool) -> tuple[AdmissionContext, Any, Slot]:
+    """
+    Get the provider's response for a request: the response object for non-streaming calls,
+    or the open stream once its headers have arrived.
+
+    Each attempt is bounded by a timeout, and retryable failures are retried with backoff
+    before anything has been sent to the client. Slow non-streaming calls can be hedged. When
+    the model's circuit breaker is open, or it keeps failing, the request is failed over to
+    the model's fallback if one is configured.
+
+    Returns:
+        tuple[AdmissionContext, Any, Slot]: The context of the model that answered, the provider's
+        response, and the upstream slot held for it.
+
+    Raises:
+        HTTPException: The error for the client once every option has failed, e.g. 503 with
+        Retry-After, 504 on timeouts, or the provider's own 4xx.
+    """
+    settings = get_settings()
+    candidates = [context]
+    fallback = _fallback_context(context)
+    if fallback is not None:
+        candidates.append(fallback)
+
+    last_error: Optional[BaseException] = None
+    for candidate in candidates:
+        breaker = circuit_breakers.get(candidate.model_id)
+        if not breaker.allow():
+            last_error = HTTPException(status_code=503, detail=f"Model {candidate.model_id} is temporarily unavailable",
+                                       headers={"Retry-After": str(int(settings.circuit_reset_seconds))})
+            continue
+        probe_started_at = breaker.probe_started_at
+
+        request = PROVIDER_REQUESTS[candidate.provider]
+        timeout = settings.upstream_ttfb_timeout_seconds if stream else settings.upstream_response_timeout_seconds
+
+        async def attempt(candidate=candidate, request=request):
+            try:
+                return await asyncio.wait_for(request(candidate, chat_history, stream), timeout)
+            except Exception as error:
+                upstream_errors.inc(router=candidate.router, provider=candidate.provider, model=candidate.model_id, error=error_kind(error))
+                raise
+
+        call = attempt
+        if not stream and settings.upstream_hedge_after_seconds is not None:
+            async def call(attempt=attempt):
+                return await hedged(attempt, settings.upstream_hedge_after_seconds)
+
+        labels = {"router": candidate.router, "provider": candidate.provider, "model": candidate.model_id}
+        try:
+            with stage("upstream_queue", **labels):
+                slot = await upstream_scheduler.acquire(candidate.provider, candidate.model_id, candidate.access_type, candidate.user_name)
+            try:
+                # the time to the response headers for streams, the whole response otherwise, retries included
+                with stage("upstream_ttfb", **labels):
+                    upstream_response = await with_retries(
+                        call,
+                        breaker,
+                        attempts=settings.upstream_max_attempts,
+                        base_delay=settings.upstream_retry_base_delay_seconds,
+                        max_delay=settings.upstream_retry_max_delay_seconds,
+                    )
+            except Exception as error:
+                slot.release()
+                if not is_retryable(error):
+                    raise to_http_exception(error)
+                print(f"Upstream call to {candidate.model_id} failed: {upstream_error_detail(error)}")
+                last_error = error
+                continue
+            except BaseException:
+                slot.release()
+                raise
+        finally:
+            # a half-open probe that ended without a verdict (shed, cancelled, or a non-retryable
+            # error) mustn't hold off the next probe
+            breaker.end_probe(probe_started_at)
+        if candidate is not context:
+            print(f"Failed over from {context.model_id} to {candidate.model_id}")
+        return candidate, upstream_response, slot
+
+    raise to_http_exception(last_error)
+
+
+async def openai_request(context: AdmissionContext, chat_history: list, stream: bool):
+    client = upstream_clients.openai()
+    return await client.chat.completions.create(
+        model=context.model_id,
+        stream=stream,
+        messages=chat_history,
+        max_tokens=context.max_tokens,
+        temperature=0.7,
+        # always ask for usage so the log gets exact counts, it's only forwarded if the client asked for it
+        stream_options={"include_usage": True} if stream else NOT_GIVEN,
+    )
+
+
+async def openai_chat_completion(context: AdmissionContext, response, stream: bool, encoding, include_usage: bool = False):
+    if stream:
+        return ClosingStreamingResponse(stream_openai_response(response, context, encoding=encoding, include_usage=include_usage), media_type="text/event-stream", headers=SSE_HEADERS)
+    else:
+        usage = response.usage
+        if usage:
+            await complete_usage_log(context, usage.prompt_tokens, usage.completion_tokens)
+        else:
+            output_text = "".join(choice.message.content or "" for choice in response.choices)
+            await complete_usage_log(context, None, len(encoding.encode(output_text)))
+        return FastJSONResponse(content=response.to_dict())
+
+
+def get_media_type_from_data_url(data_url):
+    return data_url.split(';')[0].split(':')[1]
+
+def get_base64_from_data_url(data_url):
+    return data_url.split(',')[1]
+
+async def anthropic_request(context: AdmissionContext, chat_history: list, stream: bool):
+    # Format the input messages for the Anthropic API. The caller's list is reused by retries
+    # and by a failover to another provider, so build new messages rather than editing it.
+    anthropic_formatted_messages = chat_history[:1]
+
+    for message in chat_history[1:]:
+        if not isinstance(message.get("content"), list):
+            anthropic_formatted_messages.append(message)
+            continue
+
+        formatted_content = []
+        for content in message["content"]:
+            if content.get("type") == "image_url" and isinstance(content.get("image_url", {}).get("url"), str):
+                image_url = content["image_url"]["url"]
+                formatted_content.append({
+                    "type": "image",
+                    "source": {
+                        "type": "base64",
+                        "media_type": get_media_type_from_data_url(image_url),
+                        "data": get_base64_from_data_url(image_url)
+                    }
+                })
+            else:
+                formatted_content.append(content)
+        anthropic_formatted_messages.append({**message, "content": formatted_content})
+    # Call the Anthropic API
+    client = upstream_clients.get("anthropic")
+    anthropic_api_key = get_settings().anthropic_api_key
+    headers = {
+        "x-api-key": anthropic_api_key,
+        "anthropic-version": "2023-06-01",
+        "content-type": "application/json"
+    }
+    payload = {
+        "model": context.model_id,
+        "max_tokens": context.max_tokens,
+        "messages": anthropic_formatted_messages,
+        "stream": stream,
+    }
+    # send with stream=True so SSE events are forwarded as they arrive instead of after the whole body
+    upstream_request = client.build_request("POST", "/v1/messages", headers=headers, json=payload)
+    response = await client.send(upstream_request, stream=stream)
+    if response.is_error:
+        # read the error body so the provider's message can be passed on
+        await response.aread()
+        await response.aclose()
+    response.raise_for_status()
+    return response
+
+
+async def anthropic_chat_completion(context: AdmissionContext, response, stream: bool, encoding):
+    if stream:
+        return ClosingStreamingResponse(stream_anthropic_response(response, context, encoding=encoding), media_type="text/event-stream", headers=SSE_HEADERS)
+    else:
+        completion = response.json()
+        usage = completion.get("usage") or {}
+        if "output_tokens" in usage:
+            await complete_usage_log(context, usage.get("input_tokens"), usage["output_tokens"])
+        else:
+            output_text = "".join(block.get("text", "") for block in completion.get("content", []))
+            await complete_usage_log(context, None, len(encoding.encode(output_text)))
+        return FastJSONResponse(completion)
+
+
+PROVIDER_REQUESTS = {
+    "OpenAI": openai_request,
+    "Anthropic": anthropic_request,
+}
+
+
+async def cancel_stream(context: AdmissionContext, close_upstream: Callable[[], Awaitable[None]], input_tokens: Optional[int], output_tokens: int):
+    """
+    Stop a stream whose client went away: close the upstream response, which ends the generation
+    on the provider's side, and close the usage log as cancelled with the output produced so far.
+    """
+    print(f"Client disconnected, closing the upstream stream for {context.model_id}")
+    try:
+        await close_upstream()
+    finally:
+        await complete_usage_log(context, input_tokens, output_tokens, cancel_reason=CLIENT_DISCONNECTED)
+
+
+async def stream_openai_response(response, context: AdmissionContext, encoding, include_usage: bool = False):
+    usage = None
+    output_parts = []
+    idle_timeout = get_settings().upstream_stream_idle_timeout_seconds
+    timed_out = False
+
+    try:
+        async for chunk in with_idle_timeout(response, idle_timeout):
+            if chunk.usage:
+                usage = chunk.usage
+            for choice in chunk.choices:
+                if choice.delta.content:
+                    output_parts.append(choice.delta.content)
+            if chunk.choices or include_usage:
+                yield f"data: {chunk.model_dump_json()}\n\n"
+    except asyncio.TimeoutError:
+        print(f"Upstream stream for {context.model_id} was idle for {idle_timeout}s, closing it")
+        timed_out = True
+        await response.close()
+    except (asyncio.CancelledError, GeneratorExit):
+        # shielded, the request's task may still be cancelled while it runs
+        await asyncio.shield(cancel_stream(context, response.close, None, len(encoding.encode("".join(output_parts)))))
+        raise
+
+    # Update log with the provider's token counts and mark as completed, or as cut off
+    cancel_reason = UPSTREAM_TIMEOUT if timed_out else None
+    if usage:
+        await complete_usage_log(context, usage.prompt_tokens, usage.completion_tokens, cancel_reason=cancel_reason)
+    else:
+        # the provider didn't report usage, count the output locally
+        await complete_usage_log(context, None, len(encoding.encode("".join(output_parts))), cancel_reason=cancel_reason)
+    if timed_out:
+        # end the response with an error instead of [DONE] so the client can tell the stream was cut off
+        yield IDLE_TIMEOUT_EVENT
+        return
+    yield "data: [DONE]\n\n"
+
+def generate_random_id():
+    return "chatcmpl-" + str(uuid.uuid4())
+
+def generate_random_system_fingerprint():
+    return "fp_f33667828e"
+
+async def stream_anthropic_response(response, context: AdmissionContext, encoding):
+    reported_input_tokens = None
+    reported_output_tokens = None
+    # text deltas as raw JSON string literals, decoded only when the whole text is needed
+    output_literals: list[bytes] = []
+    block_start = 0
+    parser = SSEParser()
+    encoder = OpenAIChunkEncoder(generate_random_id(), context.model_id, int(time.time()), generate_random_system_fingerprint())
+
+    idle_timeout = get_settings().upstream_stream_idle_timeout_seconds
+    timed_out = False
+
+    # Parse the response stream, convert to the OpenAI format, and yield each chunk
+    try:
+        async for raw in with_idle_timeout(response.aiter_bytes(), idle_timeout):
+            for event, data in parser.feed(raw):
+                if event == b"content_block_delta":
+                    literal = text_delta_literal(data)
+                    if literal is None:
+                        try:
+                            delta = json.loads(data)["delta"]
+                        except (json.JSONDecodeError, KeyError):
+                            print(f"Invalid JSON data received: {data!r}")
+                            continue  # Skip invalid JSON data
+                        if "text" not in delta:
+                            continue  # Skip non-text deltas
+                        literal = json.dumps(delta["text"]).encode()
+                    output_literals.append(literal)
+                    yield encoder.encode(literal)
+                elif event == b"content_block_stop":
+                    # Re-send the accumulated text of the content block with the finish reason
+                    yield encoder.encode_text(decode_literals(output_literals[block_start:]), "stop")
+                    block_start = len(output_literals)  # Reset for the next content block
+                elif event == b"message_start" or event == b"message_delta":
+                    try:
+                        data = json.loads(data)
+                    except json.JSONDecodeError:
+                        print(f"Invalid JSON data received: {data!r}")
+                        continue  # Skip invalid JSON data
+                    if event == b"message_start":
+                        usage = data["message"].get("usage") or {}
+                        reported_input_tokens = usage.get("input_tokens", reported_input_tokens)
+                    else:
+                        # output_tokens in message_delta is the cumulative count for the message
+                        usage = data.get("usage") or {}
+                    reported_output_tokens = usage.get("output_tokens", reported_output_tokens)
+                # Skip other event types (ping, message_stop, content_block_start)
+    except asyncio.TimeoutError:
+        print(f"Upstream stream for {context.model_id} was idle for {idle_timeout}s, closing it")
+        timed_out = True
+    except (asyncio.CancelledError, GeneratorExit):
+        # shielded, the request's task may still be cancelled while it runs
+        await asyncio.shield(cancel_stream(context, response.aclose, reported_input_tokens, len(encoding.encode(decode_literals(output_literals)))))
+        raise
+    await response.aclose()
+
+    # Update log with the provider's token counts and mark as completed
+    if reported_output_tokens is None or timed_out:
+        # the provider didn't report (final) usage, count the output locally
+        reported_output_tokens = len(encoding.encode(decode_literals(output_literals)))
+    await complete_usage_log(context, reported_input_tokens, reported_output_tokens, cancel_reason=UPSTREAM_TIMEOUT if timed_out else None)
+    if timed_out:
+        # end the response with an error instead of [DONE] so the client can tell the stream was cut off
+        yield IDLE_TIMEOUT_EVENT
+        return
+    yield b"data: [DONE]\n\n"
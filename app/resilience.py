@@ -0,0 +1,259 @@
+import asyncio
+import random
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+
+import httpx
+import openai
+from fastapi import HTTPException
+
+from app.context import ContextProxy
+
+# statuses worth trying again: timeouts, conflicts, rate limits, server errors and Anthropic's 529 (overloaded)
+RETRYABLE_STATUS_CODES = {408, 409, 425, 429, 500, 502, 503, 504, 529}
+
+
+def error_status(error: BaseException) -> Optional[int]:
+    """The HTTP status of a failed upstream call, or None if it failed before getting one."""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code
+    return None
+
+
+def is_timeout(error: BaseException) -> bool:
+    return isinstance(error, (asyncio.TimeoutError, httpx.TimeoutException, openai.APITimeoutError))
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether a call that failed this way can be retried, or failed over to another model."""
+    if is_timeout(error) or isinstance(error, (httpx.TransportError, openai.APIConnectionError)):
+        return True
+    return error_status(error) in RETRYABLE_STATUS_CODES
+
+
+def retry_after(error: BaseException) -> Optional[float]:
+    """The upstream Retry-After, in seconds, if the provider sent one."""
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None  # an HTTP date, not worth parsing
+
+
+def backoff_delay(attempt: int, base: float, cap: float, upstream_retry_after: Optional[float] = None) -> float:
+    """Full-jitter exponential backoff, never shorter than the provider asked for (up to `cap`)."""
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    if upstream_retry_after is not None:
+        delay = max(delay, min(upstream_retry_after, cap))
+    return delay
+
+
+def error_kind(error: BaseException) -> str:
+    """A short label for a failed upstream call: its HTTP status, "timeout" or the exception type."""
+    if is_timeout(error):
+        return "timeout"
+    status = error_status(error)
+    return str(status) if status is not None else type(error).__name__
+
+
+def upstream_error_detail(error: BaseException) -> str:
+    if isinstance(error, openai.APIStatusError):
+        return error.message
+    if isinstance(error, httpx.HTTPStatusError):
+        try:
+            return error.response.json()["error"]["message"]
+        except Exception:
+            return error.response.text or str(error)
+    return str(error) or type(error).__name__
+
+
+def to_http_exception(error: BaseException) -> HTTPException:
+    """The response for the client when an upstream call has failed for good."""
+    if isinstance(error, HTTPException):
+        return error
+    if is_timeout(error):
+        return HTTPException(status_code=504, detail="Upstream provider timed out")
+    if is_retryable(error):
+        return HTTPException(
+            status_code=503,
+            detail=f"Upstream provider unavailable: {upstream_error_detail(error)}",
+            headers={"Retry-After": str(int(retry_after(error) or 1))},
+        )
+    status = error_status(error)
+    if status is not None and 400 <= status < 500:
+        # the request itself was rejected, pass the provider's reason on
+        return HTTPException(status_code=status, detail=upstream_error_detail(error))
+    return HTTPException(status_code=502, detail=f"Upstream provider error: {upstream_error_detail(error)}")
+
+
+class CircuitBreaker:
+    """
+    Tracks the health of one model. After `failure_threshold` consecutive retryable failures
+    the circuit opens and calls are refused for `reset_seconds`, then a single probe call is
+    let through: its success closes the circuit again, its failure re-opens it.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probe_started_at: Optional[float] = None
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_seconds:
+            return "open"
+        return "half-open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "open":
+            return False
+        now = time.monotonic()
+        # one probe at a time, a probe that never reported back is replaced after reset_seconds
+        if self.probe_started_at is not None and now - self.probe_started_at < self.reset_seconds:
+            return False
+        self.probe_started_at = now
+        return True
+
+    def end_probe(self, probe_started_at: Optional[float]):
+        """
+        Called once a call let through by `allow` is over, whatever its outcome, with the
+        `probe_started_at` it was let through with. Frees the probe if that call was it.
+        """
+        if probe_started_at is not None and self.probe_started_at == probe_started_at:
+            self.probe_started_at = None
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        self.probe_started_at = None
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+class CircuitBreakers:
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.breakers: dict[str, CircuitBreaker] = {}
+
+    def get(self, model_id: str) -> CircuitBreaker:
+        breaker = self.breakers.get(model_id)
+        if breaker is None:
+            breaker = self.breakers[model_id] = CircuitBreaker(self.failure_threshold, self.reset_seconds)
+        return breaker
+
+
+async def hedged(call: Callable[[], Awaitable[Any]], delay: float) -> Any:
+    """
+    Run `call`, and if it hasn't finished after `delay` seconds start a second identical call.
+    The first to succeed wins and the other is cancelled.
+    """
+    first = asyncio.ensure_future(call())
+    pending = {first}
+    error = None
+    # everything inside the try, so calls still running when the caller is cancelled are cancelled too
+    try:
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+        pending.add(asyncio.ensure_future(call()))
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for call_future in done:
+                if call_future.exception() is None:
+                    return call_future.result()
+                error = call_future.exception()
+        raise error
+    finally:
+        for call_future in pending:
+            call_future.cancel()
+
+
+async def with_retries(call: Callable[[], Awaitable[Any]], breaker: CircuitBreaker, attempts: int, base_delay: float, max_delay: float) -> Any:
+    """
+    Call `call` until it succeeds, retrying retryable failures with jittered backoff. Every
+    attempt is reported to the model's circuit breaker, and retries stop once it opens.
+    """
+    for attempt in range(attempts):
+        try:
+            result = await call()
+        except Exception as error:
+            if not is_retryable(error):
+                raise
+            breaker.record_failure()
+            if attempt + 1 >= attempts or breaker.state == "open":
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay, retry_after(error))
+            print(f"Upstream call failed ({upstream_error_detail(error)}), retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+        else:
+            breaker.record_success()
+            return result
+
+
+async def with_idle_timeout(iterator: AsyncIterator, timeout: float) -> AsyncIterator:
+    """
+    Iterate an upstream stream, raising asyncio.TimeoutError if no item arrives within `timeout` seconds.
+
+    This runs for every streamed chunk, so rather than a wait_for (a new task per chunk) one timer
+    cancels the consuming task if it's still waiting at the deadline. Each item only moves the
+    deadline, the timer is re-armed when it fires early.
+    """
+    loop = asyncio.get_running_loop()
+    task = asyncio.current_task()
+    iterator = iterator.__aiter__()
+    deadline = 0.0
+    waiting = False
+    timed_out = False
+    timer: Optional[asyncio.TimerHandle] = None
+
+    def expire():
+        nonlocal timer, timed_out
+        timer = None
+        if not waiting:
+            return  # re-armed when the next wait starts
+        if loop.time() < deadline:
+            timer = loop.call_at(deadline, expire)
+            return
+        timed_out = True
+        task.cancel()
+
+    try:
+        while True:
+            deadline = loop.time() + timeout
+            waiting = True
+            if timer is None:
+                timer = loop.call_at(deadline, expire)
+            try:
+                item = await iterator.__anext__()
+            except StopAsyncIteration:
+                return
+            except asyncio.CancelledError:
+                if not timed_out:
+                    raise
+                if hasattr(task, "uncancel"):
+                    task.uncancel()
+                raise asyncio.TimeoutError() from None
+            finally:
+                waiting = False
+            yield item
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+
+circuit_breakers = ContextProxy("circuit_breakers")
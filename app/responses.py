@@ -0,0 +1,44 @@
+from typing import Any
+
+import orjson
+from bson import ObjectId
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+
+def _default(obj: Any) -> Any:
+    # orjson handles datetimes itself, only types it doesn't know end up here
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    """
+    Serialize `content` to JSON with orjson. Mongo documents can be passed as they are:
+    ObjectIds are written as strings and datetimes as ISO 8601 strings.
+    """
+    return orjson.dumps(content, default=_default)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse rendered with orjson, content is serialized exactly once."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+class ClosingStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that closes its body iterator once the response ends, including when the
+    client disconnects part way. Starlette only stops iterating, which leaves the stream suspended
+    until it's garbage collected; closing it lets the stream stop its upstream call right away.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            aclose = getattr(self.body_iterator, "aclose", None)
+            if aclose is not None:
+                await aclose()
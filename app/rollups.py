@@ -0,0 +1,127 @@
+import datetime
+from typing import Literal, Optional, TypedDict
+
+from pymongo import UpdateOne
+
+RollupGranularity = Literal["minute", "hour"]
+
+ROLLUP_GRANULARITIES: dict[str, int] = {
+    "minute": 60,
+    "hour": 3600,
+}
+
+ROLLUP_GROUP_FIELDS = {
+    "user": "user_name",
+    "model": "ai_model_id",
+    "token_bucket": "token_bucket_id",
+}
+
+
+class UsageRollup(TypedDict):
+    _id: str
+    period: datetime.datetime
+    token_bucket_id: str
+    ai_model_id: str
+    user_name: Optional[str]
+    tokens_input: int
+    tokens_output: int
+    requests: int
+    requests_cancelled: int  # closed without completing: client disconnects, upstream errors, shed requests
+
+
+def truncate(timestamp: datetime.datetime, granularity: RollupGranularity) -> datetime.datetime:
+    if granularity == "minute":
+        return timestamp.replace(second=0, microsecond=0)
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+class UsageRollups:
+    # keeps per-minute and per-hour token totals for every (token bucket, model, user),
+    # updated as request usage logs complete so analytics never read the raw logs
+    def __init__(self, db):
+        self.collections = {granularity: getattr(db, f"usage_rollups_{granularity}") for granularity in ROLLUP_GRANULARITIES}
+
+    def operation(self, log: dict, granularity: RollupGranularity) -> UpdateOne:
+        period = truncate(log.get("createdAt") or datetime.datetime.utcnow(), granularity)
+        token_bucket_id = str(log.get("applicable_token_bucket_id"))
+        ai_model_id = log.get("ai_model_id")
+        user_name = log.get("user_name")
+        on_insert = {
+            "period": period,
+            "token_bucket_id": token_bucket_id,
+            "ai_model_id": ai_model_id,
+            "user_name": user_name,
+        }
+        if granularity == "minute":
+            on_insert["expiresAt"] = period + datetime.timedelta(days=7)
+        return UpdateOne(
+            {"_id": f"{period.isoformat()}|{token_bucket_id}|{ai_model_id}|{user_name}"},
+            {
+                "$inc": {
+                    "tokens_input": log.get("tokens_input", 0),
+                    "tokens_output": log.get("tokens_output", 0),
+                    "requests": 1,
+                    "requests_cancelled": 0 if log.get("request_completed") else 1,
+                },
+                "$setOnInsert": on_insert,
+            },
+            upsert=True,
+        )
+
+    def record(self, log: dict):
+        """Add a completed request usage log to the minute and hour rollups."""
+        for granularity, collection in self.collections.items():
+            collection.bulk_write([self.operation(log, granularity)])
+
+    def query(
+        self,
+        start: datetime.datetime,
+        end: datetime.datetime,
+        granularity: RollupGranularity = "hour",
+        group_by: tuple[str, ...] = ("user", "model"),
+        user_name: Optional[str] = None,
+        ai_model_id: Optional[str] = None,
+    ) -> list[dict]:
+        """
+        Sum token usage between `start` and `end`, per period of `granularity`.
+
+        Args:
+            group_by: any of "user", "model" and "token_bucket"; totals are summed over the other fields.
+
+        Returns:
+            list[dict]: one entry per period and group, ordered by period.
+        """
+        match = {"period": {"$gte": truncate(start, granularity), "$lt": end}}
+        if user_name:
+            match["user_name"] = user_name
+        if ai_model_id:
+            match["ai_model_id"] = ai_model_id
+        group_id = {"period": "$period"}
+        for key in group_by:
+            group_id[ROLLUP_GROUP_FIELDS[key]] = f"${ROLLUP_GROUP_FIELDS[key]}"
+        pipeline = [
+            {"$match": match},
+            {"$group": {
+                "_id": group_id,
+                "tokens_input": {"$sum": "$tokens_input"},
+                "tokens_output": {"$sum": "$tokens_output"},
+                "requests": {"$sum": "$requests"},
+                "requests_cancelled": {"$sum": "$requests_cancelled"},
+            }},
+            {"$sort": {"_id.period": 1}},
+        ]
+        results = []
+        for row in self.collections[granularity].aggregate(pipeline):
+            entry = row.pop("_id")
+            entry.update(row)
+            entry["tokens_total"] = entry["tokens_input"] + entry["tokens_output"]
+            results.append(entry)
+        return results
+
+
+class AsyncUsageRollups(UsageRollups):
+    # same rollups, written through an async (motor) database handle
+    async def record(self, log: dict):
+        """Add a completed request usage log to the minute and hour rollups."""
+        for granularity, collection in self.collections.items():
+            await collection.bulk_write([self.operation(log, granularity)])
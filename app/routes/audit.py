@@ -1,65 +1,145 @@
-from fastapi import APIRouter, Security
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Security, HTTPException, Query
+from fastapi.responses import StreamingResponse
 from bson import ObjectId
-from app.utils import VerifyToken, check_scope
-from app.mongo import db_manager
+from app.responses import FastJSONResponse
+from app.utils import verify_token, check_scope
+from app.mongo import db_manager, verify_indexes
+from app.pagination import paginate, export_ndjson, SortOrder, MAX_PAGE_SIZE
+from app.rollups import RollupGranularity, ROLLUP_GROUP_FIELDS
+from typing import Literal, Optional
 import datetime
 
 audit_api_router = APIRouter()
-auth = VerifyToken()
 
-def convert_object_id(obj):
-    if isinstance(obj, ObjectId):
-        return str(obj)
-    if isinstance(obj, dict):
-        return {k: convert_object_id(v) for k, v in obj.items()}
-    if isinstance(obj, list):
-        return [convert_object_id(i) for i in obj]
-    return obj
+
+def naive_utc(timestamp: Optional[datetime.datetime]) -> Optional[datetime.datetime]:
+    # Mongo stores naive UTC datetimes, convert offset-aware query params instead of dropping the offset
+    if timestamp is not None and timestamp.tzinfo is not None:
+        return timestamp.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return timestamp
+
 
 @audit_api_router.get("/token-buckets")
-def list_token_buckets(auth_result: str = Security(auth.verify)):
-    token_buckets = db_manager.list_token_buckets()
-    token_buckets = convert_object_id(token_buckets)
-    for bucket in token_buckets:
-        if bucket.get("createdAt"):
-            bucket["createdAt"] = bucket["createdAt"].isoformat()  # Convert datetime to ISO format string
-        if bucket.get("updatedAt"):
-            bucket["updatedAt"] = bucket["updatedAt"].isoformat()  # Convert datetime to ISO format string
-    return JSONResponse(content={"message": "Token buckets listed", "body": token_buckets})
+def list_token_buckets(
+    auth_result: str = Security(verify_token),
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    format: Literal["json", "ndjson"] = "json",
+    user_name: Optional[str] = None,
+    model_id: Optional[str] = None,
+    type: Optional[Literal["api-access", "ui-access"]] = None,
+):
+    filter = {}
+    if user_name:
+        filter["applicable_user_name"] = user_name
+    if model_id:
+        filter["applicable_ai_model_ids"] = model_id
+    if type:
+        filter["type"] = type
+    if format == "ndjson":
+        return StreamingResponse(export_ndjson(db_manager.db.token_buckets, filter, cursor), media_type="application/x-ndjson")
+    token_buckets, next_cursor = paginate(db_manager.db.token_buckets, filter, limit, cursor)
+    return FastJSONResponse(content={"message": "Token buckets listed", "body": token_buckets, "next_cursor": next_cursor})
 
 @audit_api_router.post("/token-buckets")
-def create_token_bucket(token_bucket: dict, auth_result: str = Security(auth.verify)):
+def create_token_bucket(token_bucket: dict, auth_result: str = Security(verify_token)):
     token_bucket["createdAt"] = datetime.datetime.utcnow()
     token_bucket["updatedAt"] = datetime.datetime.utcnow()
     result = db_manager.insert_token_bucket(token_bucket)
     if result:
-        return JSONResponse(content={"message": "Token bucket created", "body": convert_object_id(result.inserted_id)})
-    return JSONResponse(content={"message": "Failed to create token bucket"}, status_code=500)
+        return FastJSONResponse(content={"message": "Token bucket created", "body": result.inserted_id})
+    return FastJSONResponse(content={"message": "Failed to create token bucket"}, status_code=500)
 
 @audit_api_router.put("/token-buckets/{bucket_id}")
-def update_token_bucket(bucket_id: str, token_bucket: dict, auth_result: str = Security(auth.verify)):
+def update_token_bucket(bucket_id: str, token_bucket: dict, auth_result: str = Security(verify_token)):
     token_bucket["updatedAt"] = datetime.datetime.utcnow()
     result = db_manager.update_token_bucket(bucket_id, token_bucket)
     if not result.modified_count:
         print(result)
-        return JSONResponse(content={"message": "Failed to update token bucket"}, status_code=500)
-    return JSONResponse(content={"message": "Token bucket updated"})
+        return FastJSONResponse(content={"message": "Failed to update token bucket"}, status_code=500)
+    return FastJSONResponse(content={"message": "Token bucket updated"})
 
 @audit_api_router.delete("/token-buckets/{bucket_id}")
-def delete_token_bucket(bucket_id: str, auth_result: str = Security(auth.verify)):
+def delete_token_bucket(bucket_id: str, auth_result: str = Security(verify_token)):
     result = db_manager.delete_token_bucket(bucket_id)
     if result.deleted_count > 0:
-        return JSONResponse(content={"message": "Token bucket deleted"})
-    return JSONResponse(content={"message": "Failed to delete token bucket"}, status_code=500)
+        return FastJSONResponse(content={"message": "Token bucket deleted"})
+    return FastJSONResponse(content={"message": "Failed to delete token bucket"}, status_code=500)
 
 @audit_api_router.get("/usage-logs")
-def list_usage_logs(auth_result: str = Security(auth.verify)):
-    usage_logs = db_manager.list_request_usage_logs()
-    usage_logs = convert_object_id(usage_logs)
-    for log in usage_logs:
-        if log.get("createdAt"):
-            log["createdAt"] = log["createdAt"].isoformat()  # Convert datetime to ISO format string
-        if log.get("updatedAt"):
-            log["updatedAt"] = log["updatedAt"].isoformat()  # Convert datetime to ISO format string
-    return JSONResponse(content={"message": "Usage logs listed", "body": usage_logs})
+def list_usage_logs(
+    auth_result: str = Security(verify_token),
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    format: Literal["json", "ndjson"] = "json",
+    sort: Literal["_id", "createdAt"] = "_id",
+    order: SortOrder = "asc",
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    user_name: Optional[str] = None,
+    model_id: Optional[str] = None,
+    token_bucket_id: Optional[str] = None,
+    completed: Optional[bool] = None,
+):
+    filter = {}
+    if start or end:
+        filter["createdAt"] = {}
+        if start:
+            filter["createdAt"]["$gte"] = naive_utc(start)
+        if end:
+            filter["createdAt"]["$lt"] = naive_utc(end)
+    if user_name:
+        filter["user_name"] = user_name
+    if model_id:
+        filter["ai_model_id"] = model_id
+    if token_bucket_id:
+        if not ObjectId.is_valid(token_bucket_id):
+            raise HTTPException(status_code=400, detail="Invalid token bucket id")
+        filter["applicable_token_bucket_id"] = ObjectId(token_bucket_id)
+    if completed is not None:
+        filter["request_completed"] = completed
+    if format == "ndjson":
+        return StreamingResponse(
+            export_ndjson(db_manager.db.request_usage_logs, filter, cursor, sort_field=sort, order=order),
+            media_type="application/x-ndjson",
+        )
+    usage_logs, next_cursor = paginate(db_manager.db.request_usage_logs, filter, limit, cursor, sort_field=sort, order=order)
+    return FastJSONResponse(content={"message": "Usage logs listed", "body": usage_logs, "next_cursor": next_cursor})
+
+
+@audit_api_router.get("/indexes")
+def get_index_report(auth_result: str = Security(verify_token)):
+    # required indexes that are missing, and indexes that haven't been used since the server started
+    report = verify_indexes(db_manager.db)
+    return FastJSONResponse(content={"message": "Index report", "body": report})
+
+@audit_api_router.get("/usage-analytics")
+def get_usage_analytics(
+    auth_result: str = Security(verify_token),
+    start: Optional[datetime.datetime] = None,
+    end: Optional[datetime.datetime] = None,
+    granularity: RollupGranularity = "hour",
+    group_by: str = "user,model",
+    user_name: Optional[str] = None,
+    model_id: Optional[str] = None,
+):
+    # answered from the pre-aggregated usage rollups, raw usage logs are never scanned
+    start, end = naive_utc(start), naive_utc(end)
+    end = end or datetime.datetime.utcnow()
+    start = start or end - datetime.timedelta(days=1)
+    group_keys = tuple(key.strip() for key in group_by.split(",") if key.strip())
+    unknown_keys = [key for key in group_keys if key not in ROLLUP_GROUP_FIELDS]
+    if unknown_keys:
+        raise HTTPException(status_code=400, detail=f"Cannot group usage by {', '.join(unknown_keys)}")
+    if start >= end:
+        raise HTTPException(status_code=400, detail="start must be before end")
+
+    usage = db_manager.rollups.query(
+        start=start,
+        end=end,
+        granularity=granularity,
+        group_by=group_keys,
+        user_name=user_name,
+        ai_model_id=model_id,
+    )
+    return FastJSONResponse(content={"message": "Usage analytics listed", "body": usage})
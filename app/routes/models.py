@@ -1,25 +1,26 @@
 from fastapi import APIRouter, Security
 from typing import Union
-from fastapi.responses import JSONResponse
-from app.utils import VerifyToken, check_scope
+from app.responses import FastJSONResponse
+from app.utils import verify_token, check_scope
 from app.mongo import db_manager, AiModel
+from app.catalog import model_catalog
 
 models_api_router = APIRouter()
-auth = VerifyToken()
 
 @models_api_router.post("/models")
-def create_model(auth_result: str = Security(auth.verify), body: dict = AiModel):
+def create_model(auth_result: str = Security(verify_token), body: dict = AiModel):
     check_scope(auth_result, ["admin:models:edit"])
     model = db_manager.insert_ai_model(body)
+    model_catalog.replace(db_manager.list_ai_models())
     return {"message": "Model created"}
     
 @models_api_router.get("/models")
-def list_models(auth_result: str = Security(auth.verify), username: Union[str, None] = None):
+def list_models(auth_result: str = Security(verify_token), username: Union[str, None] = None):
     if username:
-        models = db_manager.list_ai_models_for_user(username)
+        models = model_catalog.list_models_for_ids(db_manager.list_ai_model_ids_for_user(username))
     else:
         check_scope(auth_result, ["admin:models:edit"])
-        models = db_manager.list_ai_models()
+        models = model_catalog.list_models()
     
     formatted_models = {
         "object": "list",
@@ -32,17 +33,18 @@ def list_models(auth_result: str = Security(auth.verify), username: Union[str, N
             } for model in models
         ]
     }
-    return JSONResponse(content=formatted_models)
+    return FastJSONResponse(content=formatted_models)
 
 @models_api_router.get("/models/{model_id}")
-def get_model(model_id: str, auth_result: str = Security(auth.verify)):
+def get_model(model_id: str, auth_result: str = Security(verify_token)):
     check_scope(auth_result, ["admin:models:edit"])
     return db_manager.get_ai_model_by_provider_id(model_id)
 
 @models_api_router.delete("/models/{model_id}")
-def delete_model(model_id: str, auth_result: str = Security(auth.verify)):
+def delete_model(model_id: str, auth_result: str = Security(verify_token)):
     check_scope(auth_result, ["admin:models:edit"])
     db_manager.delete_ai_model(model_id)
     db_manager.db.token_buckets.delete_many({"applicable_ai_model_ids": model_id})
+    model_catalog.replace(db_manager.list_ai_models())
     return {"message": "Model deleted", "model_id": model_id}
 
@@ -1,8 +1,9 @@
 
 from fastapi import APIRouter, Request
-from fastapi.responses import JSONResponse
+from app.responses import FastJSONResponse
 from app.utils import VerifyToken, check_scope
 from app.mongo import db_manager, AiModel
+from app.catalog import model_catalog
 
 models_api_router = APIRouter()
 
@@ -10,7 +11,7 @@ models_api_router = APIRouter()
 @models_api_router.get("/models")
 def list_models(request: Request):
     username = request.state.owner_id
-    models = db_manager.list_ai_models_for_user(username, access_type="api-access")
+    models = model_catalog.list_models_for_ids(db_manager.list_ai_model_ids_for_user(username, access_type="api-access"))
     formatted_models = {
         "object": "list",
         "data": [
@@ -22,4 +23,4 @@ def list_models(request: Request):
             } for model in models
         ]
     }
-    return JSONResponse(content=formatted_models)
\ No newline at end of file
+    return FastJSONResponse(content=formatted_models)
\ No newline at end of file
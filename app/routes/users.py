@@ -1,55 +1,61 @@
-from fastapi import APIRouter, status, Security, Depends, HTTPException
-from fastapi.responses import JSONResponse
-from app.utils import VerifyToken, check_scope
+from fastapi import APIRouter, status, Security, Depends, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from app.responses import FastJSONResponse
+from app.utils import verify_token, check_scope
 from app.mongo import db_manager, User, TokenBucket
-import datetime
+from app.pagination import paginate, export_ndjson, MAX_PAGE_SIZE
+from typing import Literal, Optional
 
 user_api_router = APIRouter()
-auth = VerifyToken()
 
 @user_api_router.get("/user/{user_name}")
-def get_user(user_name: str, auth_result: str = Security(auth.verify)):
+def get_user(user_name: str, auth_result: str = Security(verify_token)):
     user = db_manager.get_user(user_name)
-    return JSONResponse(content=user)
+    return FastJSONResponse(content=user)
 
 @user_api_router.post("/user")
-def create_user(auth_result: str = Security(auth.verify), body: dict = User):
+def create_user(auth_result: str = Security(verify_token), body: dict = User):
     check_scope(auth_result, ["admin:user:edit"])
     user = db_manager.insert_user(body)
     if not user:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User creation failed")
-    return JSONResponse(content={"message": "User created", "body": {"success": user}})
+    return FastJSONResponse(content={"message": "User created", "body": {"success": user}})
 
 @user_api_router.delete("/user/{user_name}")
-def delete_user(user_name: str, auth_result: str = Security(auth.verify)):
+def delete_user(user_name: str, auth_result: str = Security(verify_token)):
     check_scope(auth_result, ["admin:user:edit"])
     db_manager.delete_user(user_name)
     db_manager.db.token_buckets.delete_many({"applicable_user_name": user_name})
-    return JSONResponse(content={"message": "User deleted", "success": user_name})
+    return FastJSONResponse(content={"message": "User deleted", "success": user_name})
 
 @user_api_router.get("/user/{user_name}/token_buckets")
-def list_token_buckets_for_user(user_name: str, auth_result: str = Security(auth.verify)):
+def list_token_buckets_for_user(user_name: str, auth_result: str = Security(verify_token)):
     token_buckets = db_manager.list_token_buckets_for_user(user_name)
-    return JSONResponse(content=token_buckets)
+    return FastJSONResponse(content=token_buckets)
 
 @user_api_router.get("/user/{user_name}/token_buckets/{token_bucket_id}")
-def get_token_bucket(user_name: str, token_bucket_id: str, auth_result: str = Security(auth.verify)):
+def get_token_bucket(user_name: str, token_bucket_id: str, auth_result: str = Security(verify_token)):
     token_bucket = db_manager.get_token_bucket(token_bucket_id)
-    return JSONResponse(content=token_bucket)
+    return FastJSONResponse(content=token_bucket)
 
 @user_api_router.post("/user/{user_name}/token_buckets")
-def create_token_bucket(user_name: str, auth_result: str = Security(auth.verify), body: dict = TokenBucket):
+def create_token_bucket(user_name: str, auth_result: str = Security(verify_token), body: dict = TokenBucket):
     check_scope(auth_result, ["admin:user:assign_models"])
     bucket = db_manager.insert_token_bucket(body)
-    return JSONResponse(content={"message": "Token bucket created", "body": bucket})
+    return FastJSONResponse(content={"message": "Token bucket created", "body": bucket.inserted_id})
 
 @user_api_router.get("/users")
-def list_users(auth_result: str = Security(auth.verify)):
-    users = db_manager.list_users()
-    for user in users:
-        user["_id"] = str(user["_id"])  # Convert ObjectId to string
-        if user.get("createdAt"):
-            user["createdAt"] = user["createdAt"].isoformat()  # Convert datetime to ISO format string
-        if user.get("updatedAt"):
-            user["updatedAt"] = user["updatedAt"].isoformat()  # Convert datetime to ISO format string
-    return JSONResponse(content={"message": "Users listed", "body": users})
\ No newline at end of file
+def list_users(
+    auth_result: str = Security(verify_token),
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    format: Literal["json", "ndjson"] = "json",
+    email: Optional[str] = None,
+):
+    filter = {}
+    if email:
+        filter["email"] = email
+    if format == "ndjson":
+        return StreamingResponse(export_ndjson(db_manager.db.users, filter, cursor), media_type="application/x-ndjson")
+    users, next_cursor = paginate(db_manager.db.users, filter, limit, cursor)
+    return FastJSONResponse(content={"message": "Users listed", "body": users, "next_cursor": next_cursor})
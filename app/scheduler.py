@@ -0,0 +1,230 @@
+import asyncio
+import math
+import time
+from collections import OrderedDict, defaultdict, deque
+from typing import AsyncIterator, Optional
+
+from fastapi import HTTPException
+
+from app.context import ContextProxy
+
+# smoothing factor of the moving average of how long a call holds its slot
+_HOLD_TIME_ALPHA = 0.2
+
+
+class OverloadedException(HTTPException):
+    def __init__(self, retry_after: int):
+        """Returns HTTP 503 with Retry-After, the request was shed before going upstream"""
+        super().__init__(503, detail="Upstream provider is at capacity, retry later", headers={"Retry-After": str(retry_after)})
+
+
+class Slot:
+    """Permission to make one upstream call. Must be released once the call, including any stream, is over."""
+
+    def __init__(self, queue: "ProviderQueue", model_id: str):
+        self.queue = queue
+        self.model_id = model_id
+        self.started_at = time.monotonic()
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.queue.finish(self.model_id, time.monotonic() - self.started_at)
+
+    def hold(self, iterator: AsyncIterator) -> AsyncIterator:
+        """Keep the slot while `iterator` (a response stream) is consumed, released when it ends or is dropped."""
+        return _SlotIterator(iterator, self)
+
+
+class _SlotIterator:
+    # a class rather than an async generator so the slot is also released if the stream is
+    # dropped without ever being iterated, e.g. when the client disconnects first
+    def __init__(self, iterator: AsyncIterator, slot: Slot):
+        self.iterator = iterator
+        self.slot = slot
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.iterator.__anext__()
+        except BaseException:
+            self.slot.release()
+            raise
+
+    async def aclose(self):
+        self.slot.release()
+        if hasattr(self.iterator, "aclose"):
+            await self.iterator.aclose()
+
+    def __del__(self):
+        self.slot.release()
+
+
+class _Waiter:
+    def __init__(self, model_id: str, owner: str):
+        self.model_id = model_id
+        self.owner = owner
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class ProviderQueue:
+    """
+    Concurrency limits and the wait queue for one provider.
+
+    Calls run while the provider and the model are under their caps, otherwise they wait.
+    Waiters are queued per access type and, within an access type, per owner. When a slot
+    frees up the access type is picked by smooth weighted round robin, and owners of that
+    access type take turns, so one busy owner can't starve the others.
+    """
+
+    def __init__(self, max_concurrency: int, max_model_concurrency: int, max_depth: int, weights: dict[str, int]):
+        self.max_concurrency = max_concurrency
+        self.max_model_concurrency = max_model_concurrency
+        self.max_depth = max_depth
+        self.weights = weights
+        self.active = 0
+        self.active_models: dict[str, int] = defaultdict(int)
+        # access type -> owner -> that owner's waiters in arrival order
+        self.queues: dict[str, OrderedDict[str, deque[_Waiter]]] = {access_type: OrderedDict() for access_type in weights}
+        self.credits = {access_type: 0 for access_type in weights}
+        self.depth = 0
+        self.hold_time = 1.0
+
+    def can_run(self, model_id: str) -> bool:
+        return self.active < self.max_concurrency and self.active_models[model_id] < self.max_model_concurrency
+
+    def start(self, model_id: str):
+        self.active += 1
+        self.active_models[model_id] += 1
+
+    def finish(self, model_id: str, held: float):
+        self.active -= 1
+        self.active_models[model_id] -= 1
+        if not self.active_models[model_id]:
+            del self.active_models[model_id]
+        self.hold_time += _HOLD_TIME_ALPHA * (held - self.hold_time)
+        self.dispatch()
+
+    def retry_after(self) -> int:
+        # roughly how long until the current queue has drained
+        return max(1, min(60, math.ceil(self.hold_time * (self.depth + 1) / self.max_concurrency)))
+
+    def enqueue(self, access_type: str, waiter: _Waiter):
+        self.queues[access_type].setdefault(waiter.owner, deque()).append(waiter)
+        self.depth += 1
+
+    def remove(self, access_type: str, waiter: _Waiter):
+        owners = self.queues[access_type]
+        waiters = owners.get(waiter.owner)
+        if waiters is None or waiter not in waiters:
+            return
+        waiters.remove(waiter)
+        if not waiters:
+            del owners[waiter.owner]
+        self.depth -= 1
+
+    def _next_waiter(self, access_type: str) -> Optional[_Waiter]:
+        owners = self.queues[access_type]
+        for owner, waiters in owners.items():
+            # only the head of an owner's queue is considered, an owner's calls start in order
+            if self.can_run(waiters[0].model_id):
+                waiter = waiters.popleft()
+                if waiters:
+                    owners.move_to_end(owner)
+                else:
+                    del owners[owner]
+                return waiter
+        return None
+
+    def dispatch(self):
+        """Start queued calls while there is capacity for them."""
+        while self.depth and self.active < self.max_concurrency:
+            ready = [access_type for access_type, owners in self.queues.items() if owners]
+            for access_type in ready:
+                self.credits[access_type] += self.weights[access_type]
+            waiter = None
+            for access_type in sorted(ready, key=self.credits.get, reverse=True):
+                waiter = self._next_waiter(access_type)
+                if waiter is not None:
+                    self.credits[access_type] -= sum(self.weights[ready_type] for ready_type in ready)
+                    break
+            if waiter is None:
+                # everything queued is waiting on a model cap
+                for access_type in ready:
+                    self.credits[access_type] -= self.weights[access_type]
+                return
+            self.depth -= 1
+            self.start(waiter.model_id)
+            waiter.future.set_result(None)
+
+
+class UpstreamScheduler:
+    """
+    Bounds concurrent upstream calls per provider and per model, with weighted priority
+    queues between access types and fairness between owners. Queues are bounded in depth and
+    wait time, a call that can't be queued or waits too long is shed with a 503 and a
+    Retry-After estimate instead of piling up.
+    """
+
+    def __init__(self, max_concurrency: int, provider_max_concurrency: dict[str, int], max_model_concurrency: int,
+                 max_queue_depth: int, max_wait: float, weights: dict[str, int]):
+        self.max_concurrency = max_concurrency
+        self.provider_max_concurrency = provider_max_concurrency
+        self.max_model_concurrency = max_model_concurrency
+        self.max_queue_depth = max_queue_depth
+        self.max_wait = max_wait
+        self.weights = weights
+        self.queues: dict[str, ProviderQueue] = {}
+
+    def queue(self, provider: str) -> ProviderQueue:
+        queue = self.queues.get(provider)
+        if queue is None:
+            queue = self.queues[provider] = ProviderQueue(
+                max_concurrency=self.provider_max_concurrency.get(provider, self.max_concurrency),
+                max_model_concurrency=self.max_model_concurrency,
+                max_depth=self.max_queue_depth,
+                weights=self.weights,
+            )
+        return queue
+
+    async def acquire(self, provider: str, model_id: str, access_type: str, owner: str) -> Slot:
+        """
+        Wait for a slot to call `provider` for `model_id`.
+
+        Raises:
+            HTTPException: 503 with Retry-After if the queue is full or the slot didn't free up in time.
+        """
+        queue = self.queue(provider)
+        if queue.can_run(model_id):
+            queue.start(model_id)
+            return Slot(queue, model_id)
+        if queue.depth >= queue.max_depth:
+            raise self.overloaded(queue)
+
+        waiter = _Waiter(model_id, owner)
+        queue.enqueue(access_type, waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as error:
+            if waiter.future.done():
+                # the slot was handed over just as the wait ended
+                slot = Slot(queue, model_id)
+                if isinstance(error, asyncio.CancelledError):
+                    slot.release()
+                    raise
+                return slot
+            queue.remove(access_type, waiter)
+            waiter.future.cancel()
+            if isinstance(error, asyncio.CancelledError):
+                raise
+            raise self.overloaded(queue)
+        return Slot(queue, model_id)
+
+    def overloaded(self, queue: ProviderQueue) -> OverloadedException:
+        return OverloadedException(queue.retry_after())
+
+
+upstream_scheduler = ContextProxy("upstream_scheduler")
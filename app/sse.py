@@ -0,0 +1,119 @@
+import json
+import re
+from typing import Optional
+
+# A text delta exactly as Anthropic serializes it. The text is captured as its raw JSON string
+# literal, which is already valid JSON and can be copied into the OpenAI chunk without decoding.
+_TEXT_DELTA = re.compile(
+    rb'\{"type":"content_block_delta","index":\d+,"delta":\{"type":"text_delta","text":("(?:[^"\\]|\\.)*")\}\}'
+)
+
+
+class SSEParser:
+    """
+    Incremental parser for a server-sent event stream, fed raw bytes as they arrive.
+
+    Events are returned as (event, data) byte strings once their terminating blank line has
+    been received, a line split across two reads is kept in the buffer until the rest arrives.
+    """
+
+    def __init__(self):
+        # the incomplete line left over from the previous read
+        self.buffer = b""
+        self.event = b""
+        self.data: list[bytes] = []
+
+    def feed(self, chunk: bytes) -> list[tuple[bytes, bytes]]:
+        buffer = self.buffer + chunk if self.buffer else chunk
+        events = []
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end == -1:
+                break
+            line = buffer[start:end]
+            start = end + 1
+            if line.endswith(b"\r"):
+                line = line[:-1]
+            if not line:
+                if self.data:
+                    events.append((self.event, b"\n".join(self.data)))
+                self.event = b""
+                self.data = []
+            elif line.startswith(b"data:"):
+                self.data.append(line[5:].lstrip(b" "))
+            elif line.startswith(b"event:"):
+                self.event = line[6:].strip()
+            # comments (":") and fields we don't use (id, retry) are ignored
+        self.buffer = buffer[start:]
+        return events
+
+
+def text_delta_literal(data: bytes) -> Optional[bytes]:
+    """The raw JSON string literal of a content_block_delta text delta, or None if `data` isn't one."""
+    match = _TEXT_DELTA.fullmatch(data)
+    return match.group(1) if match else None
+
+
+def decode_literals(literals: list[bytes]) -> str:
+    """Decode and join JSON string literals collected from text deltas."""
+    if not literals:
+        return ""
+    return "".join(json.loads(b"[" + b",".join(literals) + b"]"))
+
+
+class OpenAIChunkEncoder:
+    """
+    Encodes OpenAI chat.completion.chunk SSE events from pre-serialized templates.
+
+    The id, created time, model and fingerprint are fixed for the whole stream, so everything
+    but the content and finish reason is serialized once up front.
+    """
+
+    _CONTENT = "\x00content\x00"
+    _FINISH_REASON = "\x00finish_reason\x00"
+
+    def __init__(self, completion_id: str, model: str, created: int, system_fingerprint: str):
+        template = json.dumps({
+            "id": completion_id,
+            "choices": [
+                {
+                    "delta": {
+                        "content": self._CONTENT,
+                        "function_call": None,
+                        "refusal": None,
+                        "role": None,
+                        "tool_calls": None
+                    },
+                    "finish_reason": self._FINISH_REASON,
+                    "index": 0,
+                    "logprobs": None
+                }
+            ],
+            "created": created,
+            "model": model,
+            "object": "chat.completion.chunk",
+            "service_tier": None,
+            "system_fingerprint": system_fingerprint,
+            "usage": None
+        })
+        head, rest = template.split(json.dumps(self._CONTENT), 1)
+        middle, tail = rest.split(json.dumps(self._FINISH_REASON), 1)
+        self.head = b"data: " + head.encode()
+        self.middle = middle.encode()
+        self.tail = tail.encode() + b"\n\n"
+
+    def encode(self, content_literal: bytes, finish_reason: Optional[str] = None) -> bytes:
+        """
+        Args:
+            content_literal (bytes): The delta content as a JSON string literal.
+            finish_reason (Optional[str]): The finish reason, if this is the last chunk of a choice.
+
+        Returns:
+            bytes: The complete SSE event.
+        """
+        finish = b"null" if finish_reason is None else json.dumps(finish_reason).encode()
+        return b"".join((self.head, content_literal, self.middle, finish, self.tail))
+
+    def encode_text(self, text: str, finish_reason: Optional[str] = None) -> bytes:
+        return self.encode(json.dumps(text).encode(), finish_reason)
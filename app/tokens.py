@@ -0,0 +1,167 @@
+import base64
+import binascii
+import math
+import struct
+from typing import Any, Optional
+
+# OpenAI charges a few tokens per message for its role and separators, and a few to prime the reply
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+# what an image is charged when its size can't be read (a remote URL, or an unknown format):
+# OpenAI's cost for a 1024x1024 image at high detail, and Anthropic's for its largest unscaled image
+DEFAULT_IMAGE_TOKENS = {"OpenAI": 765, "Anthropic": 1600}
+
+# base64 prefixes to decode, in characters, when looking for an image's size. PNG, GIF and WebP
+# keep it in the first few bytes, JPEG after any EXIF/ICC segments, so larger prefixes are only
+# tried when needed. Images are never decoded in full beyond the last prefix.
+_PREFIX_SIZES = (128, 4096, 65536, 1048576)
+
+# JPEG start-of-frame markers, which carry the image size (C4, C8 and CC are other segments)
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _jpeg_dimensions(data: bytes) -> Optional[tuple[int, int]]:
+    offset = 2
+    while offset + 9 <= len(data):
+        if data[offset] != 0xFF:
+            return None
+        marker = data[offset + 1]
+        if marker == 0xFF:
+            offset += 1  # fill byte
+            continue
+        if marker in _JPEG_SOF_MARKERS:
+            height, width = struct.unpack(">HH", data[offset + 5:offset + 9])
+            return width, height
+        segment_length = struct.unpack(">H", data[offset + 2:offset + 4])[0]
+        offset += 2 + segment_length
+    return None
+
+
+def image_dimensions(data: bytes) -> Optional[tuple[int, int]]:
+    """
+    Read (width, height) from the first bytes of a PNG, GIF, WebP or JPEG image.
+
+    Returns:
+        Optional[tuple[int, int]]: The size, or None if the format isn't recognised or `data` ends before the size.
+    """
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return struct.unpack(">II", data[16:24])
+    if data[:6] in (b"GIF87a", b"GIF89a") and len(data) >= 10:
+        return struct.unpack("<HH", data[6:10])
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP" and len(data) >= 30:
+        chunk = data[12:16]
+        if chunk == b"VP8 ":
+            width, height = struct.unpack("<HH", data[26:30])
+            return width & 0x3FFF, height & 0x3FFF
+        if chunk == b"VP8L":
+            bits = int.from_bytes(data[21:25], "little")
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b"VP8X":
+            return int.from_bytes(data[24:27], "little") + 1, int.from_bytes(data[27:30], "little") + 1
+        return None
+    if data[:2] == b"\xff\xd8":
+        return _jpeg_dimensions(data)
+    return None
+
+
+def data_url_image_dimensions(url: str) -> Optional[tuple[int, int]]:
+    """The size of a base64 data-URL image, decoding only as much of its header as needed."""
+    if not url.startswith("data:"):
+        return None
+    comma = url.find(",")
+    if comma == -1 or ";base64" not in url[:comma]:
+        return None
+    start = comma + 1
+    length = len(url) - start
+    for size in _PREFIX_SIZES:
+        size = min(size, length - length % 4)
+        try:
+            dimensions = image_dimensions(base64.b64decode(url[start:start + size]))
+        except (binascii.Error, ValueError):
+            return None
+        if dimensions is not None or size >= length - length % 4:
+            return dimensions
+    return None
+
+
+def openai_image_tokens(width: int, height: int, detail: str = "auto") -> int:
+    # fit in 2048x2048, scale the shortest side down to 768, then 170 tokens per 512px tile plus 85
+    if detail == "low":
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 170 * math.ceil(width / 512) * math.ceil(height / 512) + 85
+
+
+def anthropic_image_tokens(width: int, height: int) -> int:
+    # images with a long edge over 1568px are scaled down first, then about one token per 750 pixels
+    scale = min(1.0, 1568 / max(width, height))
+    return math.ceil(width * scale * height * scale / 750)
+
+
+def image_tokens(part: dict, provider: Optional[str]) -> int:
+    image_url = part.get("image_url") or {}
+    url = image_url.get("url") if isinstance(image_url, dict) else image_url
+    detail = image_url.get("detail", "auto") if isinstance(image_url, dict) else "auto"
+    if provider == "OpenAI" and detail == "low":
+        return 85
+    dimensions = data_url_image_dimensions(url) if isinstance(url, str) else None
+    if not dimensions or not all(dimensions):
+        return DEFAULT_IMAGE_TOKENS.get(provider, DEFAULT_IMAGE_TOKENS["OpenAI"])
+    if provider == "Anthropic":
+        return anthropic_image_tokens(*dimensions)
+    return openai_image_tokens(*dimensions, detail=detail)
+
+
+def _text(value: Any) -> str:
+    return value if isinstance(value, str) else ""
+
+
+def estimate_input_tokens(messages: list[dict[str, Any]], encoding, provider: Optional[str] = None) -> int:
+    """
+    Estimate the input tokens of a chat request, to charge it against the token bucket before it goes upstream.
+
+    Message content may be a string or a list of OpenAI content parts. Text is tokenized in a
+    single pass, and images are charged by the provider's pricing formula from their size,
+    read from the data URL's first bytes.
+
+    Args:
+        messages (list[dict]): The chat messages.
+        encoding: The tiktoken encoding to count text tokens with.
+        provider (Optional[str]): The model's provider, which decides how images are charged.
+
+    Returns:
+        int: The estimated input tokens.
+    """
+    texts = []
+    tokens = TOKENS_PER_REPLY
+    for message in messages:
+        tokens += TOKENS_PER_MESSAGE
+        # the body isn't validated, malformed parts are skipped rather than failing admission
+        if not isinstance(message, dict):
+            continue
+        content = message.get("content")
+        if isinstance(content, str):
+            texts.append(content)
+        elif isinstance(content, list):
+            for part in content:
+                if isinstance(part, str):
+                    texts.append(part)
+                elif not isinstance(part, dict):
+                    continue
+                elif part.get("type") == "text":
+                    texts.append(_text(part.get("text")))
+                elif part.get("type") == "image_url":
+                    tokens += image_tokens(part, provider)
+        if _text(message.get("name")):
+            texts.append(message["name"])
+        for tool_call in message.get("tool_calls") or []:
+            function = tool_call.get("function") if isinstance(tool_call, dict) else None
+            if isinstance(function, dict):
+                texts.append(_text(function.get("name")))
+                texts.append(_text(function.get("arguments")))
+    # one encode call for all the text, special tokens in user input are counted as plain text
+    return tokens + len(encoding.encode_ordinary("\n".join(texts)))
@@ -0,0 +1,102 @@
+import asyncio
+import time
+import uuid
+from contextvars import ContextVar
+from typing import Any, Optional
+
+from app.context import ContextProxy
+from app.responses import dumps
+
+
+class Trace:
+    """The spans recorded while handling one request."""
+
+    def __init__(self, name: str):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.spans: list[dict[str, Any]] = []
+        self.attributes: dict[str, Any] = {}
+
+    def add_span(self, name: str, started: float, duration: float, attributes: dict[str, Any]):
+        self.spans.append({
+            "name": name,
+            "start_ms": round((started - self.started) * 1e3, 3),
+            "duration_ms": round(duration * 1e3, 3),
+            "attributes": attributes,
+        })
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "timestamp": self.started_at,
+            "duration_ms": round((time.perf_counter() - self.started) * 1e3, 3),
+            "attributes": self.attributes,
+            "spans": self.spans,
+        }
+
+
+# the trace of the request being handled, tasks started for a request inherit it
+current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+
+
+def record_span(name: str, started: float, duration: float, attributes: dict[str, Any]):
+    """Add a span to the current request's trace, if it's being traced."""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_span(name, started, duration, attributes)
+
+
+class TraceExporter:
+    """
+    Writes finished request traces to a local file, one JSON object per line. Traces are
+    buffered in memory and appended every `flush_interval` seconds off the event loop.
+    Tracing is disabled when `path` is None.
+    """
+
+    def __init__(self, path: Optional[str], flush_interval: float):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.pending: list[dict[str, Any]] = []
+        self.flush_task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def export(self, trace: Trace):
+        self.pending.append(trace.to_dict())
+
+    async def start(self):
+        if self.enabled and self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        traces, self.pending = self.pending, []
+        try:
+            lines = b"".join(dumps(trace) + b"\n" for trace in traces)
+            await asyncio.to_thread(self._write, lines)
+        except (OSError, TypeError) as error:
+            print(f"Failed to export {len(traces)} traces: {error}")
+
+    def _write(self, lines: bytes):
+        with open(self.path, "ab") as file:
+            file.write(lines)
+
+
+trace_exporter = ContextProxy("trace_exporter")
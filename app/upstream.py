@@ -0,0 +1,86 @@
+from typing import Optional
+
+import httpx
+from openai import AsyncOpenAI
+
+from app.config import get_settings, Settings
+from app.context import ContextProxy
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class UpstreamClients:
+    """
+    Application-lifetime HTTP clients for the model providers.
+
+    Clients are opened once in the startup hook and shared by every router, so
+    requests reuse pooled keep-alive connections instead of paying for a new
+    TCP/TLS handshake each time.
+    """
+
+    def __init__(self, settings: Optional[Settings] = None):
+        self.settings = settings
+        self.clients: dict[str, httpx.AsyncClient] = {}
+        self.openai_client: Optional[AsyncOpenAI] = None
+
+    def _build_client(self, settings: Settings, base_url: str) -> httpx.AsyncClient:
+        http2 = settings.upstream_http2
+        if http2 and not _http2_available():
+            print("HTTP/2 requested for upstream clients but the h2 package is not installed, using HTTP/1.1")
+            http2 = False
+        return httpx.AsyncClient(
+            base_url=base_url,
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=settings.upstream_max_connections,
+                max_keepalive_connections=settings.upstream_max_keepalive_connections,
+                keepalive_expiry=settings.upstream_keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(
+                connect=settings.upstream_connect_timeout,
+                read=settings.upstream_read_timeout,
+                write=settings.upstream_write_timeout,
+                pool=settings.upstream_pool_timeout,
+            ),
+        )
+
+    async def open(self, settings: Optional[Settings] = None):
+        settings = settings or self.settings or get_settings()
+        if self.clients:
+            return
+        self.clients["anthropic"] = self._build_client(settings, settings.anthropic_base_url)
+        self.clients["openai"] = self._build_client(settings, settings.openai_base_url)
+        self.openai_client = AsyncOpenAI(
+            api_key=settings.openai_api_key,
+            base_url=settings.openai_base_url,
+            http_client=self.clients["openai"],
+            # retries and timeouts are handled by app.resilience, the SDK's own would override them
+            max_retries=0,
+            timeout=self.clients["openai"].timeout,
+        )
+
+    async def close(self):
+        clients, self.clients = self.clients, {}
+        self.openai_client = None
+        for client in clients.values():
+            await client.aclose()
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        client = self.clients.get(name)
+        if client is None:
+            raise RuntimeError(f"Upstream client '{name}' is not open, was the startup hook run?")
+        return client
+
+    def openai(self) -> AsyncOpenAI:
+        if self.openai_client is None:
+            raise RuntimeError("OpenAI client is not open, was the startup hook run?")
+        return self.openai_client
+
+
+upstream_clients = ContextProxy("upstream_clients")
@@ -0,0 +1,160 @@
+import asyncio
+import datetime
+from typing import Any, Optional
+
+from bson import ObjectId
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from app.context import ContextProxy
+from app.mongo import is_final_update, RequestUsageLog
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+class UsageLogWriter:
+    """
+    Write-behind buffer for request usage logs.
+
+    Inserts and completion updates are queued in memory and written with one bulk_write per
+    batch, flushed when `batch_size` operations are queued or `flush_interval` seconds after
+    the first one, whichever comes first. The queue is bounded: when Mongo falls behind and
+    it fills up, callers wait for room instead of the buffer growing without limit.
+    """
+
+    def __init__(self, db_manager, batch_size: int, flush_interval: float, max_pending: int):
+        self.db_manager = db_manager
+        self.collection = db_manager.db.request_usage_logs
+        self.rollups = db_manager.rollups
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.queue: Optional[asyncio.Queue] = None
+        self.flush_task: Optional[asyncio.Task] = None
+        # logs that were queued but not closed yet, kept to fold them into the rollups once they are
+        self.open_logs: dict[Any, RequestUsageLog] = {}
+
+    async def start(self):
+        if self.flush_task is None:
+            self.queue = asyncio.Queue(maxsize=self.max_pending)
+            self.flush_task = asyncio.create_task(self._run())
+
+    async def close(self):
+        """Flush everything that is queued and stop the writer."""
+        if self.flush_task is None:
+            return
+        await self.queue.put(None)
+        await self.flush_task
+        self.flush_task = None
+        self.queue = None
+
+    async def insert(self, log: RequestUsageLog):
+        """Queue a new usage log, returns its _id right away. Logs inserted already closed go straight to the usage rollups."""
+        now = datetime.datetime.utcnow()
+        log["_id"] = log.get("_id") or ObjectId()
+        log["createdAt"] = now
+        log["updatedAt"] = now
+        closed = is_final_update(log)
+        if self.queue is None:
+            await self.collection.insert_one(log)
+            if closed:
+                await self.rollups.record(log)
+        else:
+            if not closed:
+                # no update will close it, so don't wait for one
+                self.open_logs[log["_id"]] = log
+            await self.queue.put(("insert", log, closed))
+        return log["_id"]
+
+    async def update(self, log_id, update_fields: dict):
+        """Queue an update to a usage log, completed or cancelled logs are also added to the usage rollups."""
+        update_fields["updatedAt"] = datetime.datetime.utcnow()
+        if self.queue is None:
+            await self.db_manager.update_request_usage_log(log_id, update_fields)
+            return
+        log = self.open_logs.get(log_id)
+        if log is not None and is_final_update(update_fields):
+            del self.open_logs[log_id]
+            log = {**log, **update_fields}
+        else:
+            log = None
+        await self.queue.put(("update", log_id, update_fields, log))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        closing = False
+        while not closing:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    closing = True
+                    break
+                batch.append(item)
+            try:
+                await self._flush(batch)
+            except Exception as error:
+                # keep the writer running, if it stopped the queue would fill up and block every request
+                print(f"Failed to flush {len(batch)} usage log operations: {error!r}")
+
+    def _operations(self, batch: list) -> tuple[list, dict[str, list]]:
+        log_operations = []
+        inserts = {}
+        rollup_operations = {granularity: [] for granularity in self.rollups.collections}
+        for item in batch:
+            if item[0] == "insert":
+                _, log, closed = item
+                inserts[log["_id"]] = log
+                log_operations.append(InsertOne(log))
+                if closed:
+                    for granularity in rollup_operations:
+                        rollup_operations[granularity].append(self.rollups.operation(log, granularity))
+            else:
+                _, log_id, update_fields, completed_log = item
+                if log_id in inserts:
+                    # the log hasn't been written yet, write it with the update applied
+                    inserts[log_id].update(update_fields)
+                else:
+                    log_operations.append(UpdateOne({"_id": log_id}, {"$set": update_fields}))
+                if completed_log is not None:
+                    for granularity in rollup_operations:
+                        rollup_operations[granularity].append(self.rollups.operation(completed_log, granularity))
+        return log_operations, rollup_operations
+
+    async def _bulk_write(self, collection, operations: list, attempts: int = 3):
+        for attempt in range(attempts):
+            try:
+                await collection.bulk_write(operations, ordered=False)
+                return
+            except BulkWriteError as error:
+                # only retry the operations that failed, a retried insert that already made it in is fine
+                errors = [e for e in error.details.get("writeErrors", []) if e.get("code") != DUPLICATE_KEY_ERROR]
+                if not errors:
+                    return
+                print(f"Failed to write {len(errors)} usage log operations: {errors[0].get('errmsg')}")
+                operations = [operations[e["index"]] for e in errors]
+            except PyMongoError as error:
+                print(f"Failed to write usage logs: {error}")
+            await asyncio.sleep(0.1 * 2 ** attempt)
+        print(f"Dropping {len(operations)} usage log operations after {attempts} attempts")
+
+    async def _flush(self, batch: list):
+        log_operations, rollup_operations = self._operations(batch)
+        if log_operations:
+            await self._bulk_write(self.collection, log_operations)
+        for granularity, operations in rollup_operations.items():
+            if operations:
+                await self._bulk_write(self.rollups.collections[granularity], operations)
+
+
+usage_log_writer = ContextProxy("usage_log_writer")
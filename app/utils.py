@@ -1,10 +1,15 @@
+import asyncio
+import hashlib
+import time
 from typing import Optional
 
 import jwt
 from fastapi import HTTPException, status, Depends
 from fastapi.security import SecurityScopes, HTTPAuthorizationCredentials, HTTPBearer
 
-from app.config import get_settings
+from app.config import get_settings, Settings
+from app.cache import TTLCache, SingleFlight
+from app.context import get_context
 
 
 class UnauthorizedException(HTTPException):
@@ -18,17 +23,50 @@ class UnauthenticatedException(HTTPException):
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Requires authentication"
         )
 
+class KeyVerificationError(Exception):
+    """Raised when Unkey could not be asked whether a key is valid"""
+
 
 class VerifyToken:
     """Does all the token verification using PyJWT"""
 
-    def __init__(self):
-        self.config = get_settings()
+    def __init__(self, settings: Optional[Settings] = None):
+        self.config = settings or get_settings()
 
         # This gets the JWKS from a given URL and does processing so you can
-        # use any of the keys available
+        # use any of the keys available. The key set is kept fresh by refresh_jwks_periodically,
+        # the lifespan only matters if that task isn't running.
         jwks_url = f'https://{self.config.auth0_domain}/.well-known/jwks.json'
-        self.jwks_client = jwt.PyJWKClient(jwks_url)
+        self.jwks_client = jwt.PyJWKClient(jwks_url, lifespan=2 * self.config.jwks_refresh_interval_seconds)
+        # verified claims keyed by token digest, each entry lives until the token expires
+        self.claims_cache = TTLCache(maxsize=self.config.jwt_cache_max_entries, ttl=self.config.jwt_cache_max_ttl_seconds)
+        self.jwks_refresh_task: Optional[asyncio.Task] = None
+
+    async def refresh_jwks(self):
+        # PyJWKClient fetches with urllib, keep it off the event loop
+        await asyncio.to_thread(self.jwks_client.get_jwk_set, refresh=True)
+
+    async def refresh_jwks_periodically(self):
+        while True:
+            await asyncio.sleep(self.config.jwks_refresh_interval_seconds)
+            try:
+                await self.refresh_jwks()
+            except Exception as error:
+                print(f"Failed to refresh JWKS: {error}")
+
+    async def start(self):
+        """Fetch the JWKS and keep refreshing it in the background, so requests never wait on it."""
+        try:
+            await self.refresh_jwks()
+        except Exception as error:
+            print(f"Failed to prefetch JWKS: {error}")
+        if self.jwks_refresh_task is None:
+            self.jwks_refresh_task = asyncio.create_task(self.refresh_jwks_periodically())
+
+    async def close(self):
+        if self.jwks_refresh_task is not None:
+            self.jwks_refresh_task.cancel()
+            self.jwks_refresh_task = None
 
     async def verify(self,
                      security_scopes: SecurityScopes,
@@ -37,6 +75,11 @@ class VerifyToken:
         if token is None:
             raise UnauthenticatedException
 
+        token_digest = hashlib.sha256(token.credentials.encode()).digest()
+        payload = self.claims_cache.get(token_digest)
+        if payload is not None:
+            return payload
+
         # This gets the 'kid' from the passed token
         try:
             signing_key = self.jwks_client.get_signing_key_from_jwt(
@@ -57,9 +100,86 @@ class VerifyToken:
             )
         except Exception as error:
             raise UnauthorizedException(str(error))
-    
+
+        ttl = self.config.jwt_cache_max_ttl_seconds
+        if "exp" in payload:
+            ttl = min(ttl, payload["exp"] - time.time())
+        self.claims_cache.set(token_digest, payload, ttl=ttl)
         return payload
-    
+
+
+def get_token_verifier() -> VerifyToken:
+    # one verifier (and claims cache) shared by the middleware and every router
+    return get_context().token_verifier
+
+
+async def verify_token(security_scopes: SecurityScopes, token: Optional[HTTPAuthorizationCredentials] = Depends(HTTPBearer())):
+    """Route dependency verifying the bearer token with the shared verifier, resolved per request so nothing is built at import."""
+    return await get_token_verifier().verify(security_scopes, token)
+
+class UnkeyKeyVerifier:
+    """
+    Verifies project API keys with Unkey, caching the outcome per key for a short TTL.
+
+    The Unkey client stays open for the process lifetime, and concurrent verifications of
+    the same key share a single remote call.
+    """
+
+    def __init__(self, api_id: str, api_key: str, settings: Optional[Settings] = None):
+        self.config = settings or get_settings()
+        self.api_id = api_id
+        # the SDK pulls in aiohttp, import it when a verifier is built rather than with the app
+        import unkey
+        self.client = unkey.Client(api_key)
+        self.started = False
+        self.cache = TTLCache(maxsize=self.config.unkey_cache_max_entries, ttl=self.config.unkey_cache_ttl_seconds)
+        self.flights = SingleFlight()
+
+    async def _start(self):
+        await self.client.start()
+        self.started = True
+
+    async def start(self):
+        if not self.started:
+            await self.flights.do("start", self._start)
+
+    async def close(self):
+        if self.started:
+            self.started = False
+            await self.client.close()
+
+    async def _verify_remote(self, key: str, key_hash: str):
+        await self.start()
+        result = await self.client.keys.verify_key(key=key, api_id=self.api_id)
+        if not result.is_ok:
+            raise KeyVerificationError(str(result.unwrap_err()))
+        verification = result.unwrap()
+        if not verification.valid:
+            self.cache.set(key_hash, None, ttl=self.config.unkey_negative_cache_ttl_seconds)
+            return None
+        # keys with usage credits or their own ratelimit have to be checked by Unkey every time
+        if verification.remaining is None and verification.ratelimit is None:
+            ttl = self.config.unkey_cache_ttl_seconds
+            if verification.expires:
+                ttl = min(ttl, verification.expires / 1000 - time.time())
+            self.cache.set(key_hash, verification, ttl=ttl)
+        return verification
+
+    async def verify(self, key: str):
+        """
+        Returns:
+            ApiKeyVerification: the verification for a valid key, or None if the key is invalid.
+
+        Raises:
+            KeyVerificationError: if Unkey could not verify the key.
+        """
+        key_hash = hashlib.sha256(key.encode()).hexdigest()
+        cached = self.cache.get(key_hash, default=False)
+        if cached is not False:
+            return cached
+        return await self.flights.do(key_hash, lambda: self._verify_remote(key, key_hash))
+
+
 def check_scope(payload: str, required_scopes: list[str]):
     """Checks if the token has the required scopes, assuming the token has already been decoded and is valid"""
     token_scopes = payload.get("scope", "").split()
@@ -0,0 +1,65 @@
+"""
+Measures the gateway's cold start: importing app.main, then starting its application context.
+
+Each run is a fresh interpreter. The import is timed with no configuration and no services, so
+it also checks that importing the app has no side effects. Starting the context connects to
+Mongo, loads the model catalog and opens the upstream clients, so it needs a Mongo at MONGO_URI
+(benchmarks.gateway's placeholder settings cover the rest):
+
+    python -m benchmarks.cold_start --runs 5
+    python -m benchmarks.cold_start --runs 5 --startup
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+from benchmarks.gateway import PLACEHOLDER_SETTINGS
+
+# runs in the fresh interpreter, prints its timings as JSON
+PROBE = """
+import asyncio, json, sys, time
+started = time.perf_counter()
+import app.main
+timings = {"import": time.perf_counter() - started}
+if sys.argv[1] == "startup":
+    from app.context import get_context
+
+    async def start():
+        context = get_context()
+        await context.start()
+        timings.update({"startup": context.startup_seconds, **context.startup_timings})
+        await context.close()
+
+    asyncio.run(start())
+print(json.dumps(timings))
+"""
+
+
+def probe(startup: bool) -> dict[str, float]:
+    if startup:
+        env = {**PLACEHOLDER_SETTINGS, **os.environ}
+    else:
+        env = {"PATH": os.environ.get("PATH", ""), "PYTHONPATH": os.environ.get("PYTHONPATH", "")}
+    output = subprocess.check_output([sys.executable, "-c", PROBE, "startup" if startup else "import"], env=env, text=True)
+    # the app prints while it starts, the timings are the last line
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--startup", action="store_true", help="also start the application context")
+    args = parser.parse_args()
+
+    runs = [probe(args.startup) for _ in range(args.runs)]
+    print(f"\n{'step':<20} {'median ms':>10} {'max ms':>10}")
+    for step in runs[0]:
+        values = [run[step] * 1e3 for run in runs]
+        print(f"{step:<20} {statistics.median(values):>10.1f} {max(values):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Runs app.main:app for the gateway benchmarks.
+
+Auth0 and Unkey verification are stubbed out, so any bearer token is accepted as the benchmark
+user, and a benchmark model per provider is seeded in Mongo with token buckets large enough
+never to run out. Everything else, Mongo included, is the real thing: point MONGO_URI at a
+local server, and OPENAI_BASE_URL / ANTHROPIC_BASE_URL at benchmarks.mock_providers.
+
+The Mongo clients are created lazily on the application context, so an in-memory Mongo could
+be swapped in by assigning the context's mongo_client / async_mongo_client (and db / async_db)
+before the first request. The benchmark doesn't: admission, the limiter and the usage log
+writer each make Mongo round trips on the chat path, and those are part of the overhead being
+measured. A fake answers them in-process and would hide them.
+
+Run from the repository root (benchmarks.gateway_overhead starts it for you):
+
+    python -m benchmarks.gateway --port 9200
+"""
+import argparse
+import datetime
+import os
+from types import SimpleNamespace
+
+BENCH_USER = "bench"
+BENCH_MODELS = {"OpenAI": "bench-openai", "Anthropic": "bench-anthropic"}
+
+# settings the app requires but the benchmark never uses
+PLACEHOLDER_SETTINGS = {
+    "AUTH0_DOMAIN": "auth0.invalid",
+    "AUTH0_API_AUDIENCE": "bench",
+    "AUTH0_ISSUER": "bench",
+    "AUTH0_ALGORITHMS": "RS256",
+    "UNKEY_API_ID": "bench",
+    "UNKEY_API_KEY": "bench",
+    "OPENAI_API_KEY": "bench",
+    "ANTHROPIC_API_KEY": "bench",
+    "MONGO_URI": "mongodb://localhost:27017",
+}
+
+
+def stub_auth(main):
+    """Accept every request as the benchmark user, without calling Auth0 or Unkey."""
+    from app.context import get_context
+    from app.utils import verify_token as verify_token_dependency
+
+    claims = {"sub": BENCH_USER, "scope": "key_type:core"}
+    verification = SimpleNamespace(valid=True, owner_id=BENCH_USER)
+
+    async def bench_claims():
+        return claims
+
+    async def verify_token(*args, **kwargs):
+        return claims
+
+    async def verify_key(key):
+        return verification
+
+    async def noop():
+        pass
+
+    context = get_context()
+    # the routers depend on verify_token, and the middleware uses the context's verifier
+    main.core_app.dependency_overrides[verify_token_dependency] = bench_claims
+    context.token_verifier.verify = verify_token
+    context.token_verifier.start = context.token_verifier.close = noop
+    context.unkey_verifier.verify = verify_key
+    context.unkey_verifier.start = context.unkey_verifier.close = noop
+
+
+def seed(db):
+    """Upsert the benchmark models and token buckets."""
+    now = datetime.datetime.utcnow()
+    for provider, model_id in BENCH_MODELS.items():
+        db.ai_models.update_one(
+            {"provider_id": model_id},
+            {"$set": {"provider": provider, "max_tokens": 1024, "updatedAt": now}, "$setOnInsert": {"createdAt": now}},
+            upsert=True,
+        )
+    for access_type in ("ui-access", "api-access"):
+        db.token_buckets.update_one(
+            {"applicable_user_name": BENCH_USER, "type": access_type},
+            {
+                "$set": {
+                    "applicable_ai_model_ids": list(BENCH_MODELS.values()),
+                    "window_duration_mins": 1,
+                    "max_tokens_within_window": 10 ** 12,
+                    "updatedAt": now,
+                },
+                "$setOnInsert": {"createdAt": now},
+            },
+            upsert=True,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9200)
+    args = parser.parse_args()
+
+    for name, value in PLACEHOLDER_SETTINGS.items():
+        os.environ.setdefault(name, value)
+
+    import uvicorn
+    from app import main as gateway
+    from app.mongo import db
+
+    stub_auth(gateway)
+    seed(db)
+    uvicorn.run(gateway.app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""
+Measures the overhead the gateway adds to chat completions.
+
+Starts benchmarks.mock_providers and benchmarks.gateway as subprocesses, then sends the same
+load to each provider directly and through both chat routers (/v1 and /projects/v1), with and
+without streaming. For every scenario it reports requests per second, p50/p99 latency and
+time to first token; for the gateway it also reports the time to first token and the gap
+between chunks it adds on top of the provider's.
+
+The gateway needs a Mongo it can write to, MONGO_URI defaults to mongodb://localhost:27017
+(e.g. `docker run --rm -p 27017:27017 mongo:7`). Results are written to benchmarks/results/
+as JSON, named after the time and commit, and an earlier run can be compared against:
+
+    python -m benchmarks.gateway_overhead --requests 200 --concurrency 16
+    python -m benchmarks.gateway_overhead --compare benchmarks/results/<earlier run>.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+from typing import Optional
+
+import httpx
+
+from benchmarks.gateway import BENCH_MODELS, BENCH_USER
+
+PROVIDERS = ("OpenAI", "Anthropic")
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+# metrics shown by --compare, and whether higher is better
+COMPARED_METRICS = {
+    "rps": True,
+    "latency_p50_ms": False,
+    "latency_p99_ms": False,
+    "added_ttft_ms": False,
+    "added_chunk_gap_ms": False,
+}
+
+
+def percentile(values: list[float], p: float) -> float:
+    # nearest rank
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p * len(ordered)) - 1)]
+
+
+async def timed_request(client: httpx.AsyncClient, url: str, headers: dict, body: dict, stream: bool) -> tuple[float, float, list[float]]:
+    """Send one request, returns its latency, its time to first token and the arrival times of its SSE events."""
+    start = time.perf_counter()
+    if not stream:
+        response = await client.post(url, headers=headers, json=body)
+        response.raise_for_status()
+        latency = time.perf_counter() - start
+        return latency, latency, []
+    arrivals = []
+    async with client.stream("POST", url, headers=headers, json=body) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if line.startswith("data:"):
+                arrivals.append(time.perf_counter() - start)
+    latency = time.perf_counter() - start
+    return latency, arrivals[0] if arrivals else latency, arrivals
+
+
+async def run_scenario(client: httpx.AsyncClient, url: str, headers: dict, body, stream: bool, requests: int, concurrency: int) -> dict:
+    """
+    Send `requests` requests, `concurrency` at a time, after a round of warm-up requests.
+
+    Args:
+        body (Callable[[int], dict]): Builds the body of the i-th request, bodies differ so identical requests aren't coalesced.
+    """
+    samples = []
+    errors = []
+
+    async def worker(indexes):
+        for i in indexes:
+            try:
+                samples.append(await timed_request(client, url, headers, body(i), stream))
+            except (httpx.HTTPError, ValueError) as error:
+                errors.append(str(error) or type(error).__name__)
+
+    await asyncio.gather(*(timed_request(client, url, headers, body(-1 - i), stream) for i in range(concurrency)))
+    indexes = iter(range(requests))
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(indexes) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    if not samples:
+        raise RuntimeError(f"Every request to {url} failed, e.g. {errors[0]}")
+    latencies = [latency for latency, _, _ in samples]
+    ttfts = [ttft for _, ttft, _ in samples]
+    gaps = [(arrivals[-1] - arrivals[0]) / (len(arrivals) - 1) for _, _, arrivals in samples if len(arrivals) > 1]
+    return {
+        "requests": len(samples),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "rps": len(samples) / elapsed,
+        "latency_p50_ms": percentile(latencies, 0.5) * 1e3,
+        "latency_p99_ms": percentile(latencies, 0.99) * 1e3,
+        "ttft_p50_ms": percentile(ttfts, 0.5) * 1e3,
+        "ttft_p99_ms": percentile(ttfts, 0.99) * 1e3,
+        "chunk_gap_ms": sum(gaps) / len(gaps) * 1e3 if gaps else None,
+    }
+
+
+def start_process(module: str, args: list[str], env: dict) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, "-m", module, *args], env=env)
+
+
+def wait_until_ready(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with status {process.returncode} before it was ready")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} wasn't ready after {timeout}s")
+
+
+def git_commit() -> str:
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{commit}-dirty" if dirty else commit
+
+
+async def benchmark(args) -> dict:
+    provider_url = f"http://{args.host}:{args.provider_port}"
+    gateway_url = f"http://{args.host}:{args.gateway_port}"
+    routes = {
+        "core": (f"{gateway_url}/v1/chat/completions", {"authorization": "Bearer bench", "username": BENCH_USER}),
+        "projects": (f"{gateway_url}/projects/v1/chat/completions", {"authorization": "Bearer bench"}),
+    }
+    direct = {
+        "OpenAI": f"{provider_url}/v1/chat/completions",
+        "Anthropic": f"{provider_url}/v1/messages",
+    }
+
+    def body_for(model: str, stream: bool, route: str):
+        def body(i: int) -> dict:
+            return {
+                "model": model,
+                "stream": stream,
+                "max_tokens": 1024,
+                "messages": [{"role": "user", "content": f"Benchmark request {route} {i}, reply with anything."}],
+            }
+        return body
+
+    scenarios = {}
+    limits = httpx.Limits(max_connections=args.concurrency * 2, max_keepalive_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(timeout=60, limits=limits) as client:
+        for provider in PROVIDERS:
+            for stream in (False, True):
+                mode = "stream" if stream else "json"
+                baseline = await run_scenario(client, direct[provider], {}, body_for(BENCH_MODELS[provider], stream, "direct"),
+                                              stream, args.requests, args.concurrency)
+                scenarios[f"direct/{provider}/{mode}"] = baseline
+                for route, (url, headers) in routes.items():
+                    result = await run_scenario(client, url, headers, body_for(BENCH_MODELS[provider], stream, route),
+                                                stream, args.requests, args.concurrency)
+                    result["added_ttft_ms"] = result["ttft_p50_ms"] - baseline["ttft_p50_ms"]
+                    result["added_latency_p50_ms"] = result["latency_p50_ms"] - baseline["latency_p50_ms"]
+                    if result["chunk_gap_ms"] is not None and baseline["chunk_gap_ms"] is not None:
+                        result["added_chunk_gap_ms"] = result["chunk_gap_ms"] - baseline["chunk_gap_ms"]
+                    scenarios[f"{route}/{provider}/{mode}"] = result
+    return scenarios
+
+
+def format_ms(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value:.2f}"
+
+
+def print_report(scenarios: dict):
+    print(f"{'scenario':<26} {'rps':>8} {'p50 ms':>9} {'p99 ms':>9} {'ttft ms':>9} {'+ttft ms':>9} {'gap ms':>8} {'+gap ms':>8} {'errors':>7}")
+    for name, result in scenarios.items():
+        print(
+            f"{name:<26} {result['rps']:>8.1f} {format_ms(result['latency_p50_ms']):>9} {format_ms(result['latency_p99_ms']):>9}"
+            f" {format_ms(result['ttft_p50_ms']):>9} {format_ms(result.get('added_ttft_ms')):>9}"
+            f" {format_ms(result['chunk_gap_ms']):>8} {format_ms(result.get('added_chunk_gap_ms')):>8} {result['errors']:>7}"
+        )
+
+
+def print_comparison(previous: dict, current: dict):
+    print(f"\nCompared with {previous['commit']} ({previous['timestamp']}):")
+    if previous["config"] != current["config"]:
+        print(f"  Runs used different settings, {previous['config']} then {current['config']}")
+    for name, result in current["scenarios"].items():
+        before = previous["scenarios"].get(name)
+        if before is None or name.startswith("direct/"):
+            continue
+        changes = []
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            if result.get(metric) is None or before.get(metric) is None:
+                continue
+            delta = result[metric] - before[metric]
+            worse = delta < 0 if higher_is_better else delta > 0
+            changes.append(f"{metric} {before[metric]:.2f} -> {result[metric]:.2f}{' (worse)' if worse and abs(delta) > 0.05 * abs(before[metric]) else ''}")
+        print(f"  {name:<26} " + ", ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.05, help="provider seconds before the first token")
+    parser.add_argument("--token-rate", type=float, default=1000, help="provider tokens per second")
+    parser.add_argument("--tokens", type=int, default=32, help="output tokens per completion")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--provider-port", type=int, default=9100)
+    parser.add_argument("--gateway-port", type=int, default=9200)
+    parser.add_argument("--mongo-uri", help="Mongo for the gateway, defaults to MONGO_URI or mongodb://localhost:27017")
+    parser.add_argument("--results-dir", default=RESULTS_DIR)
+    parser.add_argument("--compare", help="results file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env["OPENAI_BASE_URL"] = f"http://{args.host}:{args.provider_port}/v1"
+    env["ANTHROPIC_BASE_URL"] = f"http://{args.host}:{args.provider_port}"
+    if args.mongo_uri:
+        env["MONGO_URI"] = args.mongo_uri
+
+    processes = []
+    try:
+        provider = start_process("benchmarks.mock_providers", [
+            "--host", args.host, "--port", str(args.provider_port), "--latency", str(args.latency),
+            "--token-rate", str(args.token_rate), "--tokens", str(args.tokens),
+        ], env)
+        processes.append(provider)
+        wait_until_ready(f"http://{args.host}:{args.provider_port}/v1/messages", provider)
+        gateway = start_process("benchmarks.gateway", ["--host", args.host, "--port", str(args.gateway_port)], env)
+        processes.append(gateway)
+        wait_until_ready(f"http://{args.host}:{args.gateway_port}/projects/v1/helloworld", gateway)
+
+        scenarios = asyncio.run(benchmark(args))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.datetime.utcnow().isoformat(timespec="seconds"),
+        "config": {key: getattr(args, key) for key in ("requests", "concurrency", "latency", "token_rate", "tokens")},
+        "scenarios": scenarios,
+    }
+    print_report(scenarios)
+    os.makedirs(args.results_dir, exist_ok=True)
+    path = os.path.join(args.results_dir, f"{results['timestamp'].replace(':', '')}-{results['commit']}.json")
+    with open(path, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"\nResults written to {path}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            print_comparison(json.load(file), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Compares response serialization before and after the move to orjson.
+
+Run from the repository root:
+
+    python -m benchmarks.json_serialization
+"""
+import datetime
+import json
+import timeit
+
+from bson import ObjectId
+
+from app.responses import dumps
+
+
+def usage_logs(count: int) -> list[dict]:
+    now = datetime.datetime.utcnow()
+    return [
+        {
+            "_id": ObjectId(),
+            "ai_model_id": "gpt-4o-mini",
+            "applicable_token_bucket_id": ObjectId(),
+            "user_name": f"user-{i % 50}",
+            "tokens_input": 120 + i % 300,
+            "tokens_output": 480 + i % 700,
+            "request_completed": True,
+            "createdAt": now,
+            "updatedAt": now,
+        }
+        for i in range(count)
+    ]
+
+
+def chat_completion() -> dict:
+    return {
+        "id": "chatcmpl-123",
+        "object": "chat.completion",
+        "created": 1700000000,
+        "model": "gpt-4o-mini",
+        "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "Hello! " * 200}}],
+        "usage": {"prompt_tokens": 12, "completion_tokens": 400, "total_tokens": 412},
+    }
+
+
+def convert_object_id(obj):
+    if isinstance(obj, ObjectId):
+        return str(obj)
+    if isinstance(obj, dict):
+        return {k: convert_object_id(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [convert_object_id(i) for i in obj]
+    return obj
+
+
+def stdlib_usage_logs(logs: list[dict]) -> bytes:
+    # what /usage-logs used to do: convert ObjectIds, isoformat datetimes, then JSONResponse's json.dumps
+    logs = convert_object_id(logs)
+    for log in logs:
+        log["createdAt"] = log["createdAt"].isoformat()
+        log["updatedAt"] = log["updatedAt"].isoformat()
+    return json.dumps({"message": "Usage logs listed", "body": logs}, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def stdlib_chat_completion(completion: dict) -> bytes:
+    # what the non-streaming OpenAI path used to do: json.dumps the dict, then JSONResponse encoded the string again
+    return json.dumps(json.dumps(completion), ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def report(name: str, baseline, candidate, number: int):
+    before = min(timeit.repeat(baseline, number=number, repeat=5)) / number
+    after = min(timeit.repeat(candidate, number=number, repeat=5)) / number
+    print(f"{name:<24} stdlib {before * 1e3:8.3f} ms   orjson {after * 1e3:8.3f} ms   {before / after:5.1f}x")
+
+
+if __name__ == "__main__":
+    logs = usage_logs(1000)
+    completion = chat_completion()
+    report("usage logs (1000 docs)", lambda: stdlib_usage_logs(logs), lambda: dumps({"message": "Usage logs listed", "body": logs}), 20)
+    report("chat completion", lambda: stdlib_chat_completion(completion), lambda: dumps(completion), 2000)
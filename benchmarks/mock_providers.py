@@ -0,0 +1,132 @@
+"""
+Stand-in OpenAI and Anthropic servers for the gateway benchmarks.
+
+One app serves both protocols: OpenAI chat completions at /v1/chat/completions and Anthropic
+messages at /v1/messages, streaming (SSE) or not. Every completion is `tokens` tokens long,
+the first arrives after `latency` seconds and the rest at `token_rate` tokens per second.
+
+Run from the repository root (benchmarks.gateway_overhead starts it for you):
+
+    python -m benchmarks.mock_providers --port 9100 --latency 0.05 --token-rate 1000 --tokens 32
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+TOKEN = "tok "
+
+
+def prompt_tokens(body: dict) -> int:
+    # about four characters per token, close enough for a stand-in
+    return max(1, len(json.dumps(body.get("messages", []))) // 4)
+
+
+def sse(data: dict, event: str = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+def create_app(latency: float, token_rate: float, tokens: int) -> Starlette:
+    interval = 1 / token_rate if token_rate > 0 else 0.0
+
+    async def paced():
+        # yields once per token, on a fixed schedule so sleeps don't drift
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for i in range(tokens):
+            yield i
+            await asyncio.sleep(max(0.0, start + (i + 1) * interval - loop.time()))
+
+    async def openai_chat(request: Request):
+        body = await request.json()
+        model = body.get("model")
+        completion_id = f"chatcmpl-{uuid.uuid4()}"
+        created = int(time.time())
+        usage = {"prompt_tokens": prompt_tokens(body), "completion_tokens": tokens, "total_tokens": prompt_tokens(body) + tokens}
+        await asyncio.sleep(latency)
+
+        if not body.get("stream"):
+            await asyncio.sleep(interval * tokens)
+            return JSONResponse({
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": TOKEN * tokens}}],
+                "usage": usage,
+            })
+
+        def chunk(choices: list, chunk_usage: dict = None) -> str:
+            return sse({"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                        "choices": choices, "usage": chunk_usage})
+
+        async def events():
+            async for _ in paced():
+                yield chunk([{"index": 0, "delta": {"content": TOKEN}, "finish_reason": None}])
+            yield chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if (body.get("stream_options") or {}).get("include_usage"):
+                yield chunk([], usage)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    async def anthropic_messages(request: Request):
+        body = await request.json()
+        model = body.get("model")
+        message_id = f"msg_{uuid.uuid4().hex}"
+        input_tokens = prompt_tokens(body)
+        await asyncio.sleep(latency)
+
+        if not body.get("stream"):
+            await asyncio.sleep(interval * tokens)
+            return JSONResponse({
+                "id": message_id,
+                "type": "message",
+                "role": "assistant",
+                "model": model,
+                "content": [{"type": "text", "text": TOKEN * tokens}],
+                "stop_reason": "end_turn",
+                "usage": {"input_tokens": input_tokens, "output_tokens": tokens},
+            })
+
+        async def events():
+            yield sse({"type": "message_start", "message": {"id": message_id, "type": "message", "role": "assistant", "model": model,
+                                                            "content": [], "usage": {"input_tokens": input_tokens, "output_tokens": 1}}},
+                      "message_start")
+            yield sse({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}, "content_block_start")
+            async for _ in paced():
+                yield sse({"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": TOKEN}}, "content_block_delta")
+            yield sse({"type": "content_block_stop", "index": 0}, "content_block_stop")
+            yield sse({"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": tokens}}, "message_delta")
+            yield sse({"type": "message_stop"}, "message_stop")
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return Starlette(routes=[
+        Route("/v1/chat/completions", openai_chat, methods=["POST"]),
+        Route("/v1/messages", anthropic_messages, methods=["POST"]),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds before the first token")
+    parser.add_argument("--token-rate", type=float, default=1000, help="tokens per second after the first, 0 for no pacing")
+    parser.add_argument("--tokens", type=int, default=32, help="output tokens per completion")
+    args = parser.parse_args()
+    app = create_app(args.latency, args.token_rate, args.tokens)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
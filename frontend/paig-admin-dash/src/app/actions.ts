@@ -79,17 +79,30 @@ export const getAuthToken = async () => {
   return token;
 };
 
+// list endpoints are paginated, follow next_cursor until the last page
+async function fetchAllPages<T>(path: string, token: string): Promise<T[]> {
+  const items: T[] = []
+  let cursor: string | null = null
+  do {
+    const params = new URLSearchParams({ limit: '1000' })
+    if (cursor) params.set('cursor', cursor)
+    const response = await fetch(`${API_URL}${path}?${params}`, {
+      method: 'GET',
+      headers: {
+        'Content-Type': 'application/json',
+        'Authorization': `Bearer ${token}`
+      }
+    })
+    const page = await response.json()
+    items.push(...page.body)
+    cursor = page.next_cursor
+  } while (cursor)
+  return items
+}
+
 export async function getUsers(): Promise<User[]> {
   const token = await getAuthToken()
-  const response = await fetch(`${API_URL}/users`, {
-    method: 'GET',
-    headers: {
-      'Content-Type': 'application/json',
-      'Authorization': `Bearer ${token}`
-    }
-  })
-  const users = await response.json()
-  return users.body
+  return fetchAllPages<User>('/users', token)
 }
 
 export async function getModels(): Promise<AiModel[]> {
@@ -107,15 +120,7 @@ export async function getModels(): Promise<AiModel[]> {
 
 export async function getTokenBuckets(): Promise<TokenBucket[]> {
   const token = await getAuthToken()
-  const response = await fetch(`${API_URL}/token-buckets`, {
-    method: 'GET',
-    headers: {
-      'Content-Type': 'application/json',
-      'Authorization': `Bearer ${token}`
-    }
-  })
-  const tokenBuckets = await response.json()
-  return tokenBuckets.body
+  return fetchAllPages<TokenBucket>('/token-buckets', token)
 }
 
 export async function createUser(formData: FormData): Promise<User> {
@@ -267,14 +272,7 @@ export async function deleteTokenBucket(bucketId: string): Promise<void> {
 
 export async function getUsageLogs(): Promise<RequestUsageLog[]> {
   const token = await getAuthToken()
-  const response = await fetch(`${API_URL}/usage-logs`, {
-    method: 'GET',
-    headers: {
-      'Authorization': `Bearer ${token}`
-    }
-  })
-  const usageLogs = await response.json()
-  return usageLogs.body
+  return fetchAllPages<RequestUsageLog>('/usage-logs', token)
 }
 
 export async function getKey(username: string, name: string): Promise<string> {
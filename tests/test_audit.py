@@ -0,0 +1,74 @@
+import datetime
+from types import SimpleNamespace
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.routes import audit
+from app.utils import verify_token
+
+
+@pytest.fixture
+def queries(monkeypatch):
+    # the rollup queries and usage log filters the routes would have sent to Mongo
+    queries = []
+
+    def query(**kwargs):
+        queries.append(kwargs)
+        return []
+
+    def paginate(collection, filter, *args, **kwargs):
+        queries.append(filter)
+        return [], None
+
+    monkeypatch.setattr(audit, "db_manager", SimpleNamespace(rollups=SimpleNamespace(query=query), db=SimpleNamespace(request_usage_logs=None)))
+    monkeypatch.setattr(audit, "paginate", paginate)
+    return queries
+
+
+@pytest.fixture
+def client():
+    app = FastAPI()
+    app.include_router(audit.audit_api_router)
+    app.dependency_overrides[verify_token] = lambda: {"sub": "admin"}
+    return TestClient(app)
+
+
+def test_naive_utc():
+    assert audit.naive_utc(None) is None
+    naive = datetime.datetime(2026, 1, 1, 8)
+    assert audit.naive_utc(naive) is naive
+    aware = datetime.datetime(2026, 1, 1, 10, tzinfo=datetime.timezone(datetime.timedelta(hours=2)))
+    assert audit.naive_utc(aware) == naive
+
+
+def test_analytics_converts_offset_aware_params_to_utc(client, queries):
+    response = client.get("/usage-analytics", params={"start": "2026-01-01T10:00:00+02:00", "end": "2026-01-01T09:00:00Z"})
+
+    assert response.status_code == 200
+    assert queries[0]["start"] == datetime.datetime(2026, 1, 1, 8)
+    assert queries[0]["end"] == datetime.datetime(2026, 1, 1, 9)
+
+
+def test_analytics_defaults_around_an_offset_aware_end(client, queries):
+    response = client.get("/usage-analytics", params={"end": "2026-01-02T00:00:00-05:00"})
+
+    assert response.status_code == 200
+    assert queries[0]["end"] == datetime.datetime(2026, 1, 2, 5)
+    assert queries[0]["start"] == datetime.datetime(2026, 1, 1, 5)
+
+
+def test_analytics_compares_offset_aware_params_in_utc(client, queries):
+    # 10:00+02:00 is after 07:00Z, though its wall clock time isn't
+    response = client.get("/usage-analytics", params={"start": "2026-01-01T10:00:00+02:00", "end": "2026-01-01T07:00:00Z"})
+
+    assert response.status_code == 400
+    assert queries == []
+
+
+def test_usage_logs_filter_converts_offset_aware_params_to_utc(client, queries):
+    response = client.get("/usage-logs", params={"start": "2026-01-01T10:00:00+02:00", "end": "2026-01-01T12:30:00+05:30"})
+
+    assert response.status_code == 200
+    assert queries[0]["createdAt"] == {"$gte": datetime.datetime(2026, 1, 1, 8), "$lt": datetime.datetime(2026, 1, 1, 7)}
@@ -0,0 +1,110 @@
+import asyncio
+
+import pytest
+from fastapi.responses import StreamingResponse
+
+from app.coalescing import ChunkBroadcast, CompletionFlights
+
+
+async def collect(iterator):
+    return [chunk async for chunk in iterator]
+
+
+def test_late_subscriber_gets_the_chunks_it_missed():
+    async def main():
+        release = asyncio.Event()
+
+        async def stream():
+            yield "one"
+            await release.wait()
+            yield b"two"
+
+        broadcast = ChunkBroadcast(stream(), on_done=lambda: None)
+        first = broadcast.subscribe()
+        assert await first.__anext__() == b"one"
+        late = broadcast.subscribe()
+        release.set()
+        return await collect(first), await collect(late)
+
+    assert asyncio.run(main()) == ([b"two"], [b"one", b"two"])
+
+
+def test_stream_is_cancelled_once_the_last_subscriber_leaves():
+    async def main():
+        cancelled = asyncio.Event()
+
+        async def stream():
+            try:
+                yield b"one"
+                await asyncio.sleep(10)
+            finally:
+                cancelled.set()
+
+        broadcast = ChunkBroadcast(stream(), on_done=lambda: None)
+        first, second = broadcast.subscribe(), broadcast.subscribe()
+        await first.__anext__()
+        await first.aclose()
+        await asyncio.sleep(0)
+        assert not cancelled.is_set()
+
+        # a subscriber that never read anything still counts
+        await second.aclose()
+        await asyncio.wait_for(cancelled.wait(), 1)
+
+    asyncio.run(main())
+
+
+def test_stream_error_is_raised_for_every_subscriber():
+    async def main():
+        async def stream():
+            yield b"one"
+            raise RuntimeError("upstream failed")
+
+        broadcast = ChunkBroadcast(stream(), on_done=lambda: None)
+        for subscription in (broadcast.subscribe(), broadcast.subscribe()):
+            with pytest.raises(RuntimeError):
+                await collect(subscription)
+
+    asyncio.run(main())
+
+
+def test_identical_requests_share_one_call():
+    async def main():
+        flights = CompletionFlights(enabled=True)
+        calls = []
+
+        async def stream():
+            await asyncio.sleep(0.01)
+            yield b"data: [DONE]\n\n"
+
+        async def complete():
+            calls.append(None)
+            await asyncio.sleep(0.01)
+            return StreamingResponse(stream()), "log"
+
+        joined = await asyncio.gather(*(flights.join("key", complete) for _ in range(3)))
+        bodies = [await collect(response.body_iterator) for response, _, _ in joined]
+        return calls, [(log_id, leader) for _, log_id, leader in joined], bodies, flights.flights
+
+    calls, joined, bodies, in_flight = asyncio.run(main())
+    assert len(calls) == 1
+    assert joined == [("log", True), ("log", False), ("log", False)]
+    assert bodies == [[b"data: [DONE]\n\n"]] * 3
+    # the flight lands once the stream has ended
+    assert in_flight == {}
+
+
+def test_failed_call_fails_every_caller_and_lands():
+    async def main():
+        flights = CompletionFlights(enabled=True)
+
+        async def complete():
+            await asyncio.sleep(0.01)
+            raise RuntimeError("admission failed")
+
+        results = await asyncio.gather(*(flights.join("key", complete) for _ in range(2)), return_exceptions=True)
+        return results, flights.flights
+
+    results, in_flight = asyncio.run(main())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert in_flight == {}
@@ -0,0 +1,42 @@
+import os
+import uuid
+
+import pytest
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+from app.mongo import check_query_plans, ensure_indexes, verify_indexes
+
+MONGO_URI = os.environ.get("TEST_MONGO_URI", "mongodb://localhost:27017")
+
+
+@pytest.fixture
+def db():
+    client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=500)
+    try:
+        client.admin.command("ping")
+    except PyMongoError:
+        client.close()
+        pytest.skip(f"no mongod at {MONGO_URI}")
+    # a throwaway database per test, laid out like the app's
+    name = f"test_{uuid.uuid4().hex[:12]}"
+    yield client.get_database(name).get_collection("bongodb")
+    client.drop_database(name)
+    client.close()
+
+
+def test_hot_path_queries_use_indexes(db):
+    ensure_indexes(db)
+    assert check_query_plans(db) == []
+
+
+def test_ensure_indexes_keeps_indexes_with_other_names(db):
+    # indexes created by earlier versions with the default names
+    db.token_bucket_counters.create_index([("expiresAt", 1)], expireAfterSeconds=0)
+    db.usage_rollups_minute.create_index([("period", 1), ("user_name", 1), ("ai_model_id", 1)])
+
+    ensure_indexes(db)
+    ensure_indexes(db)
+
+    assert "expiresAt_1" in db.token_bucket_counters.index_information()
+    assert verify_indexes(db)["missing"] == []
@@ -0,0 +1,74 @@
+import asyncio
+
+from app.limiter import InMemoryLimiterBackend, TokenBucketLimiter
+
+# a one minute window, so window n covers [60n, 60n + 60)
+BUCKET = {"_id": "bucket", "window_duration_mins": 1, "max_tokens_within_window": 100}
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_admits_up_to_the_limit_inclusive():
+    limiter = TokenBucketLimiter(InMemoryLimiterBackend())
+
+    assert run(limiter.acquire(BUCKET, 60, now=60.0)) == 60
+    assert run(limiter.acquire(BUCKET, 40, now=60.0)) == 100
+    assert run(limiter.acquire(BUCKET, 1, now=60.0)) is None
+    # a refused request isn't charged
+    assert run(limiter.usage(BUCKET, now=60.0)) == 100
+
+
+def test_previous_window_counts_fully_at_the_window_boundary():
+    limiter = TokenBucketLimiter(InMemoryLimiterBackend())
+    run(limiter.acquire(BUCKET, 100, now=119.999))
+
+    # the boundary starts a new window, but none of the previous one has slid out yet
+    assert run(limiter.usage(BUCKET, now=120.0)) == 100
+    assert run(limiter.acquire(BUCKET, 1, now=120.0)) is None
+
+
+def test_previous_window_slides_out_as_the_window_elapses():
+    limiter = TokenBucketLimiter(InMemoryLimiterBackend())
+    run(limiter.acquire(BUCKET, 100, now=60.0))
+
+    # half way through the next window, half of the previous one is still counted
+    assert run(limiter.usage(BUCKET, now=150.0)) == 50
+    assert run(limiter.acquire(BUCKET, 50, now=150.0)) == 100
+    assert run(limiter.acquire(BUCKET, 1, now=150.0)) is None
+
+
+def test_windows_older_than_the_previous_one_are_dropped():
+    limiter = TokenBucketLimiter(InMemoryLimiterBackend())
+    run(limiter.acquire(BUCKET, 100, now=60.0))
+
+    assert run(limiter.usage(BUCKET, now=180.0)) == 0
+    assert run(limiter.acquire(BUCKET, 100, now=180.0)) == 100
+
+
+def test_recorded_tokens_are_charged_without_a_limit():
+    limiter = TokenBucketLimiter(InMemoryLimiterBackend())
+    run(limiter.acquire(BUCKET, 90, now=60.0))
+
+    # output tokens have already been spent, they're charged even past the limit
+    run(limiter.record(BUCKET, 30, now=61.0))
+    assert run(limiter.usage(BUCKET, now=61.0)) == 120
+    assert not run(limiter.try_acquire(BUCKET, 1, now=61.0))
+
+
+def test_buckets_are_counted_separately():
+    limiter = TokenBucketLimiter(InMemoryLimiterBackend())
+    other = {**BUCKET, "_id": "other"}
+    run(limiter.acquire(BUCKET, 100, now=60.0))
+
+    assert run(limiter.acquire(other, 100, now=60.0)) == 100
+
+
+def test_window_is_at_least_one_minute():
+    limiter = TokenBucketLimiter(InMemoryLimiterBackend())
+    bucket = {**BUCKET, "window_duration_mins": 0}
+    run(limiter.acquire(bucket, 100, now=60.0))
+
+    assert run(limiter.usage(bucket, now=90.0)) == 100
+    assert run(limiter.usage(bucket, now=150.0)) == 50
@@ -0,0 +1,128 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from openai.types.chat import ChatCompletionChunk
+
+from app import providers
+from app.admission import AdmissionContext
+from app.providers import IDLE_TIMEOUT_EVENT, UPSTREAM_TIMEOUT, stream_anthropic_response, stream_openai_response
+
+IDLE_TIMEOUT = 0.05
+
+
+class Encoding:
+    def encode(self, text):
+        return text.split()
+
+
+class UsageLogWriter:
+    def __init__(self):
+        self.updates = []
+
+    async def update(self, log_id, fields):
+        self.updates.append((log_id, fields))
+
+
+class Limiter:
+    def __init__(self):
+        self.recorded = []
+
+    async def record(self, token_bucket, tokens):
+        self.recorded.append(tokens)
+
+
+@pytest.fixture
+def usage_log_writer(monkeypatch):
+    writer = UsageLogWriter()
+    monkeypatch.setattr(providers, "usage_log_writer", writer)
+    monkeypatch.setattr(providers, "limiter", Limiter())
+    monkeypatch.setattr(providers, "get_settings", lambda: SimpleNamespace(upstream_stream_idle_timeout_seconds=IDLE_TIMEOUT))
+    return writer
+
+
+def admission_context(provider):
+    return AdmissionContext(
+        user_name="alice",
+        access_type="api-access",
+        user=None,
+        ai_model={"provider_id": "model", "provider": provider},
+        token_bucket={"_id": "bucket", "window_duration_mins": 1, "max_tokens_within_window": 1000},
+        input_tokens=3,
+        window_usage=3,
+        log_id="log",
+    )
+
+
+class Stalled:
+    """An upstream stream that sends `items`, then nothing until it's closed."""
+
+    def __init__(self, items):
+        self.items = items
+        self.closed = False
+
+    async def __aiter__(self):
+        for item in self.items:
+            yield item
+        await asyncio.sleep(10)
+
+    def aiter_bytes(self):
+        return self.__aiter__()
+
+    async def close(self):
+        self.closed = True
+
+    async def aclose(self):
+        self.closed = True
+
+
+async def collect(iterator):
+    return [item async for item in iterator]
+
+
+def openai_chunk(content):
+    return ChatCompletionChunk(
+        id="chatcmpl-1",
+        created=0,
+        model="model",
+        object="chat.completion.chunk",
+        choices=[{"index": 0, "delta": {"content": content}, "finish_reason": None}],
+    )
+
+
+def test_idle_openai_stream_is_logged_as_timed_out(usage_log_writer):
+    response = Stalled([openai_chunk("two words")])
+    events = asyncio.run(collect(stream_openai_response(response, admission_context("OpenAI"), Encoding())))
+
+    assert len(events) == 2
+    assert events[-1] == IDLE_TIMEOUT_EVENT
+    assert response.closed
+    assert usage_log_writer.updates == [
+        ("log", {"tokens_output": 2, "request_completed": False, "cancel_reason": UPSTREAM_TIMEOUT}),
+    ]
+
+
+def test_idle_anthropic_stream_is_logged_as_timed_out(usage_log_writer):
+    response = Stalled([
+        b'event: message_start\ndata: {"type":"message_start","message":{"usage":{"input_tokens":4,"output_tokens":1}}}\n\n',
+        b'event: content_block_delta\ndata: {"type":"content_block_delta","index":0,"delta":{"type":"text_delta","text":"two words"}}\n\n',
+    ])
+    events = asyncio.run(collect(stream_anthropic_response(response, admission_context("Anthropic"), Encoding())))
+
+    assert len(events) == 2
+    assert events[-1] == IDLE_TIMEOUT_EVENT
+    assert response.closed
+    # the reported output tokens are from before the stream stalled, the output is counted locally
+    assert usage_log_writer.updates == [
+        ("log", {"tokens_output": 2, "request_completed": False, "cancel_reason": UPSTREAM_TIMEOUT, "tokens_input": 4}),
+    ]
+
+
+def test_finished_stream_is_logged_as_completed(usage_log_writer):
+    async def finished():
+        yield openai_chunk("two words")
+
+    events = asyncio.run(collect(stream_openai_response(finished(), admission_context("OpenAI"), Encoding())))
+
+    assert events[-1] == "data: [DONE]\n\n"
+    assert usage_log_writer.updates == [("log", {"tokens_output": 2, "request_completed": True})]
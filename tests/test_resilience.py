@@ -0,0 +1,175 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app import resilience
+from app.resilience import CircuitBreaker, hedged, with_idle_timeout
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(resilience, "time", SimpleNamespace(monotonic=lambda: now.value))
+    return now
+
+
+def test_breaker_opens_after_consecutive_failures(clock):
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=30)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state == "closed"
+
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+
+def test_breaker_lets_one_probe_through_when_half_open(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=30)
+    breaker.record_failure()
+
+    clock.value += 30
+    assert breaker.state == "half-open"
+    assert breaker.allow()
+    assert not breaker.allow()
+    # a probe that never reported back is replaced once it's as old as reset_seconds
+    clock.value += 30
+    assert breaker.allow()
+
+
+def test_breaker_probe_success_closes_the_circuit(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=30)
+    breaker.record_failure()
+    clock.value += 30
+    assert breaker.allow()
+
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.allow() and breaker.allow()
+
+
+def test_breaker_probe_failure_reopens_the_circuit(clock):
+    breaker = CircuitBreaker(failure_threshold=3, reset_seconds=30)
+    for _ in range(3):
+        breaker.record_failure()
+    clock.value += 30
+    assert breaker.allow()
+
+    # a single failure is enough once the circuit has opened
+    breaker.record_failure()
+    assert breaker.state == "open"
+    clock.value += 29
+    assert not breaker.allow()
+
+
+def test_breaker_end_probe_only_frees_its_own_probe(clock):
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=30)
+    breaker.record_failure()
+    clock.value += 30
+    assert breaker.allow()
+    probe = breaker.probe_started_at
+
+    # a call let through before the circuit opened ends without freeing the probe
+    breaker.end_probe(None)
+    assert not breaker.allow()
+
+    breaker.end_probe(probe)
+    assert breaker.allow()
+
+
+async def chunks(delays):
+    for delay in delays:
+        await asyncio.sleep(delay)
+        yield delay
+
+
+async def collect(iterator):
+    return [item async for item in iterator]
+
+
+def test_idle_timeout_passes_a_stream_that_keeps_going():
+    # longer than the timeout in total, but never idle for that long
+    delays = [0.02] * 10
+    assert asyncio.run(collect(with_idle_timeout(chunks(delays), 0.1))) == delays
+
+
+def test_idle_timeout_raises_when_the_stream_stalls():
+    received = []
+
+    async def main():
+        async for item in with_idle_timeout(chunks([0.01, 0.01, 1]), 0.1):
+            received.append(item)
+
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(main())
+    assert received == [0.01, 0.01]
+
+
+def test_idle_timeout_doesnt_count_time_spent_by_the_consumer():
+    async def main():
+        items = []
+        async for item in with_idle_timeout(chunks([0, 0]), 0.05):
+            await asyncio.sleep(0.1)
+            items.append(item)
+        return items
+
+    assert asyncio.run(main()) == [0, 0]
+
+
+def test_idle_timeout_leaves_other_cancellations_alone():
+    async def main():
+        consumer = asyncio.ensure_future(collect(with_idle_timeout(chunks([1]), 10)))
+        await asyncio.sleep(0.01)
+        consumer.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await consumer
+
+    asyncio.run(main())
+
+
+def test_hedged_returns_the_first_call_if_it_is_quick():
+    calls = []
+
+    async def call():
+        calls.append(None)
+        return "first"
+
+    assert asyncio.run(hedged(call, 0.1)) == "first"
+    assert len(calls) == 1
+
+
+def test_hedged_second_call_wins_and_cancels_the_first():
+    started = []
+
+    async def call():
+        started.append(asyncio.current_task())
+        await asyncio.sleep(1 if len(started) == 1 else 0)
+        return len(started)
+
+    async def main():
+        result = await hedged(call, 0.01)
+        await asyncio.sleep(0)
+        return result, started[0].cancelled()
+
+    assert asyncio.run(main()) == (2, True)
+
+
+def test_hedged_cancels_the_calls_when_cancelled():
+    started = []
+
+    async def call():
+        started.append(asyncio.current_task())
+        await asyncio.sleep(1)
+
+    async def main():
+        caller = asyncio.ensure_future(hedged(call, 0.5))
+        await asyncio.sleep(0.01)
+        caller.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await caller
+        await asyncio.sleep(0)
+        return [task.cancelled() for task in started]
+
+    assert asyncio.run(main()) == [True]
@@ -0,0 +1,123 @@
+import asyncio
+
+import pytest
+
+from app.scheduler import OverloadedException, UpstreamScheduler
+
+WEIGHTS = {"api-access": 1, "ui-access": 3}
+
+
+def scheduler(max_concurrency=1, max_model_concurrency=1, max_queue_depth=1, max_wait=0.05):
+    return UpstreamScheduler(
+        max_concurrency=max_concurrency,
+        provider_max_concurrency={},
+        max_model_concurrency=max_model_concurrency,
+        max_queue_depth=max_queue_depth,
+        max_wait=max_wait,
+        weights=WEIGHTS,
+    )
+
+
+def test_sheds_with_retry_after_when_the_queue_is_full():
+    async def main():
+        upstream = scheduler()
+        slot = await upstream.acquire("OpenAI", "gpt", "api-access", "alice")
+        waiting = asyncio.ensure_future(upstream.acquire("OpenAI", "gpt", "api-access", "bob"))
+        await asyncio.sleep(0)
+
+        with pytest.raises(OverloadedException) as shed:
+            await upstream.acquire("OpenAI", "gpt", "api-access", "carol")
+        # one call holding the slot for ~1s and one queued ahead: about two seconds
+        assert shed.value.status_code == 503
+        assert shed.value.headers == {"Retry-After": "2"}
+
+        slot.release()
+        (await waiting).release()
+
+    asyncio.run(main())
+
+
+def test_sheds_a_call_that_waits_too_long():
+    async def main():
+        upstream = scheduler()
+        slot = await upstream.acquire("OpenAI", "gpt", "api-access", "alice")
+
+        with pytest.raises(OverloadedException) as shed:
+            await upstream.acquire("OpenAI", "gpt", "api-access", "bob")
+        assert shed.value.headers == {"Retry-After": "1"}
+        # the shed call left the queue, so the next one can queue again
+        assert upstream.queue("OpenAI").depth == 0
+        slot.release()
+
+    asyncio.run(main())
+
+
+def test_released_slot_goes_to_the_queued_call():
+    async def main():
+        upstream = scheduler(max_wait=5)
+        slot = await upstream.acquire("OpenAI", "gpt", "api-access", "alice")
+        waiting = asyncio.ensure_future(upstream.acquire("OpenAI", "gpt", "api-access", "bob"))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+
+        slot.release()
+        (await waiting).release()
+        queue = upstream.queue("OpenAI")
+        assert (queue.active, queue.depth) == (0, 0)
+
+    asyncio.run(main())
+
+
+def test_model_cap_only_holds_back_that_model():
+    async def main():
+        upstream = scheduler(max_concurrency=2, max_model_concurrency=1)
+        slot = await upstream.acquire("OpenAI", "gpt", "api-access", "alice")
+        other = await asyncio.wait_for(upstream.acquire("OpenAI", "gpt-mini", "api-access", "alice"), 1)
+
+        with pytest.raises(OverloadedException):
+            await upstream.acquire("OpenAI", "gpt", "api-access", "bob")
+        slot.release()
+        other.release()
+
+    asyncio.run(main())
+
+
+def test_cancelled_wait_leaves_the_queue():
+    async def main():
+        upstream = scheduler(max_wait=5)
+        slot = await upstream.acquire("OpenAI", "gpt", "api-access", "alice")
+        waiting = asyncio.ensure_future(upstream.acquire("OpenAI", "gpt", "api-access", "bob"))
+        await asyncio.sleep(0)
+
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        slot.release()
+        queue = upstream.queue("OpenAI")
+        assert (queue.active, queue.depth) == (0, 0)
+
+    asyncio.run(main())
+
+
+def test_access_types_take_turns_by_weight():
+    async def main():
+        upstream = scheduler(max_queue_depth=10, max_wait=5)
+        slot = await upstream.acquire("OpenAI", "gpt", "api-access", "alice")
+        order = []
+
+        async def call(access_type, owner):
+            acquired = await upstream.acquire("OpenAI", "gpt", access_type, owner)
+            order.append(access_type)
+            await asyncio.sleep(0)
+            acquired.release()
+
+        calls = [asyncio.ensure_future(call("api-access", f"api-{n}")) for n in range(2)]
+        calls += [asyncio.ensure_future(call("ui-access", f"ui-{n}")) for n in range(6)]
+        await asyncio.sleep(0)
+        slot.release()
+        await asyncio.gather(*calls)
+
+        # ui-access has three times the weight of api-access
+        assert order[:4].count("ui-access") == 3
+
+    asyncio.run(main())
@@ -0,0 +1,81 @@
+import json
+
+from app.sse import OpenAIChunkEncoder, SSEParser, decode_literals, text_delta_literal
+
+STREAM = (
+    b"event: message_start\n"
+    b'data: {"type":"message_start","message":{"usage":{"input_tokens":5}}}\n'
+    b"\n"
+    b": keep-alive\n"
+    b"\n"
+    b"event: content_block_delta\r\n"
+    b'data: {"type":"content_block_delta","index":0,"delta":{"type":"text_delta","text":"h\\u00e9llo \\"x\\""}}\r\n'
+    b"\r\n"
+    b"event: multi\n"
+    b"data: one\n"
+    b"data:two\n"
+    b"id: 7\n"
+    b"\n"
+)
+
+EVENTS = [
+    (b"message_start", b'{"type":"message_start","message":{"usage":{"input_tokens":5}}}'),
+    (b"content_block_delta", b'{"type":"content_block_delta","index":0,"delta":{"type":"text_delta","text":"h\\u00e9llo \\"x\\""}}'),
+    (b"multi", b"one\ntwo"),
+]
+
+
+def test_parses_a_whole_stream():
+    assert SSEParser().feed(STREAM) == EVENTS
+
+
+def test_parses_a_stream_split_at_every_byte():
+    parser = SSEParser()
+    events = []
+    for offset in range(len(STREAM)):
+        events += parser.feed(STREAM[offset:offset + 1])
+    assert events == EVENTS
+    assert parser.buffer == b""
+
+
+def test_parses_a_stream_split_anywhere():
+    for split in range(1, len(STREAM)):
+        parser = SSEParser()
+        assert parser.feed(STREAM[:split]) + parser.feed(STREAM[split:]) == EVENTS
+
+
+def test_event_is_held_back_until_its_blank_line():
+    parser = SSEParser()
+    assert parser.feed(b"event: ping\ndata: {}\n") == []
+    assert parser.feed(b"\n") == [(b"ping", b"{}")]
+
+
+def test_text_delta_literal_is_the_raw_json_string():
+    data = EVENTS[1][1]
+    literal = text_delta_literal(data)
+    assert literal == b'"h\\u00e9llo \\"x\\""'
+    assert decode_literals([literal, b'"!"']) == 'héllo "x"!'
+
+
+def test_text_delta_literal_rejects_other_deltas():
+    assert text_delta_literal(b'{"type":"content_block_delta","index":0,"delta":{"type":"input_json_delta","partial_json":"{"}}') is None
+    assert text_delta_literal(b'{"type":"content_block_delta","index":0,"delta":{"type":"text_delta","text":"a"}} ') is None
+    assert decode_literals([]) == ""
+
+
+def test_encoder_writes_openai_chunks():
+    encoder = OpenAIChunkEncoder("chatcmpl-1", "claude", 1700000000, "fp_1")
+    event = encoder.encode(b'"h\\u00e9"')
+    assert event.startswith(b"data: ") and event.endswith(b"\n\n")
+
+    chunk = json.loads(event[len(b"data: "):])
+    assert chunk["id"] == "chatcmpl-1"
+    assert chunk["model"] == "claude"
+    assert chunk["created"] == 1700000000
+    assert chunk["object"] == "chat.completion.chunk"
+    assert chunk["choices"][0]["delta"]["content"] == "hé"
+    assert chunk["choices"][0]["finish_reason"] is None
+
+    final = json.loads(encoder.encode_text('say "hi"', "stop")[len(b"data: "):])
+    assert final["choices"][0]["delta"]["content"] == 'say "hi"'
+    assert final["choices"][0]["finish_reason"] == "stop"
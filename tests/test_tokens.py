@@ -0,0 +1,83 @@
+import base64
+import struct
+
+from app.tokens import (
+    DEFAULT_IMAGE_TOKENS,
+    TOKENS_PER_MESSAGE,
+    TOKENS_PER_REPLY,
+    anthropic_image_tokens,
+    data_url_image_dimensions,
+    estimate_input_tokens,
+    openai_image_tokens,
+)
+
+
+class Encoding:
+    """Counts whitespace-separated words, enough to check what text is counted."""
+
+    def encode_ordinary(self, text):
+        return text.split()
+
+
+def png_data_url(width, height):
+    header = b"\x89PNG\r\n\x1a\n" + struct.pack(">I", 13) + b"IHDR" + struct.pack(">II", width, height)
+    return "data:image/png;base64," + base64.b64encode(header + b"\x00" * 64).decode()
+
+
+def overhead(messages):
+    return TOKENS_PER_REPLY + TOKENS_PER_MESSAGE * messages
+
+
+def test_counts_text_of_strings_and_parts():
+    messages = [
+        {"role": "system", "content": "be brief"},
+        {"role": "user", "name": "alice", "content": [{"type": "text", "text": "one two"}, "three"]},
+    ]
+    assert estimate_input_tokens(messages, Encoding()) == overhead(2) + 6
+
+
+def test_counts_tool_calls():
+    messages = [{"role": "assistant", "content": None, "tool_calls": [{"function": {"name": "lookup", "arguments": '{"q": 1}'}}]}]
+    assert estimate_input_tokens(messages, Encoding()) == overhead(1) + 3
+
+
+def test_skips_malformed_messages_and_parts():
+    messages = [
+        "not a message",
+        {"role": "user", "name": 7, "content": [None, 3, {"type": "text", "text": None}, {"type": "text", "text": "ok"}]},
+        {"role": "assistant", "tool_calls": ["call", {"function": "lookup"}, {"function": {"name": None}}]},
+    ]
+    assert estimate_input_tokens(messages, Encoding()) == overhead(3) + 1
+
+
+def test_charges_images_by_size_and_provider():
+    part = {"type": "image_url", "image_url": {"url": png_data_url(1024, 1024)}}
+    messages = [{"role": "user", "content": [part]}]
+
+    assert estimate_input_tokens(messages, Encoding(), "OpenAI") == overhead(1) + openai_image_tokens(1024, 1024)
+    assert estimate_input_tokens(messages, Encoding(), "Anthropic") == overhead(1) + anthropic_image_tokens(1024, 1024)
+
+
+def test_charges_images_of_unknown_size_the_default():
+    part = {"type": "image_url", "image_url": {"url": "https://example.com/cat.png"}}
+    messages = [{"role": "user", "content": [part]}]
+
+    assert estimate_input_tokens(messages, Encoding(), "Anthropic") == overhead(1) + DEFAULT_IMAGE_TOKENS["Anthropic"]
+
+
+def test_low_detail_openai_images_are_flat():
+    part = {"type": "image_url", "image_url": {"url": png_data_url(4000, 3000), "detail": "low"}}
+    assert estimate_input_tokens([{"role": "user", "content": [part]}], Encoding(), "OpenAI") == overhead(1) + 85
+
+
+def test_image_pricing():
+    # OpenAI's documented examples
+    assert openai_image_tokens(1024, 1024) == 765
+    assert openai_image_tokens(2048, 4096) == 1105
+    assert anthropic_image_tokens(1000, 1000) == 1334
+
+
+def test_reads_image_size_from_the_data_url():
+    assert data_url_image_dimensions(png_data_url(640, 480)) == (640, 480)
+    assert data_url_image_dimensions("data:image/png;base64,!!!!") is None
+    assert data_url_image_dimensions("https://example.com/cat.png") is None
@@ -0,0 +1,108 @@
+import asyncio
+from types import SimpleNamespace
+
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from app.usage_writer import UsageLogWriter
+
+
+class Collection:
+    def __init__(self, errors=()):
+        self.writes = []
+        # errors raised by the next bulk writes, in order
+        self.errors = list(errors)
+
+    async def bulk_write(self, operations, ordered=True):
+        self.writes.append(list(operations))
+        if self.errors:
+            raise self.errors.pop(0)
+
+
+class Rollups:
+    def __init__(self):
+        self.collections = {"hour": Collection()}
+
+    def operation(self, log, granularity):
+        return (granularity, log["_id"], log.get("tokens_output"))
+
+
+def writer(collection=None, batch_size=100, flush_interval=10.0):
+    db_manager = SimpleNamespace(db=SimpleNamespace(request_usage_logs=collection or Collection()), rollups=Rollups())
+    return UsageLogWriter(db_manager, batch_size=batch_size, flush_interval=flush_interval, max_pending=1000)
+
+
+def test_insert_and_update_in_one_batch_are_written_as_one_insert():
+    async def main():
+        usage = writer()
+        await usage.start()
+        log_id = await usage.insert({"user_name": "alice", "request_completed": False})
+        await usage.update(log_id, {"tokens_output": 5, "request_completed": True})
+        await usage.close()
+        return usage, log_id
+
+    usage, log_id = asyncio.run(main())
+    [operations] = usage.collection.writes
+    assert len(operations) == 1 and isinstance(operations[0], InsertOne)
+    assert operations[0]._doc["request_completed"] is True
+    # closed logs are folded into the rollups once, with their final counts
+    assert usage.rollups.collections["hour"].writes == [[("hour", log_id, 5)]]
+    assert usage.open_logs == {}
+
+
+def test_update_of_a_written_log_is_an_update():
+    async def main():
+        usage = writer(batch_size=1)
+        await usage.start()
+        log_id = await usage.insert({"user_name": "alice", "request_completed": False})
+        await usage.update(log_id, {"tokens_output": 5, "cancel_reason": "client_disconnected"})
+        await usage.close()
+        return usage
+
+    usage = asyncio.run(main())
+    inserts, updates = usage.collection.writes
+    assert isinstance(inserts[0], InsertOne) and isinstance(updates[0], UpdateOne)
+    assert len(usage.rollups.collections["hour"].writes) == 1
+
+
+def test_flushes_after_the_interval():
+    async def main():
+        usage = writer(flush_interval=0.01)
+        await usage.start()
+        await usage.insert({"user_name": "alice", "request_completed": False})
+        await asyncio.sleep(0.1)
+        written = len(usage.collection.writes)
+        await usage.close()
+        return written
+
+    assert asyncio.run(main()) == 1
+
+
+def test_retries_only_failed_operations():
+    error = BulkWriteError({"writeErrors": [
+        {"index": 0, "code": 11000, "errmsg": "duplicate key"},
+        {"index": 1, "code": 1, "errmsg": "failed"},
+    ]})
+    collection = Collection(errors=[error])
+
+    async def main():
+        usage = writer(collection)
+        await usage._bulk_write(collection, ["duplicate", "failed", "written"])
+
+    asyncio.run(main())
+    assert collection.writes == [["duplicate", "failed", "written"], ["failed"]]
+
+
+def test_writes_directly_before_it_starts():
+    updates = []
+
+    async def update_request_usage_log(log_id, fields):
+        updates.append((log_id, fields["tokens_output"]))
+
+    async def main():
+        usage = writer()
+        usage.db_manager.update_request_usage_log = update_request_usage_log
+        await usage.update("log", {"tokens_output": 5, "request_completed": True})
+
+    asyncio.run(main())
+    assert updates == [("log", 5)]